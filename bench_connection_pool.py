@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Benchmark per-call latency of a fresh httpx client per request versus the
+shared, pooled connection used by UnifiClient
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+
+# Ensure we can import the project modules
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from main import UnifiClient
+
+STUB_BODY = json.dumps({
+    "data": [{"id": f"host_{i}", "name": f"Host {i}"} for i in range(10)],
+    "nextToken": None,
+}).encode()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Minimal Site Manager stand-in that keeps connections alive"""
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(STUB_BODY)))
+        self.end_headers()
+        self.wfile.write(STUB_BODY)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server():
+    """Start the stub server on a free local port in a background thread"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+async def bench_per_call_client(url, iterations):
+    """Previous behaviour: open a new AsyncClient for every request"""
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        async with httpx.AsyncClient() as client:
+            response = await client.get(url, timeout=30.0)
+            response.json()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+async def bench_pooled_client(client, iterations):
+    """Current behaviour: reuse UnifiClient's shared connection pool"""
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        await client.list_hosts()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def report(name, latencies):
+    latencies_ms = sorted(x * 1000 for x in latencies)
+    p99 = latencies_ms[min(len(latencies_ms) - 1, int(len(latencies_ms) * 0.99))]
+    print(f"{name:<22} mean={statistics.mean(latencies_ms):7.3f}ms "
+          f"p50={statistics.median(latencies_ms):7.3f}ms p99={p99:7.3f}ms")
+    return statistics.mean(latencies_ms)
+
+
+async def main(iterations):
+    server = start_stub_server()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    os.environ.setdefault("UNIFI_API_KEY", "bench_api_key")
+    os.environ["UNIFI_API_URL"] = base_url
+
+    client = UnifiClient()
+    await client.start()
+    try:
+        # Warm up both paths so imports and first connections are excluded
+        await bench_per_call_client(f"{base_url}/v1/hosts", 5)
+        await bench_pooled_client(client, 5)
+
+        before = report("per-call client", await bench_per_call_client(f"{base_url}/v1/hosts", iterations))
+        after = report("pooled client", await bench_pooled_client(client, iterations))
+        print(f"speedup: {before / after:.1f}x over {iterations} calls")
+    finally:
+        await client.close()
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    import logging
+    logging.disable(logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--iterations", type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(main(args.iterations))
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark of output model construction plus JSON encoding for large
+synthetic device payloads: validated models with FastAPI's default encoder
+versus pass-through models encoded with json_dumps (orjson when installed)
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Any, Dict
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel, Field
+
+# Ensure we can import the project modules
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from main import ORJSON_AVAILABLE, ListDevicesOutput, json_dumps
+
+
+class ValidatedListDevicesOutput(BaseModel):
+    """ListDevicesOutput as it was before pass-through fields skipped validation"""
+    data: Dict[str, Any] = Field(..., description="Devices data from API response")
+
+
+def build_payload(hosts, devices_per_host):
+    return {
+        "data": [{
+            "hostId": f"host_{h}",
+            "hostName": f"Host {h}",
+            "updatedAt": "2024-04-15T09:30:29Z",
+            "devices": [{
+                "id": f"dev_{h}_{d}",
+                "mac": f"74:ac:b9:{h % 256:02x}:{d // 256 % 256:02x}:{d % 256:02x}",
+                "name": f"Device {h}-{d}",
+                "model": "U6-LR",
+                "status": "online",
+                "version": "6.6.55",
+                "isManaged": True,
+                "startupTime": "2024-04-01T00:00:00Z",
+                "uidb": {"guid": f"guid-{h}-{d}", "images": {"default": "abc123"}},
+            } for d in range(devices_per_host)],
+        } for h in range(hosts)],
+        "nextToken": None,
+    }
+
+
+def default_path(payload):
+    output = ValidatedListDevicesOutput(data=payload)
+    return json.dumps(jsonable_encoder(output)).encode()
+
+
+def fast_path(payload):
+    output = ListDevicesOutput(data=payload)
+    return json_dumps(output)
+
+
+def bench(name, func, payload, iterations):
+    size = len(func(payload))
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(payload)
+    elapsed = (time.perf_counter() - start) / iterations
+    print(f"{name:<28} {elapsed * 1000:8.1f} ms/response {size / elapsed / 1e6:8.1f} MB/s")
+    return elapsed
+
+
+if __name__ == "__main__":
+    import logging
+    logging.disable(logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--hosts", type=int, default=100)
+    parser.add_argument("--devices-per-host", type=int, default=100)
+    parser.add_argument("-n", "--iterations", type=int, default=5)
+    args = parser.parse_args()
+
+    payload = build_payload(args.hosts, args.devices_per_host)
+    assert json.loads(default_path(payload)) == json.loads(fast_path(payload))
+    print(f"{args.hosts * args.devices_per_host} devices, orjson available: {ORJSON_AVAILABLE}")
+    before = bench("validated + jsonable_encoder", default_path, payload, args.iterations)
+    after = bench("pass-through + json_dumps", fast_path, payload, args.iterations)
+    print(f"speedup: {before / after:.1f}x")
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Benchmark cold start: import time of main (from python -X importtime) with the
+slowest imports, the cost of building the HTTP app, and the time from process
+start to the first tool response against the mock Site Manager server
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Ensure we can import the project modules
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_site_manager import Fleet, MockSiteManager
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+FIRST_TOOL = """
+import asyncio, main
+input_model, tool = main.BATCH_TOOLS["list_hosts"]
+asyncio.run(tool(input_model(live=True)))
+"""
+
+
+def run_python(args, env=None):
+    """Run a fresh interpreter in the project directory and return (seconds, stderr)"""
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, *args], cwd=HERE, env=env, capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode:
+        raise RuntimeError(f"{' '.join(args)} failed:\n{result.stderr}")
+    return elapsed, result.stderr
+
+
+def parse_importtime(stderr):
+    """(total, {module: cumulative}) in microseconds for main and the modules it imports directly"""
+    children = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth == 0:
+            # Nested imports are printed before the module that imported them
+            if name.strip() == "main":
+                return int(cumulative), children
+            children = {}
+        elif depth == 1:
+            children[name.strip()] = int(cumulative)
+    raise ValueError("main not found in -X importtime output")
+
+
+def median_ms(samples):
+    return statistics.median(samples) * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="Number of slowest imports to list")
+    parser.add_argument("--budget-ms", type=float, help="Exit with status 1 if importing main takes longer")
+    args = parser.parse_args()
+
+    # Compile once so every run measures a warm bytecode cache, as an installed server has
+    subprocess.run([sys.executable, "-m", "compileall", "-q", "main.py"], cwd=HERE, check=True)
+    env = {**os.environ, "UNIFI_API_KEY": "bench_api_key", "UNIFI_INVENTORY_SYNC": "false"}
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+
+    interpreter, imports, http_app, first_tool = [], [], [], []
+    for _ in range(args.runs):
+        interpreter.append(run_python(["-c", "pass"], env)[0])
+        elapsed, stderr = run_python(["-X", "importtime", "-c", "import main"], env)
+        imports.append(parse_importtime(stderr))
+        http_app.append(run_python(["-c", "import main; main.create_app()"], env)[0])
+    with MockSiteManager(Fleet(hosts=10, devices_per_host=10)) as server:
+        env["UNIFI_API_URL"] = server.url
+        for _ in range(args.runs):
+            first_tool.append(run_python(["-c", FIRST_TOOL], env)[0])
+
+    base = median_ms(interpreter)
+    totals = [total / 1e6 for total, _ in imports]
+    print(f"interpreter start            {base:8.1f} ms")
+    print(f"import main                  {median_ms(totals):8.1f} ms")
+    print(f"import main + HTTP app       {median_ms(http_app) - base:8.1f} ms (process, excluding interpreter start)")
+    print(f"first tool response          {median_ms(first_tool) - base:8.1f} ms (process, excluding interpreter start)")
+    print(f"slowest imports of main (median of {args.runs} runs):")
+    slowest = {name: statistics.median(run.get(name, 0) for _, run in imports) for name in imports[-1][1]}
+    for name, micros in sorted(slowest.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"  {name:<30} {micros / 1000:8.1f} ms")
+
+    if args.budget_ms is not None and median_ms(totals) > args.budget_ms:
+        print(f"import main exceeds the budget of {args.budget_ms:.0f} ms")
+        sys.exit(1)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Benchmark peak memory of buffered versus streaming parsing of a large
+/v1/devices page, projecting each device group to a few fields
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Ensure we can import the project modules
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from main import UnifiClient, project, projection_tree
+
+
+def build_body(hosts, devices_per_host):
+    """Synthetic devices page with realistic per-device payloads"""
+    groups = []
+    for h in range(hosts):
+        devices = [{
+            "id": f"dev_{h}_{d}",
+            "mac": f"74:ac:b9:{h % 256:02x}:{d // 256 % 256:02x}:{d % 256:02x}",
+            "name": f"Device {h}-{d}",
+            "model": "U6-LR",
+            "status": "online",
+            "version": "6.6.55",
+            "ip": f"10.{h % 256}.{d // 256 % 256}.{d % 256}",
+            "uidb": {"guid": f"guid-{h}-{d}", "images": {"default": "x" * 64}},
+        } for d in range(devices_per_host)]
+        groups.append({"hostId": f"host_{h}", "hostName": f"Host {h}", "devices": devices})
+    return json.dumps({"data": groups, "nextToken": None}).encode()
+
+
+def start_stub_server(body):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+async def measure(client, stream, fields):
+    client.stream_lists = stream
+    client.cache.clear()
+    tree = projection_tree(fields)
+    tracemalloc.start()
+    start = time.perf_counter()
+    groups = [project(group, tree) async for group in client.iter_devices()]
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(groups), peak, elapsed
+
+
+async def main(hosts, devices_per_host):
+    body = build_body(hosts, devices_per_host)
+    server = start_stub_server(body)
+    os.environ.setdefault("UNIFI_API_KEY", "bench_api_key")
+    os.environ["UNIFI_API_URL"] = f"http://127.0.0.1:{server.server_address[1]}"
+
+    client = UnifiClient()
+    client.cache_enabled = False
+    await client.start()
+    fields = ["hostId", "devices.id", "devices.status"]
+    try:
+        print(f"page size: {len(body) / 1e6:.1f} MB, {hosts * devices_per_host} devices in {hosts} groups")
+        for name, stream in (("buffered", False), ("streaming", True)):
+            count, peak, elapsed = await measure(client, stream, fields)
+            print(f"{name:<10} groups={count} peak={peak / 1e6:7.1f} MB time={elapsed * 1000:7.1f} ms")
+    finally:
+        await client.close()
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    import logging
+    logging.disable(logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--hosts", type=int, default=200)
+    parser.add_argument("--devices-per-host", type=int, default=100)
+    args = parser.parse_args()
+    asyncio.run(main(args.hosts, args.devices_per_host))
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Load test of the MCP tools against the local mock Site Manager server:
+throughput, p50/p99 latency, peak memory and upstream requests per call
+for each tool, with an optional comparison against a saved baseline
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+# Ensure we can import the project modules
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main
+from main import BATCH_TOOLS, UnifiClient
+from mock_site_manager import Fleet, MockSiteManager
+
+# Relative change beyond which a metric counts as a regression against the baseline
+REGRESSION_METRICS = {"p50_ms": 1, "p99_ms": 1, "peak_mb": 1, "throughput": -1}
+
+
+def scenarios(fleet):
+    """Tool name and input of each benchmarked call"""
+    host_ids = [host["id"] for host in fleet.hosts]
+    config_id = fleet.sdwan_configs[0]["id"] if fleet.sdwan_configs else "missing"
+    return {
+        "list_hosts": ("list_hosts", {"live": True}),
+        "get_host_by_id": ("get_host_by_id", {"host_id": host_ids[0]}),
+        "list_sites": ("list_sites", {"live": True}),
+        "list_devices": ("list_devices", {"live": True}),
+        "list_devices_all": ("list_devices_all", {"max_items": None, "page_size": 100}),
+        "list_devices_all_fan_out": ("list_devices_all", {"max_items": None, "fan_out": True, "host_ids": host_ids}),
+        "list_devices_projected": ("list_devices_all", {"max_items": None, "fields": ["hostId", "devices.id", "devices.status"]}),
+        "list_sdwan_configs": ("list_sdwan_configs", {"live": True}),
+        "get_sdwan_config_status": ("get_sdwan_config_status", {"config_id": config_id}),
+        "sdwan_overview": ("sdwan_overview", {"live": True}),
+        "get_isp_metrics": ("get_isp_metrics", {"metric_type": "5m", "duration": "24h"}),
+        "summarize_isp_metrics": ("summarize_isp_metrics", {"metric_type": "5m", "duration": "24h"}),
+        "analyze_isp_metrics": ("analyze_isp_metrics", {"metric_type": "5m", "duration": "24h"}),
+        "query_inventory": ("query_inventory", {"filters": {"status": "offline"}, "group_by": "model"}),
+    }
+
+
+async def call(tool, tool_input):
+    input_model, handler = BATCH_TOOLS[tool]
+    return await handler(input_model.model_validate(tool_input))
+
+
+async def run_scenario(server, tool, tool_input, iterations, concurrency):
+    """Time `iterations` calls issued by `concurrency` workers, then measure one call's peak memory"""
+    await call(tool, tool_input)
+    server.reset_stats()
+    latencies = []
+    errors = 0
+    remaining = iter(range(iterations))
+
+    async def worker():
+        nonlocal errors
+        for _ in remaining:
+            start = time.perf_counter()
+            try:
+                await call(tool, tool_input)
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    upstream = sum(server.requests.values())
+
+    tracemalloc.start()
+    try:
+        await call(tool, tool_input)
+    except Exception:
+        pass
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies_ms = sorted(x * 1000 for x in latencies)
+    return {
+        "calls": iterations,
+        "errors": errors,
+        "throughput": iterations / elapsed,
+        "p50_ms": statistics.median(latencies_ms),
+        "p99_ms": latencies_ms[min(len(latencies_ms) - 1, int(len(latencies_ms) * 0.99))],
+        "peak_mb": peak / 1e6,
+        "upstream_per_call": upstream / iterations,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Metrics that got worse than the baseline by more than `tolerance`"""
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        for metric, direction in REGRESSION_METRICS.items():
+            if before.get(metric) and (result[metric] - before[metric]) * direction > tolerance * before[metric]:
+                regressions.append(f"{name}.{metric}: {before[metric]:.2f} -> {result[metric]:.2f}")
+    return regressions
+
+
+async def main_async(args):
+    fleet = Fleet(args.hosts, args.devices_per_host, args.sdwan_configs)
+    server = MockSiteManager(
+        fleet, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate, retry_after=0,
+    ).start()
+    os.environ.setdefault("UNIFI_API_KEY", "bench_api_key")
+    os.environ["UNIFI_API_URL"] = server.url
+
+    client = UnifiClient()
+    client.cache_enabled = not args.no_cache
+    client.retry_base_delay = 0.01
+    await client.start()
+    main.unifi_client = client
+    selected = scenarios(fleet)
+    names = args.tools or list(selected)
+    try:
+        await client.inventory.full_load()
+        # Keep the snapshot in sync, as the server does, so tools keep serving it through long runs
+        client.inventory.start()
+        print(f"mock fleet: {len(fleet.hosts)} hosts, {fleet.device_count} devices, "
+              f"{len(fleet.sdwan_configs)} SD-WAN configs; latency={args.latency * 1000:.0f}ms "
+              f"errors={args.error_rate:.0%} 429s={args.throttle_rate:.0%} cache={'off' if args.no_cache else 'on'}")
+        print(f"{'scenario':<26} {'calls/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'peak MB':>8} {'upstream':>9} {'errors':>7}")
+        results = {}
+        for name in names:
+            tool, tool_input = selected[name]
+            result = results[name] = await run_scenario(server, tool, tool_input, args.iterations, args.concurrency)
+            print(f"{name:<26} {result['throughput']:9.1f} {result['p50_ms']:9.2f} {result['p99_ms']:9.2f} "
+                  f"{result['peak_mb']:8.2f} {result['upstream_per_call']:9.2f} {result['errors']:7d}")
+    finally:
+        main.unifi_client = None
+        await client.close()
+        server.stop()
+    return results
+
+
+if __name__ == "__main__":
+    import logging
+    logging.disable(logging.CRITICAL)
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--hosts", type=int, default=100)
+    parser.add_argument("--devices-per-host", type=int, default=100)
+    parser.add_argument("--sdwan-configs", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.005, help="Mock server latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random extra mock latency, up to this value")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of upstream requests failing with 503")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of upstream requests answered with 429")
+    parser.add_argument("-n", "--iterations", type=int, default=50, help="Calls per scenario")
+    parser.add_argument("-c", "--concurrency", type=int, default=8, help="Concurrent callers per scenario")
+    parser.add_argument("--no-cache", action="store_true", help="Disable the response cache")
+    parser.add_argument("--tools", nargs="*", help="Scenarios to run (default: all)")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--baseline", help="Compare against results saved earlier with --output")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative regression against the baseline")
+    args = parser.parse_args()
+
+    results = asyncio.run(main_async(args))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)["results"], args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
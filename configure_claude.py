@@ -64,7 +64,9 @@ def update_claude_config(config_path, uv_path, server_dir):
             "--directory",
             str(server_dir),
             "run",
-            "main.py"
+            "main.py",
+            "--transport",
+            "stdio"
         ]
     }
     
@@ -111,7 +113,9 @@ Add the following to your Claude Desktop config:
         "--directory",
         "{server_dir}",
         "run",
-        "main.py"
+        "main.py",
+        "--transport",
+        "stdio"
       ]
     }}
   }}
@@ -2,30 +2,61 @@
 """
 Unifi MCP Server - Integrates Unifi Site Manager API with Claude Desktop
 """
+import asyncio
+import bisect
+import codecs
+import contextvars
+import fnmatch
+import functools
+import hashlib
+import hmac
+import importlib.util
+import json
 import os
 import logging
-from typing import Dict, List, Any, Optional
+import random
+import secrets
+import sqlite3
+import threading
+import time
+import warnings
+from collections import OrderedDict, deque
+from datetime import date, datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
 
 import httpx
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel, Field
+# FastAPI's HTTPException is a subclass of this one and both are handled alike; importing it from
+# Starlette keeps FastAPI itself out of the import path until the HTTP app is built (see create_app)
+from starlette.exceptions import HTTPException
+from pydantic import BaseModel, ConfigDict, Field, SkipValidation, ValidationError
 
 try:
-    from mcp import MCPServer
-except Exception:  # pragma: no cover - fallback for missing MCPServer
-    class MCPServer:  # type: ignore
-        def __init__(self, *args, **kwargs) -> None:
-            pass
-
-        def tool(self, *args, **kwargs):  # pragma: no cover - simple decorator
-            def decorator(func):
-                return func
-            return decorator
-
-        def resource(self, *args, **kwargs):  # pragma: no cover - simple decorator
-            def decorator(func):
-                return func
-            return decorator
+    import h2  # noqa: F401 - enables HTTP/2 support in httpx
+    HTTP2_AVAILABLE = True
+except ImportError:  # pragma: no cover - h2 is an optional dependency
+    HTTP2_AVAILABLE = False
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:  # pragma: no cover - orjson is an optional dependency
+    ORJSON_AVAILABLE = False
+
+# numpy is only needed by analyze_isp_metrics and is imported on first use (see _numpy)
+NUMPY_AVAILABLE = importlib.util.find_spec("numpy") is not None
+np: Any = None
+
+
+def _numpy() -> Any:
+    """Import numpy on first use, keeping it out of startup"""
+    global np
+    if np is None:
+        import numpy
+        np = numpy
+    return np
+
+
 
 # Configure logging
 logging.basicConfig(
@@ -34,15 +65,2276 @@ logging.basicConfig(
 )
 logger = logging.getLogger("unifi-mcp-server")
 
-# Initialize FastAPI app
-app = FastAPI(title="Unifi MCP Server")
+# JSON serialization
+
+
+def _json_default(obj: Any) -> Any:
+    if isinstance(obj, BaseModel):
+        # Output models only wrap plain JSON data, so their fields can be encoded directly
+        return dict(obj)
+    if isinstance(obj, (datetime, date)):
+        # Same ISO 8601 form orjson writes natively
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def json_dumps(obj: Any, sort_keys: bool = False) -> bytes:
+    """Serialize to JSON bytes, using orjson when it is installed"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj, default=_json_default, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+    return json.dumps(obj, default=_json_default, sort_keys=sort_keys, separators=(",", ":"),
+                      ensure_ascii=False).encode()
+
+
+def json_loads(data: Any) -> Any:
+    """Parse JSON from bytes or str, using orjson when it is installed"""
+    if ORJSON_AVAILABLE:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+# Instrumentation
+
+# Histogram buckets in seconds, covering cache hits up to slow upstream pages
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Path segments kept in endpoint labels; anything else (host, config IDs) becomes {id}
+ENDPOINT_LABEL_SEGMENTS = {"v1", "ea", "hosts", "sites", "devices", "sd-wan", "configs", "status",
+                           "isp-metrics", "query", "5m", "1h"}
+
+
+def endpoint_label(endpoint: str) -> str:
+    """Endpoint with IDs replaced by {id}, to keep label cardinality bounded"""
+    return "/".join(
+        segment if not segment or segment in ENDPOINT_LABEL_SEGMENTS else "{id}"
+        for segment in endpoint.split("?", 1)[0].split("/")
+    )
+
+
+def _escape_label(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    """Monotonic counter per label values"""
+    kind = "counter"
+    
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values: Dict[Tuple[str, ...], float] = {}
+    
+    def inc(self, labels: Tuple[str, ...] = (), value: float = 1.0) -> None:
+        self.values[labels] = self.values.get(labels, 0.0) + value
+    
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+                for labels, value in self.values.items()]
+
+
+class Gauge(Counter):
+    """Value per label values that can go up and down"""
+    kind = "gauge"
+    
+    def dec(self, labels: Tuple[str, ...] = (), value: float = 1.0) -> None:
+        self.values[labels] = self.values.get(labels, 0.0) - value
+    
+    def set(self, labels: Tuple[str, ...], value: float) -> None:
+        self.values[labels] = value
+
+
+class Histogram:
+    """Cumulative histogram per label values, rendered as Prometheus buckets"""
+    kind = "histogram"
+    
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # Per label values: [count per bucket (plus +Inf), sum]
+        self.values: Dict[Tuple[str, ...], List[Any]] = {}
+    
+    def observe(self, value: float, labels: Tuple[str, ...] = ()) -> None:
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+    
+    def samples(self) -> List[str]:
+        lines = []
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound!r}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """In-process metrics rendered in the Prometheus text exposition format"""
+    
+    def __init__(self):
+        self.metrics: List[Any] = []
+    
+    def register(self, metric: Any) -> Any:
+        self.metrics.append(metric)
+        return metric
+    
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+    
+    def gauge(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+    
+    def histogram(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames))
+    
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+TOOL_CALLS = metrics.counter("unifi_mcp_tool_calls_total", "MCP tool calls by tool and outcome", ("tool", "outcome"))
+TOOL_DURATION = metrics.histogram("unifi_mcp_tool_duration_seconds", "End-to-end MCP tool call latency", ("tool",))
+TOOL_IN_FLIGHT = metrics.gauge("unifi_mcp_tool_calls_in_flight", "MCP tool calls currently running", ("tool",))
+UPSTREAM_REQUESTS = metrics.counter(
+    "unifi_mcp_upstream_requests_total", "Requests sent to the Site Manager API by outcome", ("method", "endpoint", "status")
+)
+UPSTREAM_DURATION = metrics.histogram(
+    "unifi_mcp_upstream_request_duration_seconds", "Site Manager API request latency, including waiting for a connection", ("method", "endpoint")
+)
+UPSTREAM_BYTES = metrics.counter(
+    "unifi_mcp_upstream_response_bytes_total", "Response body bytes received from the Site Manager API", ("endpoint",)
+)
+UPSTREAM_IN_FLIGHT = metrics.gauge("unifi_mcp_upstream_requests_in_flight", "Site Manager API requests currently in flight")
+UPSTREAM_RETRIES = metrics.counter("unifi_mcp_upstream_retries_total", "Retried Site Manager API requests", ("endpoint",))
+CACHE_LOOKUPS = metrics.counter(
+    "unifi_mcp_cache_lookups_total", "Response cache lookups by result (hit, stale, miss)", ("endpoint", "result")
+)
+CONCURRENCY_LIMIT = metrics.gauge("unifi_mcp_concurrency_limit", "Current adaptive upstream concurrency limit")
+CIRCUIT_BREAKER_OPEN = metrics.gauge("unifi_mcp_circuit_breaker_open", "Whether the circuit breaker of a host is open", ("host",))
+
+
+# Tracing
+
+# Span of the code currently running; asyncio tasks inherit it from the task that created them
+_current_span: "contextvars.ContextVar[Optional[Span]]" = contextvars.ContextVar("unifi_current_span", default=None)
+
+
+def parse_traceparent(value: Optional[str]) -> Optional[Tuple[str, str]]:
+    """Trace and parent span IDs from a W3C traceparent header, or None if it is missing or invalid"""
+    if not value:
+        return None
+    parts = value.strip().lower().split("-")
+    if len(parts) < 4 or len(parts[0]) != 2 or parts[0] == "ff" or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[0], 16), int(parts[1], 16), int(parts[2], 16), int(parts[3], 16)
+    except ValueError:
+        return None
+    if parts[1] == "0" * 32 or parts[2] == "0" * 16:
+        return None
+    return parts[1], parts[2]
+
+
+class Span:
+    """A timed operation within a trace; finished spans are handed to the tracer's exporter"""
+    __slots__ = ("tracer", "name", "trace_id", "span_id", "parent_id", "attributes", "events",
+                 "start_ns", "end_ns", "status", "_token")
+    
+    def __init__(self, tracer: "Tracer", name: str, trace_id: str, parent_id: Optional[str],
+                 attributes: Optional[Dict[str, Any]] = None):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.attributes = dict(attributes) if attributes else {}
+        self.events: List[Dict[str, Any]] = []
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.status = "OK"
+        self._token = None
+    
+    def __enter__(self) -> "Span":
+        self._token = _current_span.set(self)
+        return self
+    
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc is not None and not isinstance(exc, asyncio.CancelledError):
+            self.record_exception(exc)
+        _current_span.reset(self._token)
+        self.end()
+    
+    def end(self) -> None:
+        """Finish a span that was not entered as a context manager"""
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            self.tracer.export(self)
+    
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+    
+    def add_event(self, name: str, attributes: Optional[Dict[str, Any]] = None) -> None:
+        self.events.append({"name": name, "timeUnixNano": time.time_ns(), "attributes": attributes or {}})
+    
+    def record_exception(self, exc: BaseException) -> None:
+        self.status = "ERROR"
+        self.add_event("exception", {"exception.type": type(exc).__name__, "exception.message": str(exc)})
+    
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+    
+    def propagation_headers(self) -> Optional[Dict[str, str]]:
+        """Headers that continue this trace in the upstream service"""
+        return {"traceparent": self.traceparent()}
+    
+    def httpx_extensions(self) -> Optional[Dict[str, Any]]:
+        """httpx trace hook that records connection and request phases as span events"""
+        async def trace(event_name: str, info: Dict[str, Any]) -> None:
+            self.add_event(event_name)
+        return {"trace": trace}
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Span in the field layout of OTLP/JSON"""
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id,
+            "name": self.name,
+            "startTimeUnixNano": self.start_ns,
+            "endTimeUnixNano": self.end_ns,
+            "attributes": self.attributes,
+            "events": self.events,
+            "status": self.status,
+            "service": self.tracer.service_name,
+        }
+
+
+class _NoopSpan:
+    """Shared span returned while tracing is disabled; every operation does nothing"""
+    
+    def __enter__(self) -> "_NoopSpan":
+        return self
+    
+    def __exit__(self, exc_type, exc, tb) -> None:
+        pass
+    
+    def set_attribute(self, key: str, value: Any) -> None:
+        pass
+    
+    def add_event(self, name: str, attributes: Optional[Dict[str, Any]] = None) -> None:
+        pass
+    
+    def record_exception(self, exc: BaseException) -> None:
+        pass
+    
+    def end(self) -> None:
+        pass
+    
+    def propagation_headers(self) -> Optional[Dict[str, str]]:
+        return None
+    
+    def httpx_extensions(self) -> Optional[Dict[str, Any]]:
+        return None
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class InMemorySpanExporter:
+    """Keeps the most recent finished spans in memory"""
+    
+    def __init__(self, max_spans: int = 1000):
+        self.spans: "deque[Dict[str, Any]]" = deque(maxlen=max_spans)
+    
+    def export(self, span: Span) -> None:
+        self.spans.append(span.to_dict())
+    
+    def clear(self) -> None:
+        self.spans.clear()
+
+
+class FileSpanExporter:
+    """Appends finished spans to a file, one JSON object per line"""
+    
+    def __init__(self, path: str):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+    
+    def export(self, span: Span) -> None:
+        self._file.write(json_dumps(span.to_dict()).decode() + "\n")
+        self._file.flush()
+
+
+class Tracer:
+    """Creates spans and passes finished ones to a pluggable exporter.
+    
+    Any object with an ``export(span)`` method can be used as exporter. Without an exporter
+    tracing is disabled and ``span()`` returns a shared no-op span.
+    """
+    
+    def __init__(self, exporter: Any = None, service_name: str = "unifi-mcp-server"):
+        self.exporter = exporter
+        self.service_name = service_name
+        self.exported = 0
+        self.export_errors = 0
+    
+    @property
+    def enabled(self) -> bool:
+        return self.exporter is not None
+    
+    def span(self, name: str, attributes: Optional[Dict[str, Any]] = None, traceparent: Optional[str] = None):
+        """Start a span, as a child of the current span or of a remote traceparent"""
+        if self.exporter is None:
+            return NOOP_SPAN
+        parent = _current_span.get()
+        if parent is not None:
+            return Span(self, name, parent.trace_id, parent.span_id, attributes)
+        remote = parse_traceparent(traceparent)
+        if remote is not None:
+            return Span(self, name, remote[0], remote[1], attributes)
+        return Span(self, name, f"{random.getrandbits(128):032x}", None, attributes)
+    
+    def export(self, span: Span) -> None:
+        exporter = self.exporter
+        if exporter is None:
+            return
+        try:
+            exporter.export(span)
+            self.exported += 1
+        except Exception as e:
+            self.export_errors += 1
+            logger.warning(f"Exporting span {span.name} failed: {e}")
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "exporter": type(self.exporter).__name__ if self.exporter is not None else None,
+            "exported": self.exported,
+            "export_errors": self.export_errors,
+        }
+
+
+def create_tracer(mode: str, path: str) -> Tracer:
+    """Tracer for UNIFI_TRACING: 'none' (default), 'memory' or 'file'"""
+    mode = mode.lower()
+    if mode == "memory":
+        return Tracer(InMemorySpanExporter())
+    if mode == "file":
+        return Tracer(FileSpanExporter(path))
+    if mode not in ("", "none", "off", "false"):
+        logger.warning(f"Unknown UNIFI_TRACING mode {mode!r}, tracing disabled")
+    return Tracer()
+
+
+tracer = create_tracer(os.environ.get("UNIFI_TRACING", "none"), os.environ.get("UNIFI_TRACING_FILE", "logs/traces.jsonl"))
+
+
+class TraceContextMiddleware:
+    """ASGI middleware that starts a server span per HTTP request, continuing an incoming traceparent"""
+    
+    def __init__(self, app: Any):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not tracer.enabled:
+            return await self.app(scope, receive, send)
+        traceparent = None
+        for name, value in scope.get("headers") or []:
+            if name == b"traceparent":
+                traceparent = value.decode("latin-1")
+                break
+        attributes = {"http.request.method": scope.get("method"), "url.path": scope.get("path")}
+        with tracer.span(f"{scope.get('method')} {scope.get('path')}", attributes, traceparent) as span:
+            async def send_with_status(message):
+                if message["type"] == "http.response.start":
+                    span.set_attribute("http.response.status_code", message["status"])
+                await send(message)
+            await self.app(scope, receive, send_with_status)
+
+
+def instrument_tool(name: str, func: Callable[[Any], Awaitable[Any]]) -> Callable[[Any], Awaitable[Any]]:
+    """Wrap a tool handler to record call counts, latency and in-flight calls, and trace it"""
+    labels = (name,)
+    span_name = f"tool {name}"
+    
+    @functools.wraps(func)
+    async def wrapper(input: Any) -> Any:
+        TOOL_IN_FLIGHT.inc(labels)
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            with tracer.span(span_name, {"mcp.tool": name}):
+                result = await call_with_tenant_client(func, input)
+            outcome = "ok"
+            return result
+        finally:
+            TOOL_IN_FLIGHT.dec(labels)
+            TOOL_DURATION.observe(time.perf_counter() - started, labels)
+            TOOL_CALLS.inc((name, outcome))
+    
+    return wrapper
+
+
+def trace_rejected_tool_call(name: Any, error: HTTPException) -> None:
+    """Trace a tool call refused before its handler (which opens the tool span) ran"""
+    with tracer.span(f"tool {name}", {"mcp.tool": str(name)}) as span:
+        span.record_exception(error)
+
+
+class ToolRegistry:
+    """Tools and resources defined in this module, served by the MCP transports (see MCPDispatcher)"""
+    
+    def __init__(self):
+        self.tools: Dict[str, Tuple[type, type, str, Callable[[Any], Awaitable[Any]]]] = {}
+        self.resources: Dict[str, Callable[[], Awaitable[Any]]] = {}
+    
+    def tool(self, name: str, input_model: type, output_model: type, description: str):
+        def decorator(func):
+            handler = instrument_tool(name, func)
+            self.tools[name] = (input_model, output_model, description, handler)
+            return handler
+        return decorator
+    
+    def resource(self, uri: str):
+        def decorator(func):
+            self.resources[uri] = func
+            return func
+        return decorator
+
+
+mcp_server = ToolRegistry()
+
+# Response cache
+
+# Default cache TTLs in seconds for read-only endpoints, matched by longest prefix.
+# Endpoints without an entry (status and ISP metrics) are never cached.
+CACHE_TTLS = {
+    "/v1/hosts": 60.0,
+    "/v1/sites": 300.0,
+    "/v1/devices": 30.0,
+    "/v1/sd-wan/configs": 300.0,
+}
+
+
+class ResponseCache:
+    """Bounded LRU cache of API responses with per-entry TTL and a stale window"""
+    
+    def __init__(self, max_entries: int = 512, stale_ttl: float = 60.0):
+        self.max_entries = max_entries
+        self.stale_ttl = stale_ttl
+        self._entries: "OrderedDict[str, Tuple[Any, float, float]]" = OrderedDict()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+    
+    @staticmethod
+    def make_key(method: str, endpoint: str, params: Optional[Dict] = None) -> str:
+        """Build a cache key from the method, endpoint and normalized params"""
+        normalized = {}
+        for name, value in (params or {}).items():
+            if value is None:
+                continue
+            if isinstance(value, (list, tuple)):
+                value = sorted(value)
+            normalized[name] = value
+        return f"{method.upper()} {endpoint} {json_dumps(normalized, sort_keys=True).decode()}"
+    
+    def get(self, key: str) -> Optional[Tuple[Any, bool]]:
+        """Return (value, is_fresh) for a cached entry, or None on a miss"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, stored_at, ttl = entry
+        age = time.monotonic() - stored_at
+        if age < ttl:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value, True
+        if age < ttl + self.stale_ttl:
+            self._entries.move_to_end(key)
+            self.stale_hits += 1
+            return value, False
+        del self._entries[key]
+        self.misses += 1
+        return None
+    
+    def set(self, key: str, value: Any, ttl: float, age: float = 0.0) -> None:
+        """Store a value (already `age` seconds old), evicting the least recently used entries when full"""
+        self._entries[key] = (value, time.monotonic() - age, ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    def clear(self) -> None:
+        """Drop all cached entries"""
+        self._entries.clear()
+    
+    def stats(self) -> Dict[str, Any]:
+        """Return cache hit/miss counters"""
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "hit_ratio": (self.hits + self.stale_hits) / lookups if lookups else 0.0,
+        }
+
+
+class DiskCache:
+    """SQLite-backed response cache that survives restarts, bounded by total size and entry age"""
+    
+    def __init__(self, path: str, namespace: str = "", max_bytes: int = 64 * 1024 * 1024, max_age: float = 86400.0):
+        self.path = path
+        self.namespace = namespace
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Reads and writes run in worker threads; the lock serializes access to the shared connection
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            if path != ":memory:":
+                # WAL keeps readers working during a write, and a crash mid-write never leaves a torn entry
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+                "stored_at REAL NOT NULL, size INTEGER NOT NULL, used_at REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS response_cache_used_at ON response_cache (used_at)")
+            self._db.execute("DELETE FROM response_cache WHERE stored_at < ?", (time.time() - max_age,))
+            self.size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM response_cache").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+    
+    def get(self, key: str) -> Optional[Tuple[Any, float]]:
+        """Return (value, age in seconds) for a stored entry younger than max_age, or None"""
+        key = self.namespace + key
+        now = time.time()
+        with self._lock, self._db:
+            row = self._db.execute("SELECT value, stored_at FROM response_cache WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] >= self.max_age:
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE response_cache SET used_at = ? WHERE key = ?", (now, key))
+        self.hits += 1
+        return json_loads(row[0]), now - row[1]
+    
+    def set(self, key: str, value: Any) -> None:
+        """Store an entry, evicting the least recently used ones beyond max_bytes"""
+        key = self.namespace + key
+        data = json_dumps(value)
+        now = time.time()
+        # Each write is one transaction, so an entry and the evictions it causes are stored atomically.
+        # IMMEDIATE takes the write lock before the first read, so processes sharing the file queue up
+        # instead of failing when a read transaction tries to become a write transaction.
+        with self._lock, self._db:
+            self._db.execute("BEGIN IMMEDIATE")
+            self._sync_size()
+            old = self._db.execute("SELECT size FROM response_cache WHERE key = ?", (key,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO response_cache (key, value, stored_at, size, used_at) VALUES (?, ?, ?, ?, ?)",
+                (key, data, now, len(data), now),
+            )
+            self.size += len(data) - (old[0] if old else 0)
+            while self.size > self.max_bytes:
+                victim = self._db.execute(
+                    "SELECT key, size FROM response_cache WHERE key != ? ORDER BY used_at LIMIT 1", (key,)
+                ).fetchone()
+                if victim is None:
+                    break
+                self._db.execute("DELETE FROM response_cache WHERE key = ?", (victim[0],))
+                self.size -= victim[1]
+                self.evictions += 1
+        self.writes += 1
+    
+    def _sync_size(self) -> None:
+        """Bring the size counter up to date; only this process writes to a private file"""
+    
+    def clear(self) -> None:
+        """Drop all stored entries"""
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM response_cache")
+            self.size = 0
+    
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+    
+    def stats(self) -> Dict[str, Any]:
+        """Return disk cache counters"""
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM response_cache").fetchone()[0]
+        return {
+            "path": self.path,
+            "entries": entries,
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "evictions": self.evictions,
+        }
+
+
+class _Flight:
+    """An in-flight upstream call and the number of callers waiting on it"""
+    
+    def __init__(self, task: "asyncio.Task"):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Table of in-flight requests so identical concurrent calls share one upstream call"""
+    
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+        self.started = 0
+        self.coalesced = 0
+    
+    async def do(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """Run factory() once per key at a time; concurrent callers share its result or error"""
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight(asyncio.create_task(factory()))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _task: self._forget(key, flight))
+            self.started += 1
+        else:
+            self.coalesced += 1
+        
+        flight.waiters += 1
+        try:
+            # Shield the shared task so one cancelled caller doesn't cancel it for the others
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                # Every caller has gone away, so the upstream call is no longer needed
+                self._forget(key, flight)
+                flight.task.cancel()
+    
+    def _forget(self, key: str, flight: _Flight) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+    
+    def stats(self) -> Dict[str, Any]:
+        """Return single-flight counters"""
+        return {
+            "in_flight": len(self._flights),
+            "started": self.started,
+            "coalesced": self.coalesced,
+        }
+
+
+# Shared state for multi-worker deployments
+# Worker processes (uvicorn --workers, several containers) share the response cache, in-flight
+# fetches and rate limit budgets through one of these backends, selected by UNIFI_SHARED_STATE
+
+
+class SharedStateError(Exception):
+    """A shared state backend could not be reached"""
+
+
+# Errors raised by the cache tier and shared state backends; callers log them and carry on locally
+STATE_ERRORS = (sqlite3.Error, SharedStateError)
+
+
+class SQLiteSharedState(DiskCache):
+    """DiskCache plus fetch leases and token buckets, shared by every process that opens the same file.
+    
+    Suits workers on one host: SQLite's file locking serializes the short write transactions, and WAL
+    keeps cache reads from waiting on them.
+    """
+    
+    backend = "sqlite"
+    
+    def __init__(self, path: str, namespace: str = "", max_bytes: int = 64 * 1024 * 1024, max_age: float = 86400.0):
+        super().__init__(path, namespace, max_bytes, max_age)
+        with self._lock, self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS fetch_leases (key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS rate_buckets (name TEXT PRIMARY KEY, tokens REAL NOT NULL, "
+                "updated REAL NOT NULL, blocked_until REAL NOT NULL)"
+            )
+            self._db.execute("DELETE FROM fetch_leases WHERE expires < ?", (time.time(),))
+    
+    def _sync_size(self) -> None:
+        # Other processes write to the same table
+        self.size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM response_cache").fetchone()[0]
+    
+    def acquire_lease(self, key: str, owner: str, seconds: float) -> bool:
+        """Take the lease on a key unless another owner holds an unexpired one"""
+        key = self.namespace + key
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute("BEGIN IMMEDIATE")
+            row = self._db.execute("SELECT owner, expires FROM fetch_leases WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[0] != owner and row[1] > now:
+                return False
+            self._db.execute("INSERT OR REPLACE INTO fetch_leases (key, owner, expires) VALUES (?, ?, ?)",
+                             (key, owner, now + seconds))
+        return True
+    
+    def release_lease(self, key: str, owner: str) -> None:
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM fetch_leases WHERE key = ? AND owner = ?", (self.namespace + key, owner))
+    
+    def take_token(self, name: str, rate: float, capacity: float) -> Tuple[float, float]:
+        """Take a token from a shared bucket; returns (seconds to wait before retrying or 0.0, tokens left)"""
+        name = self.namespace + name
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute("BEGIN IMMEDIATE")
+            row = self._db.execute(
+                "SELECT tokens, updated, blocked_until FROM rate_buckets WHERE name = ?", (name,)
+            ).fetchone()
+            tokens, updated, blocked_until = row if row is not None else (capacity, now, 0.0)
+            tokens = min(capacity, tokens + max(0.0, now - updated) * rate)
+            if blocked_until > now:
+                wait = blocked_until - now
+            elif tokens >= 1:
+                tokens -= 1
+                wait = 0.0
+            else:
+                wait = (1 - tokens) / rate
+            self._db.execute(
+                "INSERT OR REPLACE INTO rate_buckets (name, tokens, updated, blocked_until) VALUES (?, ?, ?, ?)",
+                (name, tokens, now, blocked_until),
+            )
+        return wait, tokens
+    
+    def pause_bucket(self, name: str, seconds: float) -> None:
+        """Empty a shared bucket and stop it handing out tokens for the given number of seconds"""
+        name = self.namespace + name
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute("BEGIN IMMEDIATE")
+            row = self._db.execute("SELECT blocked_until FROM rate_buckets WHERE name = ?", (name,)).fetchone()
+            blocked_until = max(row[0] if row is not None else 0.0, now + seconds)
+            self._db.execute(
+                "INSERT OR REPLACE INTO rate_buckets (name, tokens, updated, blocked_until) VALUES (?, 0, ?, ?)",
+                (name, now, blocked_until),
+            )
+    
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.backend, **super().stats()}
+
+
+class RedisSharedState:
+    """Shared state kept in a Redis-compatible server, for workers spread over several hosts.
+    
+    Requires the redis package. Cache entries expire after max_age through Redis key expiry; size
+    limits are left to the server's maxmemory policy.
+    """
+    
+    backend = "redis"
+    
+    # Refill and take a token atomically; the server clock keeps all clients on one time base.
+    # Floats are returned as strings because Redis truncates Lua numbers to integers.
+    TAKE_TOKEN = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local rate, capacity = tonumber(ARGV[1]), tonumber(ARGV[2])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated', 'blocked_until')
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+local blocked_until = tonumber(bucket[3]) or 0
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if blocked_until > now then
+    wait = blocked_until - now
+elseif tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now), 'blocked_until', tostring(blocked_until))
+redis.call('EXPIRE', KEYS[1], 3600)
+return {tostring(wait), tostring(tokens)}
+"""
+    PAUSE_BUCKET = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local blocked_until = math.max(tonumber(redis.call('HGET', KEYS[1], 'blocked_until')) or 0, now + tonumber(ARGV[1]))
+redis.call('HSET', KEYS[1], 'tokens', '0', 'updated', tostring(now), 'blocked_until', tostring(blocked_until))
+redis.call('EXPIRE', KEYS[1], 3600)
+"""
+    RELEASE_LEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+    
+    def __init__(self, url: str, namespace: str = "", max_age: float = 86400.0):
+        try:
+            import redis
+        except ImportError:
+            raise ValueError("UNIFI_SHARED_STATE points to Redis but the redis package is not installed (pip install redis)")
+        self.path = url
+        self.namespace = namespace
+        self.max_age = max_age
+        self._errors = redis.RedisError
+        self._redis = redis.Redis.from_url(url)
+        self._take_token = self._redis.register_script(self.TAKE_TOKEN)
+        self._pause_bucket = self._redis.register_script(self.PAUSE_BUCKET)
+        self._release_lease = self._redis.register_script(self.RELEASE_LEASE)
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+    
+    def _key(self, kind: str, key: str) -> str:
+        return f"unifi:{kind}:{self.namespace}{key}"
+    
+    def _call(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        try:
+            return func(*args, **kwargs)
+        except self._errors as e:
+            raise SharedStateError(f"Redis shared state failed: {e}") from e
+    
+    def get(self, key: str) -> Optional[Tuple[Any, float]]:
+        """Return (value, age in seconds) for a stored entry, or None"""
+        data = self._call(self._redis.get, self._key("cache", key))
+        if data is None:
+            self.misses += 1
+            return None
+        stored_at, _, value = data.partition(b" ")
+        self.hits += 1
+        return json_loads(value), max(0.0, time.time() - float(stored_at))
+    
+    def set(self, key: str, value: Any) -> None:
+        data = str(time.time()).encode() + b" " + json_dumps(value)
+        self._call(self._redis.set, self._key("cache", key), data, px=int(self.max_age * 1000))
+        self.writes += 1
+    
+    def acquire_lease(self, key: str, owner: str, seconds: float) -> bool:
+        lease = self._key("lease", key)
+        if self._call(self._redis.set, lease, owner, nx=True, px=max(1, int(seconds * 1000))):
+            return True
+        # Renew a lease this owner already holds, as the SQLite backend does
+        current = self._call(self._redis.get, lease)
+        return current is not None and current.decode() == owner
+    
+    def release_lease(self, key: str, owner: str) -> None:
+        self._call(self._release_lease, keys=[self._key("lease", key)], args=[owner])
+    
+    def take_token(self, name: str, rate: float, capacity: float) -> Tuple[float, float]:
+        wait, tokens = self._call(self._take_token, keys=[self._key("bucket", name)], args=[rate, capacity])
+        return float(wait), float(tokens)
+    
+    def pause_bucket(self, name: str, seconds: float) -> None:
+        self._call(self._pause_bucket, keys=[self._key("bucket", name)], args=[seconds])
+    
+    def clear(self) -> None:
+        for key in self._call(self._redis.scan_iter, match=self._key("cache", "*")):
+            self._call(self._redis.delete, key)
+    
+    def close(self) -> None:
+        self._redis.close()
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.backend,
+            "path": self.path,
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+        }
+
+
+def create_shared_state(url: str, namespace: str = "", max_bytes: int = 64 * 1024 * 1024,
+                        max_age: float = 86400.0) -> Any:
+    """Open the backend named by UNIFI_SHARED_STATE: redis:// or rediss:// URLs, otherwise a SQLite file
+    given as sqlite:///path or a plain path"""
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisSharedState(url, namespace, max_age)
+    path = url[len("sqlite:///"):] if url.startswith("sqlite:///") else url
+    return SQLiteSharedState(path, namespace, max_bytes, max_age)
+
+
+# Rate limiting
+
+# Endpoint families with separate request budgets (requests per minute)
+RATE_LIMIT_FAMILIES = {
+    "/ea/": "ea",
+    "/v1/": "v1",
+}
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header given either in seconds or as an HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """Token bucket that refills at a fixed rate and can be paused after throttling"""
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+    
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    async def acquire(self) -> float:
+        """Wait until a token is available and take it; returns the time spent waiting"""
+        waited = 0.0
+        # The lock keeps waiters in FIFO order
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                delay = self.blocked_until - now
+                if delay <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return waited
+                    delay = (1 - self.tokens) / self.rate
+                await asyncio.sleep(delay)
+                waited += delay
+    
+    def pause(self, seconds: float) -> None:
+        """Stop handing out tokens for the given number of seconds"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+
+class SharedTokenBucket:
+    """TokenBucket whose tokens are kept in shared state, so all workers draw from one budget.
+    
+    Falls back to a local bucket with the same budget while the shared state is unreachable.
+    """
+    
+    def __init__(self, state: Any, name: str, rate: float, capacity: float):
+        self.state = state
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        # Last values seen in the shared bucket, for stats
+        self.tokens = capacity
+        self.blocked_until = 0.0
+        self.fallback = TokenBucket(rate, capacity)
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self) -> float:
+        """Wait until the shared bucket has a token and take it; returns the time spent waiting"""
+        waited = 0.0
+        async with self._lock:
+            while True:
+                try:
+                    delay, self.tokens = await asyncio.to_thread(self.state.take_token, self.name, self.rate, self.capacity)
+                except STATE_ERRORS as e:
+                    logger.warning(f"Shared rate limit unavailable, using the local budget: {e}")
+                    return waited + await self.fallback.acquire()
+                if delay <= 0:
+                    return waited
+                await asyncio.sleep(delay)
+                waited += delay
+    
+    def pause(self, seconds: float) -> None:
+        """Stop every worker taking tokens for the given number of seconds"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+        self.fallback.pause(seconds)
+        task = asyncio.ensure_future(asyncio.to_thread(self.state.pause_bucket, self.name, seconds))
+        task.add_done_callback(self._log_pause_failure)
+    
+    @staticmethod
+    def _log_pause_failure(task: "asyncio.Task") -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Pausing the shared rate limit failed: {task.exception()}")
+
+
+class RateLimiter:
+    """Token buckets with a separate budget per endpoint family, per process or shared between workers"""
+    
+    def __init__(self, budgets: Dict[str, float], shared: Any = None):
+        # budgets maps family name to requests per minute; the bucket allows bursts of up to one minute
+        self.buckets = {
+            family: (
+                SharedTokenBucket(shared, f"bucket {family}", rate=per_minute / 60.0, capacity=max(1.0, per_minute))
+                if shared is not None else
+                TokenBucket(rate=per_minute / 60.0, capacity=max(1.0, per_minute))
+            )
+            for family, per_minute in budgets.items()
+        }
+        self.shared = shared is not None
+        self.throttled = 0
+    
+    @staticmethod
+    def family(endpoint: str) -> Optional[str]:
+        for prefix, family in RATE_LIMIT_FAMILIES.items():
+            if endpoint.startswith(prefix):
+                return family
+        return None
+    
+    async def acquire(self, endpoint: str) -> float:
+        bucket = self.buckets.get(self.family(endpoint))
+        if bucket is None:
+            return 0.0
+        return await bucket.acquire()
+    
+    def on_throttled(self, endpoint: str, retry_after: Optional[float]) -> None:
+        """Pause the endpoint family after a 429 for Retry-After seconds (or one second)"""
+        self.throttled += 1
+        bucket = self.buckets.get(self.family(endpoint))
+        if bucket is not None:
+            bucket.pause(retry_after if retry_after is not None else 1.0)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "throttled": self.throttled,
+            "shared": self.shared,
+            "families": {
+                family: {
+                    "rate_per_minute": bucket.rate * 60.0,
+                    "tokens": round(bucket.tokens, 2),
+                    "paused_for": round(max(0.0, bucket.blocked_until - time.monotonic()), 2),
+                }
+                for family, bucket in self.buckets.items()
+            },
+        }
+
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD concurrency limit: grows additively while healthy, halves on throttling"""
+    
+    def __init__(self, initial: int = 8, minimum: int = 1, maximum: int = 64):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.in_flight = 0
+        self._condition = asyncio.Condition()
+    
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+    
+    def on_success(self) -> None:
+        # Additive increase: roughly +1 after a full window of successful requests
+        self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+    
+    def on_throttled(self) -> None:
+        # Multiplicative decrease
+        self.limit = max(self.minimum, self.limit / 2.0)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "minimum": self.minimum,
+            "maximum": self.maximum,
+        }
+
+
+# Retries and circuit breaking
+
+# Methods that are safe to retry and status codes worth retrying
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS"}
+RETRY_STATUS_CODES = {429, 502, 503, 504}
+
+
+class CircuitBreaker:
+    """Per-host circuit breaker that fails fast while the upstream is down"""
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(self, host: str, failure_threshold: int = 5, recovery_timeout: float = 30.0):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_started = 0.0
+        self.times_opened = 0
+    
+    def allow_request(self) -> bool:
+        """Return whether a request may be sent, letting one probe through once the timeout has passed"""
+        if self.state == self.CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            if now - self.opened_at < self.recovery_timeout:
+                return False
+            self.state = self.HALF_OPEN
+            self.probe_started = now
+            return True
+        # Half open: only one probe at a time, unless the previous probe never reported back
+        if now - self.probe_started >= self.recovery_timeout:
+            self.probe_started = now
+            return True
+        return False
+    
+    def record_success(self) -> None:
+        if self.state != self.CLOSED:
+            logger.info(f"Circuit breaker for {self.host} closed")
+        self.state = self.CLOSED
+        self.failures = 0
+    
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.times_opened += 1
+                logger.warning(f"Circuit breaker for {self.host} opened after {self.failures} failures")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+    
+    def retry_in(self) -> float:
+        return max(0.0, self.opened_at + self.recovery_timeout - time.monotonic())
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "times_opened": self.times_opened,
+            "retry_in": round(self.retry_in(), 2) if self.state == self.OPEN else 0.0,
+        }
+
+
+# Device fan-out helpers
+
+
+def merge_device_groups(host_order: List[str], shard_results: List[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """Merge per-host device groups from several shards, dropping duplicates and keeping host order"""
+    groups: Dict[Any, Dict[str, Any]] = {}
+    seen: Dict[Any, set] = {}
+    for shard in shard_results:
+        for group in shard:
+            host_id = group.get("hostId")
+            if host_id not in groups:
+                groups[host_id] = {**group, "devices": []}
+                seen[host_id] = set()
+            for device in group.get("devices") or []:
+                device_key = device.get("id") or device.get("mac")
+                if device_key is not None and device_key in seen[host_id]:
+                    continue
+                seen[host_id].add(device_key)
+                groups[host_id]["devices"].append(device)
+    position = {host_id: index for index, host_id in enumerate(host_order)}
+    return sorted(groups.values(), key=lambda group: position.get(group.get("hostId"), len(position)))
+
+
+# SD-WAN overview
+
+
+def sdwan_overview_row(config: Dict[str, Any], status: Any) -> Dict[str, Any]:
+    """Compact summary of an SD-WAN config joined with its status response (or the error fetching it)"""
+    row = {"id": config.get("id"), "name": config.get("name"), "type": config.get("type")}
+    if isinstance(status, Exception):
+        row["error"] = str(status.detail) if isinstance(status, HTTPException) else str(status)
+        return row
+    data = (status or {}).get("data") or {}
+    hubs = data.get("hubs") or []
+    spokes = data.get("spokes") or []
+    sites = hubs + spokes
+    row.update({
+        "status": data.get("generateStatus"),
+        "updatedAt": data.get("updatedAt"),
+        "hubs": len(hubs),
+        "spokes": len(spokes),
+        "errors": len(data.get("errors") or []) + sum(len(site.get("errors") or []) for site in sites),
+        "warnings": len(data.get("warnings") or []) + sum(len(site.get("warnings") or []) for site in sites),
+    })
+    return row
+
+
+# Site index
+
+
+class SiteIndex:
+    """Index from site ID to the ID of the host running it, built from list_sites"""
+    
+    def __init__(self, loader: Callable[[], AsyncIterator[Dict[str, Any]]], ttl: float = 300.0,
+                 min_refresh_interval: float = 10.0):
+        self.loader = loader
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.site_hosts: Dict[str, str] = {}
+        self.updated = 0.0
+        self.refreshes = 0
+        self._lock = asyncio.Lock()
+    
+    def update(self, sites: Iterable[Dict[str, Any]]) -> Dict[str, int]:
+        """Apply a full site listing, changing only the entries that differ"""
+        current = {site["siteId"]: site["hostId"] for site in sites if site.get("siteId") and site.get("hostId")}
+        removed = [site_id for site_id in self.site_hosts if site_id not in current]
+        changed = {
+            site_id: host_id for site_id, host_id in current.items()
+            if self.site_hosts.get(site_id) != host_id
+        }
+        for site_id in removed:
+            del self.site_hosts[site_id]
+        self.site_hosts.update(changed)
+        self.updated = time.monotonic()
+        return {"changed": len(changed), "removed": len(removed)}
+    
+    async def refresh(self, force: bool = False) -> None:
+        """Reload the index from the API if it is older than its TTL (or when forced)"""
+        async with self._lock:
+            age = time.monotonic() - self.updated
+            if self.updated and age < (self.min_refresh_interval if force else self.ttl):
+                return
+            sites = [site async for site in self.loader()]
+            diff = self.update(sites)
+            self.refreshes += 1
+            logger.info(f"Refreshed site index: {len(self.site_hosts)} sites, "
+                        f"{diff['changed']} changed, {diff['removed']} removed")
+    
+    async def host_for_site(self, site_id: str) -> Optional[str]:
+        """Return the host ID for a site, refreshing the index when it is stale or the site is unknown"""
+        await self.refresh()
+        if site_id not in self.site_hosts:
+            await self.refresh(force=True)
+        return self.site_hosts.get(site_id)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "sites": len(self.site_hosts),
+            "refreshes": self.refreshes,
+            "age": round(time.monotonic() - self.updated, 2) if self.updated else None,
+        }
+
+
+# Response projection
+
+
+def projection_tree(fields: List[str]) -> Dict[str, Any]:
+    """Turn dotted field paths into a nested tree; None marks a field that is kept whole"""
+    tree: Dict[str, Any] = {}
+    for field in fields:
+        node = tree
+        parts = field.split(".")
+        for part in parts[:-1]:
+            child = node.get(part, {})
+            if child is None:
+                break
+            node = node.setdefault(part, child)
+        else:
+            node[parts[-1]] = None
+    return tree
+
+
+def project(value: Any, tree: Optional[Dict[str, Any]]) -> Any:
+    """Keep only the fields in a projection tree, descending into nested dicts and lists"""
+    if tree is None:
+        return value
+    if isinstance(value, list):
+        return [project(item, tree) for item in value]
+    if not isinstance(value, dict):
+        return value
+    return {key: project(value[key], subtree) for key, subtree in tree.items() if key in value}
+
+
+def shape_response(data: Any, fields: Optional[List[str]] = None, max_items: Optional[int] = None) -> Any:
+    """Apply a field projection and an item cap to an API response or a list of items"""
+    if not fields and max_items is None:
+        return data
+    tree = projection_tree(fields) if fields else None
+    
+    def shape(items: Any) -> Any:
+        if isinstance(items, list):
+            if max_items is not None:
+                items = items[:max_items]
+            return [project(item, tree) for item in items]
+        return project(items, tree)
+    
+    # API responses wrap their payload in "data"; keep the envelope (nextToken etc.) intact
+    if isinstance(data, dict) and "data" in data:
+        return {**data, "data": shape(data["data"])}
+    return shape(data)
+
+
+# Streaming list pages
+
+
+class StreamingPageParser:
+    """Incremental parser for {"data": [...], ...} responses that returns data elements as they complete"""
+    
+    def __init__(self, array_key: str = "data"):
+        self.array_key = array_key
+        self.extras: Dict[str, Any] = {}
+        self.done = False
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._pending: List[str] = []
+        self._pending_length = 0
+        self._retry_at = 0
+        self._state = "start"
+        self._key: Optional[str] = None
+    
+    def _decode(self, buffer: str, position: int, final: bool) -> Optional[Tuple[Any, int]]:
+        """Decode one JSON value, or return None if the buffer doesn't hold all of it yet"""
+        try:
+            value, end = self._decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if final:
+                raise
+            return None
+        # A number at the very end of the buffer may continue in the next chunk
+        if end >= len(buffer) and not final and buffer[position] not in "{[\"":
+            return None
+        return value, end
+    
+    def feed(self, text: str, final: bool = False) -> List[Any]:
+        """Add a chunk of text and return the data elements completed by it"""
+        self._pending.append(text)
+        self._pending_length += len(text)
+        # After an incomplete element, wait until the buffer has doubled before parsing it again
+        if not final and len(self._buffer) + self._pending_length < self._retry_at:
+            return []
+        buffer = self._buffer + "".join(self._pending)
+        self._pending = []
+        self._pending_length = 0
+        
+        items = []
+        position = 0
+        length = len(buffer)
+        while not self.done:
+            while position < length and buffer[position] in " \t\r\n":
+                position += 1
+            if position >= length:
+                break
+            char = buffer[position]
+            state = self._state
+            if state == "start":
+                if char != "{":
+                    raise ValueError("Expected a JSON object")
+                position += 1
+                self._state = "key"
+            elif state in ("key", "next_key"):
+                if char == "}":
+                    position += 1
+                    self.done = True
+                elif char == "," and state == "next_key":
+                    position += 1
+                    self._state = "key"
+                else:
+                    decoded = self._decode(buffer, position, final)
+                    if decoded is None:
+                        break
+                    self._key, position = decoded
+                    self._state = "colon"
+            elif state == "colon":
+                if char != ":":
+                    raise ValueError("Expected ':' in JSON object")
+                position += 1
+                self._state = "value"
+            elif state == "value":
+                if self._key == self.array_key and char == "[":
+                    position += 1
+                    self._state = "item"
+                    continue
+                decoded = self._decode(buffer, position, final)
+                if decoded is None:
+                    break
+                self.extras[self._key], position = decoded
+                self._state = "next_key"
+            elif state in ("item", "next_item"):
+                if char == "]":
+                    position += 1
+                    self._state = "next_key"
+                elif char == "," and state == "next_item":
+                    position += 1
+                    self._state = "item"
+                else:
+                    decoded = self._decode(buffer, position, final)
+                    if decoded is None:
+                        break
+                    item, position = decoded
+                    items.append(item)
+                    self._state = "next_item"
+        
+        self._buffer = buffer[position:]
+        self._retry_at = len(self._buffer) * 2
+        if final and not self.done:
+            raise ValueError("Truncated JSON response")
+        return items
+
+
+class BufferedPage:
+    """A list page that was fetched and parsed as a whole"""
+    
+    def __init__(self, response: Dict[str, Any]):
+        self.response = response
+        self.next_token = response.get("nextToken")
+    
+    async def __aiter__(self):
+        for item in self.response.get("data") or []:
+            yield item
+
+
+class StreamedPage:
+    """A list page whose data elements are yielded while the response is still being received"""
+    
+    def __init__(self, client: "UnifiClient", endpoint: str, params: Optional[Dict] = None):
+        self.client = client
+        self.endpoint = endpoint
+        self.params = params
+        self.parser = StreamingPageParser()
+    
+    @property
+    def next_token(self) -> Optional[str]:
+        """The page's nextToken, available once all items have been consumed"""
+        return self.parser.extras.get("nextToken")
+    
+    def __aiter__(self):
+        return self.client._stream_items(self.endpoint, self.params, self.parser)
+
+
+# Local inventory queries
+
+# Device fields with secondary indexes, and friendlier names accepted in queries
+INDEXED_DEVICE_FIELDS = ("status", "model", "hostId", "siteId", "version")
+QUERY_FIELD_ALIASES = {"host": "hostId", "site": "siteId", "firmware": "version"}
+DEFAULT_DEVICE_FIELDS = ["id", "name", "model", "status", "version", "hostId", "siteId"]
+
+
+def get_path(item: Any, path: str) -> Any:
+    """Look up a dotted path such as "reportedState.hostname" in nested dicts"""
+    for part in path.split("."):
+        if not isinstance(item, dict):
+            return None
+        item = item.get(part)
+    return item
+
+
+def _matches(value: Any, expected: Any) -> bool:
+    """Compare a field value with a filter value, list of values or glob pattern"""
+    if isinstance(expected, list):
+        return any(_matches(value, option) for option in expected)
+    if isinstance(expected, str) and any(char in expected for char in "*?["):
+        return value is not None and fnmatch.fnmatchcase(str(value), expected)
+    return value == expected
+
+
+class RecordIndex:
+    """Flat records with secondary indexes for filter, group-by and count queries"""
+    
+    def __init__(self, records: List[Dict[str, Any]], indexed_fields: Iterable[str] = ()):
+        self.records = records
+        self.indexes: Dict[str, Dict[Any, List[int]]] = {}
+        for field in indexed_fields:
+            index: Dict[Any, List[int]] = {}
+            for position, record in enumerate(records):
+                value = record.get(field)
+                if isinstance(value, (dict, list)):
+                    continue
+                index.setdefault(value, []).append(position)
+            self.indexes[field] = index
+    
+    def _candidates(self, field: str, expected: Any) -> Optional[set]:
+        """Positions matching an indexed filter, or None if the field isn't indexed"""
+        index = self.indexes.get(field)
+        if index is None:
+            return None
+        if isinstance(expected, list) or (isinstance(expected, str) and any(char in expected for char in "*?[")):
+            keys = [key for key in index if _matches(key, expected)]
+        else:
+            keys = [expected] if expected in index else []
+        positions: set = set()
+        for key in keys:
+            positions.update(index[key])
+        return positions
+    
+    def filter(self, filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """Return records matching every filter, using indexes first and scanning only the rest"""
+        filters = {QUERY_FIELD_ALIASES.get(field, field): value for field, value in (filters or {}).items()}
+        positions: Optional[set] = None
+        remaining = {}
+        for field, expected in filters.items():
+            candidates = self._candidates(field, expected)
+            if candidates is None:
+                remaining[field] = expected
+                continue
+            positions = candidates if positions is None else positions & candidates
+        selected = range(len(self.records)) if positions is None else sorted(positions)
+        return [
+            self.records[position] for position in selected
+            if all(_matches(get_path(self.records[position], field), expected) for field, expected in remaining.items())
+        ]
+    
+    @staticmethod
+    def group_counts(records: List[Dict[str, Any]], group_by: str) -> Dict[str, int]:
+        """Count records per value of a field, largest groups first"""
+        field = QUERY_FIELD_ALIASES.get(group_by, group_by)
+        counts: Dict[str, int] = {}
+        for record in records:
+            key = str(get_path(record, field))
+            counts[key] = counts.get(key, 0) + 1
+        return dict(sorted(counts.items(), key=lambda item: (-item[1], item[0])))
+    
+    @staticmethod
+    def project(record: Dict[str, Any], fields: List[str]) -> Dict[str, Any]:
+        return {field: get_path(record, QUERY_FIELD_ALIASES.get(field, field)) for field in fields}
+
+
+# Inventory snapshot
+
+
+class Inventory:
+    """In-memory snapshot of hosts, sites, devices and SD-WAN configs kept up to date in the background"""
+    
+    def __init__(self, client: "UnifiClient", interval: float = 60.0, full_interval: float = 900.0):
+        self.client = client
+        self.interval = interval
+        self.full_interval = full_interval
+        self.hosts: Dict[str, Dict[str, Any]] = {}
+        self.sites: Dict[str, Dict[str, Any]] = {}
+        self.device_groups: Dict[str, Dict[str, Any]] = {}
+        self.devices: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self.sdwan_configs: Dict[str, Dict[str, Any]] = {}
+        self.ready = False
+        self.last_full_load = 0.0
+        # When the snapshot was last brought up to date (full load or device sync)
+        self.updated_at = 0.0
+        self.last_device_sync: Optional[str] = None
+        self.full_loads = 0
+        self.incremental_syncs = 0
+        self.errors = 0
+        self._views: Dict[str, Any] = {}
+        self._task: Optional[asyncio.Task] = None
+        # One-off snapshot for local queries while this inventory isn't being kept up to date
+        self._query_snapshot: Optional["Inventory"] = None
+    
+    def start(self) -> None:
+        """Start the background sync task"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self) -> None:
+        """Stop the background sync task"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def _run(self) -> None:
+        while True:
+            try:
+                if not self.ready or time.monotonic() - self.last_full_load >= self.full_interval:
+                    await self.full_load()
+                else:
+                    await self.sync_devices()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errors += 1
+                logger.warning(f"Inventory sync failed: {e}")
+            await asyncio.sleep(self.interval)
+    
+    @staticmethod
+    def _now() -> str:
+        return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    
+    async def full_load(self) -> None:
+        """Load the complete inventory from the API"""
+        started = self._now()
+        hosts, sites, groups, configs = await asyncio.gather(
+            self._collect(self.client.iter_hosts()),
+            self._collect(self.client.iter_sites()),
+            self._collect(self.client.iter_devices()),
+            self._collect(self.client.iter_sdwan_configs()),
+        )
+        self.hosts = {host["id"]: host for host in hosts if host.get("id")}
+        self.sites = {site["siteId"]: site for site in sites if site.get("siteId")}
+        self.sdwan_configs = {config["id"]: config for config in configs if config.get("id")}
+        self.device_groups = {}
+        self.devices = {}
+        self._merge_device_groups(groups)
+        self.client.site_index.update(sites)
+        self.last_device_sync = started
+        self.last_full_load = self.updated_at = time.monotonic()
+        self.full_loads += 1
+        self.ready = True
+        self._views.clear()
+        logger.info(f"Loaded inventory: {len(self.hosts)} hosts, {len(self.sites)} sites, "
+                    f"{self.device_count()} devices, {len(self.sdwan_configs)} SD-WAN configs")
+    
+    async def sync_devices(self) -> None:
+        """Pull only devices changed since the last sync, using the devices time parameter"""
+        started = self._now()
+        groups = await self._collect(self.client.iter_devices(time=self.last_device_sync))
+        self._merge_device_groups(groups)
+        self.last_device_sync = started
+        self.updated_at = time.monotonic()
+        self.incremental_syncs += 1
+        if groups:
+            self._views.clear()
+            logger.info(f"Synced device changes for {len(groups)} hosts")
+    
+    # Intervals a snapshot kept in sync may go without an update (slow or failed syncs) before it is no longer served
+    MAX_SYNC_LAG = 3
+    
+    def is_fresh(self) -> bool:
+        """Whether the snapshot may be served: loaded, and updated within a few intervals while kept in sync
+        (within one otherwise)"""
+        running = self._task is not None and not self._task.done()
+        max_age = self.interval * (self.MAX_SYNC_LAG if running else 1)
+        return self.ready and time.monotonic() - self.updated_at < max_age
+    
+    async def queryable(self) -> "Inventory":
+        """Inventory to run a local query on: this one while it is fresh, otherwise a one-off snapshot.
+        
+        The one-off snapshot is never served by the list and get tools, and is reused for one interval;
+        concurrent first queries share a single load.
+        """
+        if self.is_fresh():
+            return self
+        snapshot = self._query_snapshot
+        if snapshot is None or not snapshot.is_fresh():
+            snapshot = await self.client.single_flight.do("inventory query snapshot", self._load_query_snapshot)
+        return snapshot
+    
+    async def _load_query_snapshot(self) -> "Inventory":
+        snapshot = Inventory(self.client, self.interval, self.full_interval)
+        await snapshot.full_load()
+        self._query_snapshot = snapshot
+        return snapshot
+    
+    @staticmethod
+    async def _collect(iterator: AsyncIterator[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return [item async for item in iterator]
+    
+    def _merge_device_groups(self, groups: List[Dict[str, Any]]) -> None:
+        for group in groups:
+            host_id = group.get("hostId")
+            self.device_groups[host_id] = {key: value for key, value in group.items() if key != "devices"}
+            devices = self.devices.setdefault(host_id, {})
+            for device in group.get("devices") or []:
+                devices[device.get("id") or device.get("mac")] = device
+    
+    def device_count(self) -> int:
+        return sum(len(devices) for devices in self.devices.values())
+    
+    def device_index(self) -> RecordIndex:
+        """Flattened device records (with host and site IDs) indexed for local queries"""
+        index = self._views.get("device_index")
+        if index is None:
+            host_sites: Dict[str, List[str]] = {}
+            for site_id, site in self.sites.items():
+                host_sites.setdefault(site.get("hostId"), []).append(site_id)
+            records = []
+            for host_id, devices in self.devices.items():
+                group = self.device_groups.get(host_id, {})
+                sites = host_sites.get(host_id, [])
+                for device in devices.values():
+                    records.append({
+                        **device,
+                        "hostId": host_id,
+                        "hostName": group.get("hostName"),
+                        # Devices are reported per host; the site is only known when the host runs a single site
+                        "siteId": device.get("siteId") or (sites[0] if len(sites) == 1 else None),
+                    })
+            index = self._views["device_index"] = RecordIndex(records, INDEXED_DEVICE_FIELDS)
+        return index
+    
+    def host_index(self) -> RecordIndex:
+        """Host records for local queries"""
+        index = self._views.get("host_index")
+        if index is None:
+            index = self._views["host_index"] = RecordIndex(list(self.hosts.values()), ("type",))
+        return index
+    
+    def _view(self, name: str, build: Callable[[], List[Dict[str, Any]]]) -> Dict[str, Any]:
+        # Responses are built once per sync and then served as-is
+        view = self._views.get(name)
+        if view is None:
+            view = self._views[name] = {"data": build(), "nextToken": None}
+        return view
+    
+    def _device_group(self, host_id: str) -> Dict[str, Any]:
+        return {**self.device_groups[host_id], "devices": list(self.devices.get(host_id, {}).values())}
+    
+    # Snapshot reads return None until the first full load has completed, and once the snapshot
+    # is no longer kept up to date, so tools fall back to the API
+    def list_hosts(self) -> Optional[Dict[str, Any]]:
+        return self._view("hosts", lambda: list(self.hosts.values())) if self.is_fresh() else None
+    
+    def get_host(self, host_id: str) -> Optional[Dict[str, Any]]:
+        if not self.is_fresh() or host_id not in self.hosts:
+            return None
+        return {"data": self.hosts[host_id]}
+    
+    def list_sites(self) -> Optional[Dict[str, Any]]:
+        return self._view("sites", lambda: list(self.sites.values())) if self.is_fresh() else None
+    
+    def list_devices(self, host_ids: Optional[List[str]] = None) -> Optional[Dict[str, Any]]:
+        if not self.is_fresh():
+            return None
+        if host_ids:
+            # Hosts missing from the snapshot may be new since the last sync; the API has the answer
+            if any(host_id not in self.device_groups for host_id in host_ids):
+                return None
+            return {"data": [self._device_group(host_id) for host_id in host_ids], "nextToken": None}
+        return self._view("devices", lambda: [self._device_group(host_id) for host_id in self.device_groups])
+    
+    def list_sdwan_configs(self) -> Optional[Dict[str, Any]]:
+        return self._view("sdwan_configs", lambda: list(self.sdwan_configs.values())) if self.is_fresh() else None
+    
+    def get_sdwan_config(self, config_id: str) -> Optional[Dict[str, Any]]:
+        if not self.is_fresh() or config_id not in self.sdwan_configs:
+            return None
+        return {"data": self.sdwan_configs[config_id]}
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self._task is not None and not self._task.done(),
+            "ready": self.ready,
+            "fresh": self.is_fresh(),
+            "hosts": len(self.hosts),
+            "sites": len(self.sites),
+            "devices": self.device_count(),
+            "sdwan_configs": len(self.sdwan_configs),
+            "full_loads": self.full_loads,
+            "incremental_syncs": self.incremental_syncs,
+            "errors": self.errors,
+            "last_device_sync": self.last_device_sync,
+        }
+
+
+# ISP metrics store
+
+# Period length and how far back the API keeps data, in seconds, per metric type
+METRIC_STEPS = {"5m": 300, "1h": 3600}
+METRIC_RETENTION = {"5m": 24 * 3600, "1h": 30 * 24 * 3600}
+# Window used when neither timestamps nor a duration are given
+DEFAULT_METRIC_DURATIONS = {"5m": "24h", "1h": "7d"}
+# Numeric WAN fields of a period stored as columns, and how they are combined when downsampling
+METRIC_COLUMNS = {
+    "avgLatency": "avg_latency",
+    "maxLatency": "max_latency",
+    "packetLoss": "packet_loss",
+    "download_kbps": "download_kbps",
+    "upload_kbps": "upload_kbps",
+    "uptime": "uptime",
+    "downtime": "downtime",
+}
+METRIC_DOWNSAMPLE = {"maxLatency": "MAX", "downtime": "SUM"}
+
+
+def parse_timestamp(value: str) -> int:
+    """Parse an RFC3339 timestamp into epoch seconds"""
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp())
+
+
+def format_timestamp(epoch: float) -> str:
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def parse_duration(value: str) -> int:
+    """Parse a duration such as '30m', '24h' or '7d' into seconds"""
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+    value = value.strip().lower()
+    if len(value) < 2 or value[-1] not in units or not value[:-1].isdigit():
+        raise ValueError(f"Invalid duration: {value}")
+    return int(value[:-1]) * units[value[-1]]
+
+
+def metric_window(metric_type: str, begin_timestamp: Optional[str] = None, end_timestamp: Optional[str] = None,
+                  duration: Optional[str] = None, now: Optional[float] = None) -> Tuple[int, int]:
+    """Resolve request parameters into a half-open [begin, end) window aligned to the metric period"""
+    step = METRIC_STEPS[metric_type]
+    now = time.time() if now is None else now
+    end = parse_timestamp(end_timestamp) if end_timestamp else int(now)
+    if begin_timestamp:
+        begin = parse_timestamp(begin_timestamp)
+    else:
+        begin = end - parse_duration(duration or DEFAULT_METRIC_DURATIONS[metric_type])
+    return begin - begin % step, end - end % step + step
+
+
+def merge_ranges(ranges: Iterable[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """Merge overlapping or adjacent half-open ranges"""
+    merged: List[Tuple[int, int]] = []
+    for begin, end in sorted(ranges):
+        if merged and begin <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        elif begin < end:
+            merged.append((begin, end))
+    return merged
+
+
+def missing_ranges(covered: List[Tuple[int, int]], begin: int, end: int) -> List[Tuple[int, int]]:
+    """Sub-ranges of [begin, end) not contained in the (merged) covered ranges"""
+    gaps = []
+    position = begin
+    for covered_begin, covered_end in covered:
+        if covered_end <= position:
+            continue
+        if covered_begin >= end:
+            break
+        if covered_begin > position:
+            gaps.append((position, covered_begin))
+        position = max(position, covered_end)
+    if position < end:
+        gaps.append((position, end))
+    return gaps
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Percentile of sorted values with linear interpolation between closest ranks"""
+    if not values:
+        return None
+    rank = (len(values) - 1) * q / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+
+# Metrics where larger values are worse; for the others (uptime, throughput) smaller values are worse
+HIGHER_IS_WORSE = {"avgLatency", "maxLatency", "packetLoss", "downtime"}
+DEFAULT_ANALYSIS_METRICS = ["avgLatency", "packetLoss", "uptime", "download_kbps", "upload_kbps"]
+# Sites loaded into memory at once by MetricsStore.analyze, and how many loaded chunks are kept
+ANALYSIS_CHUNK_SITES = 256
+ANALYSIS_CACHED_ARRAYS = 8
+
+
+def sorted_percentiles(ordered: "np.ndarray", counts: "np.ndarray", percentiles: List[float]) -> "np.ndarray":
+    """Percentiles along axis 1 of values sorted with NaN last, given the non-NaN count of each slice.
+    
+    Same linear interpolation as numpy.nanpercentile, but by indexing instead of a loop over slices.
+    Returns an array of shape (len(percentiles), sites, metrics).
+    """
+    _numpy()
+    last = np.maximum(counts - 1, 0)
+    ranks = last[None] * (np.asarray(percentiles, dtype=np.float64) / 100)[:, None, None]
+    lower = np.floor(ranks).astype(np.intp)
+    upper = np.minimum(lower + 1, last[None])
+    
+    def take(index):
+        return np.stack([np.take_along_axis(ordered, i[:, None, :], axis=1)[:, 0, :] for i in index])
+    
+    low = take(lower)
+    result = low + (take(upper) - low) * (ranks - lower)
+    return np.where(counts[None] > 0, result, np.nan)
+
+
+def analyze_metric_arrays(values: "np.ndarray", worse_high: "np.ndarray", percentiles: List[float],
+                          window: int, threshold: float) -> Dict[str, "np.ndarray"]:
+    """Per-site statistics of a (sites, periods, metrics) array with NaN for missing periods.
+    
+    Rolling windows use cumulative sums, anomaly scores are robust z-scores (distance from the
+    median in units of the scaled median absolute deviation). Everything is computed along the
+    period axis without Python-level loops.
+    """
+    _numpy()
+    sites, periods, _ = values.shape
+    valid = ~np.isnan(values)
+    counts = valid.sum(axis=1)
+    ordered = np.sort(values, axis=1)
+    with warnings.catch_warnings(), np.errstate(invalid="ignore", divide="ignore"):
+        warnings.simplefilter("ignore", RuntimeWarning)
+        result = {
+            "count": counts,
+            "avg": np.nanmean(values, axis=1, dtype=np.float64),
+            "min": np.nanmin(values, axis=1),
+            "max": np.nanmax(values, axis=1),
+            "std": np.nanstd(values, axis=1, dtype=np.float64),
+            "percentiles": sorted_percentiles(ordered, counts, percentiles),
+        }
+        
+        # Worst rolling-window average, signed so that larger is always worse
+        window = max(1, min(window, periods))
+        zeros = np.zeros((sites, 1, values.shape[2]))
+        sums = np.concatenate([zeros, np.cumsum(np.where(valid, values, 0.0), axis=1, dtype=np.float64)], axis=1)
+        running = np.concatenate([zeros, np.cumsum(valid, axis=1)], axis=1)
+        rolling = (sums[:, window:] - sums[:, :-window]) / (running[:, window:] - running[:, :-window])
+        signed = np.where(worse_high, rolling, -rolling)
+        worst_at = np.where(np.isnan(signed), -np.inf, signed).argmax(axis=1)
+        result["worst_window"] = np.take_along_axis(rolling, worst_at[:, None, :], axis=1)[:, 0, :]
+        result["worst_window_at"] = worst_at
+        
+        median = sorted_percentiles(ordered, counts, [50])[0][:, None, :]
+        deviations = np.sort(np.abs(values - median), axis=1)
+        scale = 1.4826 * sorted_percentiles(deviations, counts, [50])[0][:, None, :]
+        # Fall back to the standard deviation when more than half of the values are identical
+        scale = np.where(scale > 0, scale, result["std"][:, None, :])
+        scores = np.abs(values - median) / scale
+        scores = np.where(np.isfinite(scores), scores, 0.0)
+    result["anomalies"] = (scores > threshold).sum(axis=1)
+    result["max_score"] = scores.max(axis=1)
+    result["max_score_at"] = scores.argmax(axis=1)
+    return result
+
+
+def _number(value: Any) -> Optional[float]:
+    """JSON-friendly float, with None for NaN"""
+    value = float(value)
+    return None if value != value else round(value, 3)
+
+
+class MetricsStore:
+    """SQLite store of ISP metric periods per site, remembering which time ranges were fetched"""
+    
+    def __init__(self, path: str = ":memory:"):
+        self.path = path
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Queries run in worker threads; the lock serializes access to the shared connection
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        columns = ", ".join(f"{column} REAL" for column in METRIC_COLUMNS.values())
+        with self._lock, self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS isp_metric_periods ("
+                "metric_type TEXT NOT NULL, site_id TEXT NOT NULL, ts INTEGER NOT NULL, host_id TEXT, "
+                f"{columns}, period TEXT NOT NULL, PRIMARY KEY (metric_type, site_id, ts)) WITHOUT ROWID"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS isp_metric_periods_ts ON isp_metric_periods (metric_type, ts)")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS isp_metric_coverage (metric_type TEXT NOT NULL, begin INTEGER NOT NULL, end INTEGER NOT NULL)"
+            )
+        self.periods_added = 0
+        self.queries = 0
+        # Arrays loaded for analysis, reused until periods are added or changed
+        self._arrays: "OrderedDict[Tuple, np.ndarray]" = OrderedDict()
+    
+    def add(self, metric_type: str, response: Dict[str, Any]) -> int:
+        """Store the periods of an /ea/isp-metrics response; refetched periods overwrite the stored ones"""
+        rows = []
+        for series in response.get("data") or []:
+            site_id = series.get("siteId")
+            if not site_id:
+                continue
+            for period in series.get("periods") or []:
+                if not period.get("metricTime"):
+                    continue
+                wan = (period.get("data") or {}).get("wan") or {}
+                rows.append((
+                    metric_type, site_id, parse_timestamp(period["metricTime"]), series.get("hostId"),
+                    *(wan.get(field) for field in METRIC_COLUMNS), json_dumps(period).decode(),
+                ))
+        placeholders = ", ".join("?" * (len(METRIC_COLUMNS) + 5))
+        updated = ", ".join(f"{column} = excluded.{column}" for column in ("host_id", *METRIC_COLUMNS.values(), "period"))
+        with self._lock, self._db:
+            before = self._db.total_changes
+            # Recent periods are still settling upstream; only rows whose content changed count as written
+            self._db.executemany(
+                f"INSERT INTO isp_metric_periods (metric_type, site_id, ts, host_id, "
+                f"{', '.join(METRIC_COLUMNS.values())}, period) VALUES ({placeholders}) "
+                f"ON CONFLICT (metric_type, site_id, ts) DO UPDATE SET {updated} "
+                f"WHERE period IS NOT excluded.period",
+                rows,
+            )
+            added = self._db.total_changes - before
+        self.periods_added += added
+        if added:
+            self._arrays.clear()
+        return added
+    
+    def coverage(self, metric_type: str) -> List[Tuple[int, int]]:
+        """Merged time ranges already fetched for a metric type"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT begin, end FROM isp_metric_coverage WHERE metric_type = ?", (metric_type,)
+            ).fetchall()
+        return merge_ranges(rows)
+    
+    def mark_covered(self, metric_type: str, begin: int, end: int) -> None:
+        if begin >= end:
+            return
+        merged = merge_ranges(self.coverage(metric_type) + [(begin, end)])
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM isp_metric_coverage WHERE metric_type = ?", (metric_type,))
+            self._db.executemany(
+                "INSERT INTO isp_metric_coverage (metric_type, begin, end) VALUES (?, ?, ?)",
+                [(metric_type, b, e) for b, e in merged],
+            )
+    
+    def missing(self, metric_type: str, begin: int, end: int) -> List[Tuple[int, int]]:
+        """Parts of [begin, end) that still have to be fetched from the API"""
+        return missing_ranges(self.coverage(metric_type), begin, end)
+    
+    def _select(self, columns: str, metric_type: str, begin: int, end: int,
+                site_ids: Optional[List[str]], suffix: str, params: Tuple = ()) -> List[Tuple]:
+        sql = f"SELECT {columns} FROM isp_metric_periods WHERE metric_type = ? AND ts >= ? AND ts < ?"
+        args: List[Any] = [*params, metric_type, begin, end]
+        if site_ids:
+            sql += f" AND site_id IN ({', '.join('?' * len(site_ids))})"
+            args.extend(site_ids)
+        self.queries += 1
+        with self._lock:
+            return self._db.execute(f"{sql} {suffix}", args).fetchall()
+    
+    @staticmethod
+    def _metric_fields(metrics: Optional[List[str]]) -> List[str]:
+        metrics = list(metrics or METRIC_COLUMNS)
+        unknown = [metric for metric in metrics if metric not in METRIC_COLUMNS]
+        if unknown:
+            raise ValueError(f"Unknown metrics: {', '.join(unknown)}; expected {', '.join(METRIC_COLUMNS)}")
+        return metrics
+    
+    def query(self, metric_type: str, begin: int, end: int, site_ids: Optional[List[str]] = None) -> Dict[str, Any]:
+        """Stored periods in [begin, end), shaped like an /ea/isp-metrics response"""
+        rows = self._select("site_id, host_id, period", metric_type, begin, end, site_ids, "ORDER BY site_id, ts")
+        series: Dict[str, Dict[str, Any]] = {}
+        for site_id, host_id, period in rows:
+            entry = series.get(site_id)
+            if entry is None:
+                entry = series[site_id] = {"metricType": metric_type, "siteId": site_id, "hostId": host_id, "periods": []}
+            entry["periods"].append(json_loads(period))
+        return {"data": list(series.values())}
+    
+    def summarize(self, metric_type: str, begin: int, end: int, site_ids: Optional[List[str]] = None,
+                  metrics: Optional[List[str]] = None, percentiles: Iterable[float] = (50, 95, 99)) -> Dict[str, Any]:
+        """Count, min, max, average and percentiles of each metric per site"""
+        metrics = self._metric_fields(metrics)
+        percentiles = list(percentiles)
+        columns = ", ".join(METRIC_COLUMNS[metric] for metric in metrics)
+        rows = self._select(f"site_id, {columns}", metric_type, begin, end, site_ids, "ORDER BY site_id")
+        values: Dict[str, List[List[float]]] = {}
+        for row in rows:
+            site_values = values.get(row[0])
+            if site_values is None:
+                site_values = values[row[0]] = [[] for _ in metrics]
+            for position, value in enumerate(row[1:]):
+                if value is not None:
+                    site_values[position].append(value)
+        summary = {}
+        for site_id, site_values in values.items():
+            site_summary = {}
+            for metric, series in zip(metrics, site_values):
+                series.sort()
+                stats: Dict[str, Any] = {
+                    "count": len(series),
+                    "min": series[0] if series else None,
+                    "max": series[-1] if series else None,
+                    "avg": sum(series) / len(series) if series else None,
+                }
+                for q in percentiles:
+                    stats[f"p{q:g}"] = percentile(series, q)
+                site_summary[metric] = stats
+            summary[site_id] = site_summary
+        return summary
+    
+    def downsample(self, metric_type: str, begin: int, end: int, bucket: int, site_ids: Optional[List[str]] = None,
+                   metrics: Optional[List[str]] = None) -> Dict[str, List[Dict[str, Any]]]:
+        """Metrics per site combined into buckets of `bucket` seconds (average, or max/sum where that fits)"""
+        metrics = self._metric_fields(metrics)
+        columns = ", ".join(f"{METRIC_DOWNSAMPLE.get(metric, 'AVG')}({METRIC_COLUMNS[metric]})" for metric in metrics)
+        rows = self._select(
+            f"site_id, (ts / ?) * ? AS bucket, COUNT(*), {columns}", metric_type, begin, end, site_ids,
+            "GROUP BY site_id, bucket ORDER BY site_id, bucket", (bucket, bucket),
+        )
+        series: Dict[str, List[Dict[str, Any]]] = {}
+        for site_id, bucket_start, count, *aggregates in rows:
+            series.setdefault(site_id, []).append({
+                "metricTime": format_timestamp(bucket_start),
+                "count": count,
+                **dict(zip(metrics, aggregates)),
+            })
+        return series
+    
+    def site_ids(self, metric_type: str, begin: int, end: int) -> List[str]:
+        """Sites with stored periods in [begin, end)"""
+        return [row[0] for row in self._select("DISTINCT site_id", metric_type, begin, end, None, "ORDER BY site_id")]
+    
+    def load_array(self, metric_type: str, begin: int, end: int, site_ids: List[str],
+                   metrics: List[str]) -> "np.ndarray":
+        """Stored metrics as a (sites, periods, metrics) array, NaN where a period is missing"""
+        _numpy()
+        key = (metric_type, begin, end, tuple(site_ids), tuple(metrics))
+        if key in self._arrays:
+            self._arrays.move_to_end(key)
+            return self._arrays[key]
+        step = METRIC_STEPS[metric_type]
+        values = np.full((len(site_ids), (end - begin) // step, len(metrics)), np.nan, dtype=np.float32)
+        if not site_ids:
+            return values
+        # Map site IDs to array rows inside SQLite so every selected column is numeric
+        chunk = ", ".join("(?, ?)" for _ in site_ids)
+        params = [value for position, site_id in enumerate(site_ids) for value in (site_id, position)]
+        columns = ", ".join(f"p.{METRIC_COLUMNS[metric]}" for metric in metrics)
+        sql = (
+            f"WITH chunk(site_id, row) AS (VALUES {chunk}) "
+            f"SELECT chunk.row, (p.ts - ?) / ?, {columns} FROM isp_metric_periods p "
+            "JOIN chunk ON p.site_id = chunk.site_id WHERE p.metric_type = ? AND p.ts >= ? AND p.ts < ?"
+        )
+        self.queries += 1
+        with self._lock:
+            rows = self._db.execute(sql, [*params, begin, step, metric_type, begin, end]).fetchall()
+        if rows:
+            # None (NULL) becomes NaN
+            table = np.array(rows, dtype=np.float64)
+            values[table[:, 0].astype(np.intp), table[:, 1].astype(np.intp)] = table[:, 2:]
+        self._arrays[key] = values
+        while len(self._arrays) > ANALYSIS_CACHED_ARRAYS:
+            self._arrays.popitem(last=False)
+        return values
+    
+    def analyze(self, metric_type: str, begin: int, end: int, site_ids: Optional[List[str]] = None,
+                metrics: Optional[List[str]] = None, percentiles: Iterable[float] = (50, 95, 99),
+                window: int = 12, threshold: float = 3.5, sort_by: str = "anomaly_score",
+                top: int = 20) -> Dict[str, Any]:
+        """Vectorized per-site aggregates, rolling windows and anomaly scores, reduced to a compact summary"""
+        if not NUMPY_AVAILABLE:
+            raise RuntimeError("ISP metrics analysis requires numpy (pip install numpy)")
+        _numpy()
+        metrics = self._metric_fields(metrics or DEFAULT_ANALYSIS_METRICS)
+        if sort_by != "anomaly_score" and sort_by not in metrics:
+            raise ValueError(f"sort_by must be 'anomaly_score' or one of the analyzed metrics: {', '.join(metrics)}")
+        percentiles = list(percentiles)
+        step = METRIC_STEPS[metric_type]
+        worse_high = np.array([metric in HIGHER_IS_WORSE for metric in metrics])
+        stored_sites = self.site_ids(metric_type, begin, end)
+        if site_ids:
+            stored = set(stored_sites)
+            sites = [site_id for site_id in site_ids if site_id in stored]
+        else:
+            sites = stored_sites
+        
+        # Sites are processed in chunks to bound memory; only the per-site reductions are kept
+        chunks = []
+        for position in range(0, len(sites), ANALYSIS_CHUNK_SITES):
+            values = self.load_array(metric_type, begin, end, sites[position:position + ANALYSIS_CHUNK_SITES], metrics)
+            chunks.append(analyze_metric_arrays(values, worse_high, percentiles, window, threshold))
+        result = {
+            "metricType": metric_type,
+            "beginTimestamp": format_timestamp(begin),
+            "endTimestamp": format_timestamp(end),
+            "sites_analyzed": len(sites),
+            "periods": (end - begin) // step,
+            "fleet": {},
+            "sites": [],
+        }
+        if not chunks:
+            return result
+        stats = {
+            key: np.concatenate([chunk[key] for chunk in chunks], axis=1 if key == "percentiles" else 0)
+            for key in chunks[0]
+        }
+        
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            site_scores = np.nan_to_num(stats["max_score"].max(axis=1))
+            if sort_by == "anomaly_score":
+                order = np.argsort(-site_scores, kind="stable")
+            else:
+                column = metrics.index(sort_by)
+                averages = stats["avg"][:, column]
+                key = averages if sort_by in HIGHER_IS_WORSE else -averages
+                order = np.argsort(-np.nan_to_num(key, nan=-np.inf), kind="stable")
+            # Fleet view: distribution of the per-site averages
+            fleet_percentiles = np.nanpercentile(stats["avg"], percentiles, axis=0)
+            fleet = {
+                metric: {
+                    "avg": _number(np.nanmean(stats["avg"][:, column])),
+                    "min": _number(np.nanmin(stats["min"][:, column])),
+                    "max": _number(np.nanmax(stats["max"][:, column])),
+                    **{f"site_avg_p{q:g}": _number(fleet_percentiles[i, column]) for i, q in enumerate(percentiles)},
+                    "anomalies": int(stats["anomalies"][:, column].sum()),
+                    "sites_with_anomalies": int((stats["anomalies"][:, column] > 0).sum()),
+                }
+                for column, metric in enumerate(metrics)
+            }
+        
+        for row in order[:top]:
+            result["sites"].append({
+                "siteId": sites[row],
+                "anomaly_score": _number(site_scores[row]),
+                "metrics": {
+                    metric: {
+                        "count": int(stats["count"][row, column]),
+                        "avg": _number(stats["avg"][row, column]),
+                        "min": _number(stats["min"][row, column]),
+                        "max": _number(stats["max"][row, column]),
+                        "std": _number(stats["std"][row, column]),
+                        **{f"p{q:g}": _number(stats["percentiles"][i, row, column]) for i, q in enumerate(percentiles)},
+                        "worst_window_avg": _number(stats["worst_window"][row, column]),
+                        "worst_window_start": format_timestamp(begin + int(stats["worst_window_at"][row, column]) * step),
+                        "anomalies": int(stats["anomalies"][row, column]),
+                        "max_anomaly_score": _number(stats["max_score"][row, column]),
+                        "max_anomaly_at": format_timestamp(begin + int(stats["max_score_at"][row, column]) * step),
+                    }
+                    for column, metric in enumerate(metrics)
+                },
+            })
+        result["fleet"] = fleet
+        return result
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counts = dict(self._db.execute(
+                "SELECT metric_type, COUNT(*) FROM isp_metric_periods GROUP BY metric_type"
+            ).fetchall())
+        return {
+            "path": self.path,
+            "periods": counts,
+            "coverage": {
+                metric_type: [(format_timestamp(b), format_timestamp(e)) for b, e in self.coverage(metric_type)]
+                for metric_type in METRIC_STEPS
+            },
+            "periods_added": self.periods_added,
+            "queries": self.queries,
+        }
 
-# Initialize MCP Server
-mcp_server = MCPServer(
-    name="unifi",
-    description="MCP Server for Unifi Site Manager API integration",
-    app=app,
-)
 
 # Unifi API client
 
@@ -50,8 +2342,9 @@ mcp_server = MCPServer(
 class UnifiClient:
     """Client for interacting with the Unifi Site Manager API"""
     
-    def __init__(self):
-        self.api_key = os.environ.get("UNIFI_API_KEY")
+    def __init__(self, api_key: Optional[str] = None):
+        # An explicit key is a tenant's (see ClientRegistry); UNIFI_API_KEY is the default account
+        self.api_key = api_key or os.environ.get("UNIFI_API_KEY")
         if not self.api_key:
             logger.error("UNIFI_API_KEY environment variable not set")
             raise ValueError("UNIFI_API_KEY environment variable not set")
@@ -64,40 +2357,446 @@ class UnifiClient:
             "Accept": "application/json",
             "X-API-Key": self.api_key
         }
+        
+        # Connection pool settings for the shared HTTP client
+        self.limits = httpx.Limits(
+            max_connections=int(os.environ.get("UNIFI_MAX_CONNECTIONS", "20")),
+            max_keepalive_connections=int(os.environ.get("UNIFI_MAX_KEEPALIVE_CONNECTIONS", "10")),
+            keepalive_expiry=float(os.environ.get("UNIFI_KEEPALIVE_EXPIRY", "30.0")),
+        )
+        self.timeout = httpx.Timeout(
+            connect=float(os.environ.get("UNIFI_CONNECT_TIMEOUT", "5.0")),
+            read=float(os.environ.get("UNIFI_READ_TIMEOUT", "30.0")),
+            write=float(os.environ.get("UNIFI_WRITE_TIMEOUT", "30.0")),
+            pool=float(os.environ.get("UNIFI_POOL_TIMEOUT", "5.0")),
+        )
+        self.http2 = os.environ.get("UNIFI_HTTP2", "false").lower() in ("1", "true", "yes")
+        if self.http2 and not HTTP2_AVAILABLE:
+            logger.warning("UNIFI_HTTP2 is enabled but the h2 package is not installed, falling back to HTTP/1.1")
+            self.http2 = False
+        self._http_client: Optional[httpx.AsyncClient] = None
+        
+        # Upper bound on pages followed by the iter_* pagination helpers
+        self.max_pages = int(os.environ.get("UNIFI_MAX_PAGES", "100"))
+        # Parse list pages incrementally instead of buffering each page as a whole
+        self.stream_lists = os.environ.get("UNIFI_STREAM_LISTS", "false").lower() in ("1", "true", "yes")
+        
+        # Response cache for read-only endpoints
+        self.cache_enabled = os.environ.get("UNIFI_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+        self.cache = ResponseCache(
+            max_entries=int(os.environ.get("UNIFI_CACHE_MAX_ENTRIES", "512")),
+            stale_ttl=float(os.environ.get("UNIFI_CACHE_STALE_TTL", "60.0")),
+        )
+        self.cache_ttls = dict(CACHE_TTLS)
+        # Optional on-disk tier under the memory cache, so a restarted server starts with warm data.
+        # Entries are namespaced by API URL and key so another account never sees them.
+        namespace = hashlib.sha256(f"{self.base_url} {self.api_key}".encode()).hexdigest()[:16] + " "
+        max_bytes = int(float(os.environ.get("UNIFI_DISK_CACHE_MAX_MB", "64")) * 1024 * 1024)
+        max_age = float(os.environ.get("UNIFI_DISK_CACHE_MAX_AGE", "86400"))
+        # With several workers, state shared between them takes the place of the disk tier and also
+        # holds fetch leases and the rate limit budgets (see SQLiteSharedState and RedisSharedState)
+        self.shared_state: Any = None
+        shared_url = os.environ.get("UNIFI_SHARED_STATE", "")
+        if shared_url:
+            self.shared_state = create_shared_state(shared_url, namespace, max_bytes, max_age)
+        self.shared_lease_timeout = float(os.environ.get("UNIFI_SHARED_LEASE_TIMEOUT", "30.0"))
+        self.shared_poll_interval = 0.05
+        self.worker_id = f"{os.getpid()}-{secrets.token_hex(4)}"
+        self.shared_waits = 0
+        self.disk_cache: Any = None
+        if self.cache_enabled and self.shared_state is not None:
+            self.disk_cache = self.shared_state
+        elif self.cache_enabled and os.environ.get("UNIFI_DISK_CACHE", "false").lower() in ("1", "true", "yes"):
+            self.disk_cache = DiskCache(
+                os.environ.get("UNIFI_DISK_CACHE_PATH", "logs/response_cache.db"),
+                namespace=namespace,
+                max_bytes=max_bytes,
+                max_age=max_age,
+            )
+        self._background_tasks: set = set()
+        self._refreshing: set = set()
+        
+        # Identical concurrent GET requests share one upstream call (across workers with shared state)
+        self.single_flight = SingleFlight()
+        
+        # Client-side rate limiting and adaptive concurrency
+        self.rate_limiter = RateLimiter({
+            "v1": float(os.environ.get("UNIFI_RATE_LIMIT_V1", "10000")),
+            "ea": float(os.environ.get("UNIFI_RATE_LIMIT_EA", "100")),
+        }, shared=self.shared_state)
+        self.concurrency = AdaptiveConcurrencyLimiter(
+            initial=int(os.environ.get("UNIFI_CONCURRENCY_INITIAL", "8")),
+            minimum=int(os.environ.get("UNIFI_CONCURRENCY_MIN", "1")),
+            maximum=int(os.environ.get("UNIFI_CONCURRENCY_MAX", "64")),
+        )
+        
+        # Retries with decorrelated jitter backoff and per-host circuit breakers
+        self.max_retries = int(os.environ.get("UNIFI_MAX_RETRIES", "3"))
+        self.retry_base_delay = float(os.environ.get("UNIFI_RETRY_BASE_DELAY", "0.2"))
+        self.retry_max_delay = float(os.environ.get("UNIFI_RETRY_MAX_DELAY", "10.0"))
+        self.retries = 0
+        self.breaker_failure_threshold = int(os.environ.get("UNIFI_BREAKER_FAILURE_THRESHOLD", "5"))
+        self.breaker_recovery_timeout = float(os.environ.get("UNIFI_BREAKER_RECOVERY_TIMEOUT", "30.0"))
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        
+        # SD-WAN statuses fetched for sdwan_overview are reused for a short time
+        self.sdwan_status_ttl = float(os.environ.get("UNIFI_SDWAN_STATUS_TTL", "15.0"))
+        
+        # Sharding of host IDs for list_devices_fanout
+        self.fanout_shard_size = int(os.environ.get("UNIFI_FANOUT_SHARD_SIZE", "10"))
+        self.fanout_concurrency = int(os.environ.get("UNIFI_FANOUT_CONCURRENCY", "8"))
+        
+        # Site to host mapping used by the legacy get_devices(site_id) method
+        self.site_index = SiteIndex(
+            self.iter_sites,
+            ttl=float(os.environ.get("UNIFI_SITE_INDEX_TTL", "300.0")),
+        )
+        
+        # Background inventory snapshot served to tools and resources
+        self.inventory_enabled = os.environ.get("UNIFI_INVENTORY_SYNC", "true").lower() in ("1", "true", "yes")
+        self.inventory = Inventory(
+            self,
+            interval=float(os.environ.get("UNIFI_INVENTORY_INTERVAL", "60.0")),
+            full_interval=float(os.environ.get("UNIFI_INVENTORY_FULL_INTERVAL", "900.0")),
+        )
+        
+        # Local ISP metrics store; only missing time ranges are fetched from the API
+        self.metrics_store_enabled = os.environ.get("UNIFI_METRICS_STORE", "true").lower() in ("1", "true", "yes")
+        metrics_db = os.environ.get("UNIFI_METRICS_DB", ":memory:")
+        if api_key and metrics_db != ":memory:":
+            # Coverage is tracked per file, so each tenant gets its own
+            root, ext = os.path.splitext(metrics_db)
+            metrics_db = f"{root}-{namespace.strip()}{ext}"
+        self.metrics_store = MetricsStore(metrics_db)
+        self._metric_locks: Dict[str, asyncio.Lock] = {}
         logger.info(f"Initialized Unifi client with base URL: {self.base_url}")
     
+    def _get_http_client(self) -> httpx.AsyncClient:
+        """Return the shared HTTP client, creating it on first use"""
+        if self._http_client is None:
+            self._http_client = httpx.AsyncClient(
+                headers=self.headers,
+                limits=self.limits,
+                timeout=self.timeout,
+                http2=self.http2,
+            )
+        return self._http_client
+    
+    async def start(self) -> None:
+        """Open the shared connection pool used for all API requests"""
+        self._get_http_client()
+        logger.info(f"Opened Unifi connection pool (http2={self.http2})")
+    
+    async def close(self) -> None:
+        """Close the shared connection pool"""
+        await self.inventory.stop()
+        for task in list(self._background_tasks):
+            task.cancel()
+        if self._http_client is not None:
+            await self._http_client.aclose()
+            self._http_client = None
+            logger.info("Closed Unifi connection pool")
+        if self.disk_cache is not None and self.disk_cache is not self.shared_state:
+            self.disk_cache.close()
+        self.disk_cache = None
+        if self.shared_state is not None:
+            self.shared_state.close()
+            self.shared_state = None
+    
+    def _cache_ttl(self, method: str, endpoint: str) -> Optional[float]:
+        """Return the cache TTL for an endpoint, or None if it must not be cached"""
+        if not self.cache_enabled or method.upper() != "GET" or endpoint.endswith("/status"):
+            return None
+        matches = [prefix for prefix in self.cache_ttls if endpoint.startswith(prefix)]
+        if not matches:
+            return None
+        return self.cache_ttls[max(matches, key=len)]
+    
     async def _make_request(self, method: str, endpoint: str, params: Optional[Dict] = None, json_data: Optional[Dict] = None) -> Dict[str, Any]:
-        """Make an HTTP request to the Unifi API"""
-        url = f"{self.base_url}{endpoint}"
+        """Make an HTTP request to the Unifi API, serving reads from the cache and coalescing duplicates"""
+        with tracer.span(f"unifi {method} {endpoint_label(endpoint)}", {"url.path": endpoint}) as span:
+            if method.upper() != "GET":
+                return await self._send_request(method, endpoint, params, json_data)
+            
+            key = ResponseCache.make_key(method, endpoint, params)
+            ttl = self._cache_ttl(method, endpoint)
+            if ttl is not None:
+                cached = self.cache.get(key)
+                tier = "memory"
+                if cached is None and self.disk_cache is not None:
+                    cached = await self._load_from_disk(key, ttl)
+                    tier = "shared" if self.disk_cache is self.shared_state else "disk"
+                if cached is not None:
+                    value, fresh = cached
+                    result = "hit" if fresh else "stale"
+                    if tier != "memory":
+                        result = f"{tier}_{result}"
+                    CACHE_LOOKUPS.inc((endpoint_label(endpoint), result))
+                    span.set_attribute("cache.result", result)
+                    if not fresh:
+                        self._schedule_refresh(key, ttl, method, endpoint, params)
+                    return value
+                CACHE_LOOKUPS.inc((endpoint_label(endpoint), "miss"))
+                span.set_attribute("cache.result", "miss")
+            
+            return await self._fetch(key, ttl, method, endpoint, params)
+    
+    async def _fetch(self, key: str, ttl: Optional[float], method: str, endpoint: str,
+                     params: Optional[Dict]) -> Dict[str, Any]:
+        """Fetch a GET endpoint through the single-flight table and store the result in the cache"""
+        async def fetch():
+            data = await self._send_request(method, endpoint, params)
+            if ttl is not None:
+                self.cache.set(key, data, ttl)
+                if self.disk_cache is not None:
+                    try:
+                        await asyncio.to_thread(self.disk_cache.set, key, data)
+                    except STATE_ERRORS as e:
+                        logger.warning(f"Writing {endpoint} to the disk cache failed: {e}")
+            return data
+        
+        if ttl is not None and self.shared_state is not None and self.disk_cache is self.shared_state:
+            return await self.single_flight.do(key, lambda: self._fetch_shared(key, ttl, fetch))
+        return await self.single_flight.do(key, fetch)
+    
+    async def _fetch_shared(self, key: str, ttl: float, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        """Single-flight across workers: the worker holding the key's lease calls the API and the
+        others wait for its result to appear in the shared cache"""
+        state = self.shared_state
+        deadline = time.monotonic() + self.shared_lease_timeout
+        try:
+            while not await asyncio.to_thread(state.acquire_lease, key, self.worker_id, self.shared_lease_timeout):
+                await asyncio.sleep(self.shared_poll_interval)
+                entry = await asyncio.to_thread(state.get, key)
+                if entry is not None and entry[1] < ttl:
+                    self.shared_waits += 1
+                    self.cache.set(key, entry[0], ttl, age=entry[1])
+                    return entry[0]
+                if time.monotonic() >= deadline:
+                    # The lease holder is stuck; fetching again beats failing the call
+                    return await fetch()
+            # Another worker may have stored a fresh result between our cache miss and the lease
+            entry = await asyncio.to_thread(state.get, key)
+            if entry is not None and entry[1] < ttl:
+                self.shared_waits += 1
+                self.cache.set(key, entry[0], ttl, age=entry[1])
+                await asyncio.to_thread(state.release_lease, key, self.worker_id)
+                return entry[0]
+        except STATE_ERRORS as e:
+            logger.warning(f"Shared single-flight unavailable, fetching locally: {e}")
+            return await fetch()
+        try:
+            return await fetch()
+        finally:
+            try:
+                await asyncio.to_thread(state.release_lease, key, self.worker_id)
+            except STATE_ERRORS as e:
+                # The lease expires on its own
+                logger.warning(f"Releasing a shared fetch lease failed: {e}")
+    
+    async def _load_from_disk(self, key: str, ttl: float) -> Optional[Tuple[Any, bool]]:
+        """Return (value, is_fresh) from the disk cache or shared state, copying the entry into the memory cache"""
+        try:
+            entry = await asyncio.to_thread(self.disk_cache.get, key)
+        except STATE_ERRORS as e:
+            logger.warning(f"Reading the disk cache failed: {e}")
+            return None
+        if entry is None:
+            return None
+        value, age = entry
+        self.cache.set(key, value, ttl, age=age)
+        # Entries older than their TTL are still served (up to the disk cache's max age) while being revalidated
+        return value, age < ttl
+    
+    def _schedule_refresh(self, key: str, ttl: float, method: str, endpoint: str, params: Optional[Dict]) -> None:
+        """Revalidate a stale cache entry in the background (stale-while-revalidate)"""
+        if key in self._refreshing:
+            return
         
-        async with httpx.AsyncClient() as client:
+        async def refresh():
             try:
-                response = await client.request(
-                    method=method,
-                    url=url,
-                    headers=self.headers,
-                    params=params,
-                    json=json_data,
-                    timeout=30.0
-                )
-                response.raise_for_status()
-                return response.json()
-            except httpx.HTTPError as e:
-                logger.error(f"HTTP error occurred: {e}")
-                raise HTTPException(status_code=500, detail=f"API request failed: {str(e)}")
+                await self._fetch(key, ttl, method, endpoint, params)
             except Exception as e:
-                logger.error(f"Unexpected error occurred: {e}")
-                raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
+                logger.warning(f"Background refresh of {endpoint} failed: {e}")
+            finally:
+                self._refreshing.discard(key)
+        
+        self._refreshing.add(key)
+        task = asyncio.create_task(refresh())
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+    
+    def cache_stats(self) -> Dict[str, Any]:
+        """Return response cache counters"""
+        stats = {"enabled": self.cache_enabled, **self.cache.stats()}
+        if self.shared_state is not None:
+            stats["shared"] = {**self.shared_state.stats(), "worker": self.worker_id, "waits": self.shared_waits}
+        elif self.disk_cache is not None:
+            stats["disk"] = self.disk_cache.stats()
+        return stats
+    
+    def _breaker_for(self, url: str) -> CircuitBreaker:
+        """Return the circuit breaker for the host of a URL"""
+        host = httpx.URL(url).host
+        breaker = self.breakers.get(host)
+        if breaker is None:
+            breaker = self.breakers[host] = CircuitBreaker(
+                host, self.breaker_failure_threshold, self.breaker_recovery_timeout
+            )
+        return breaker
+    
+    async def _send_request(self, method: str, endpoint: str, params: Optional[Dict] = None, json_data: Optional[Dict] = None,
+                            stream: bool = False) -> Any:
+        """Send an HTTP request to the Unifi API, retrying transient failures of idempotent methods.
+        With stream, the response is returned as soon as its headers arrive; the caller reads and closes it"""
+        url = f"{self.base_url}{endpoint}"
+        client = self._get_http_client()
+        breaker = self._breaker_for(url)
+        max_retries = self.max_retries if method.upper() in IDEMPOTENT_METHODS else 0
+        backoff = self.retry_base_delay
+        attempt = 0
+        label = endpoint_label(endpoint)
+        
+        while True:
+            self._check_breaker(breaker)
+            span = tracer.span(f"upstream {method} {label}", {
+                "http.request.method": method, "url.path": endpoint, "retry.attempt": attempt,
+            })
+            with span:
+                try:
+                    span.set_attribute("rate_limit.wait_s", await self.rate_limiter.acquire(endpoint))
+                    queued = time.perf_counter()
+                    async with self.concurrency:
+                        span.set_attribute("concurrency.wait_s", time.perf_counter() - queued)
+                        UPSTREAM_IN_FLIGHT.inc()
+                        started = time.perf_counter()
+                        status = "error"
+                        try:
+                            if stream:
+                                request = client.build_request(method, url, params=params, json=json_data,
+                                                               headers=span.propagation_headers(),
+                                                               extensions=span.httpx_extensions())
+                                response = await client.send(request, stream=True)
+                                status = str(response.status_code)
+                                if response.is_error:
+                                    # The error body is left unread; raise_for_status only needs the headers
+                                    await response.aclose()
+                            else:
+                                response = await client.request(
+                                    method=method,
+                                    url=url,
+                                    params=params,
+                                    json=json_data,
+                                    headers=span.propagation_headers(),
+                                    extensions=span.httpx_extensions(),
+                                )
+                                status = str(response.status_code)
+                                UPSTREAM_BYTES.inc((label,), len(response.content))
+                        finally:
+                            UPSTREAM_IN_FLIGHT.dec()
+                            UPSTREAM_DURATION.observe(time.perf_counter() - started, (method, label))
+                            UPSTREAM_REQUESTS.inc((method, label, status))
+                            span.set_attribute("http.response.status_code", status)
+                    response.raise_for_status()
+                    self.concurrency.on_success()
+                    breaker.record_success()
+                    return response if stream else response.json()
+                except Exception as e:
+                    cause = e
+                    error, retryable, retry_after = self._classify_error(e, endpoint, breaker)
+                    span.record_exception(error)
+            
+            if not retryable or attempt >= max_retries:
+                raise error from cause
+            
+            # Decorrelated jitter backoff, never shorter than the server's Retry-After
+            backoff = min(self.retry_max_delay, random.uniform(self.retry_base_delay, backoff * 3))
+            if retry_after is not None:
+                if retry_after > self.retry_max_delay:
+                    raise error from cause
+                backoff = max(backoff, retry_after)
+            attempt += 1
+            self.retries += 1
+            UPSTREAM_RETRIES.inc((label,))
+            logger.warning(f"Retrying {method} {endpoint} in {backoff:.2f}s (attempt {attempt}/{max_retries})")
+            await asyncio.sleep(backoff)
+    
+    def _check_breaker(self, breaker: CircuitBreaker) -> None:
+        if not breaker.allow_request():
+            logger.warning(f"Circuit breaker open for {breaker.host}, failing fast")
+            raise HTTPException(
+                status_code=503,
+                detail=f"Circuit breaker open for {breaker.host}, retry in {breaker.retry_in():.0f}s",
+            )
+    
+    def _classify_error(self, e: Exception, endpoint: str,
+                        breaker: CircuitBreaker) -> Tuple[HTTPException, bool, Optional[float]]:
+        """Map a request failure to (HTTPException, retryable, retry_after) and update limiter/breaker state"""
+        if isinstance(e, httpx.HTTPStatusError):
+            status_code = e.response.status_code
+            retry_after = parse_retry_after(e.response.headers.get("Retry-After"))
+            # Any Retry-After (say, a 503 during maintenance) asks for the same back-off as a 429
+            if status_code == 429 or retry_after is not None:
+                self.rate_limiter.on_throttled(endpoint, retry_after)
+                self.concurrency.on_throttled()
+            if status_code == 429:
+                logger.warning(f"Rate limited by Unifi API on {endpoint} (Retry-After: {retry_after})")
+                headers = {"Retry-After": str(int(retry_after))} if retry_after is not None else None
+                error = HTTPException(status_code=429, detail=f"API rate limit exceeded: {str(e)}", headers=headers)
+                return error, True, retry_after
+            # Client errors mean the upstream is reachable, only server errors count against the breaker
+            if status_code >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            logger.error(f"HTTP error occurred: {e}")
+            error = HTTPException(status_code=500, detail=f"API request failed: {str(e)}")
+            return error, status_code in RETRY_STATUS_CODES, retry_after
+        if isinstance(e, httpx.TransportError):
+            # Connection resets, timeouts and protocol errors
+            breaker.record_failure()
+            logger.error(f"HTTP error occurred: {e!r}")
+            return HTTPException(status_code=500, detail=f"API request failed: {str(e) or type(e).__name__}"), True, None
+        if isinstance(e, httpx.HTTPError):
+            logger.error(f"HTTP error occurred: {e}")
+            return HTTPException(status_code=500, detail=f"API request failed: {str(e)}"), False, None
+        logger.error(f"Unexpected error occurred: {e}")
+        return HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}"), False, None
+    
+    async def _stream_items(self, endpoint: str, params: Optional[Dict],
+                            parser: "StreamingPageParser") -> AsyncIterator[Any]:
+        """Stream a GET response, yielding elements of its data array as soon as they are parsed.
+        Failures are retried until the body is being read; after that the page can't be replayed
+        without repeating items, so they are raised"""
+        response = await self._send_request("GET", endpoint, params, stream=True)
+        label = endpoint_label(endpoint)
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        try:
+            async for chunk in response.aiter_bytes():
+                UPSTREAM_BYTES.inc((label,), len(chunk))
+                for item in parser.feed(decoder.decode(chunk)):
+                    yield item
+            for item in parser.feed(decoder.decode(b"", final=True), final=True):
+                yield item
+        except (httpx.HTTPError, ValueError) as e:
+            error, _, _ = self._classify_error(e, endpoint, self._breaker_for(str(response.url)))
+            raise error from e
+        finally:
+            await response.aclose()
+    
+    def breaker_stats(self) -> Dict[str, Any]:
+        """Return circuit breaker state per upstream host"""
+        return {host: breaker.stats() for host, breaker in self.breakers.items()}
     
     # Host Management
-    # TODO: Move Optional[int] to .env file
+    async def list_hosts(self, page_size: Optional[int] = None, next_token: Optional[str] = None) -> Dict[str, Any]:
         """Get list of all hosts associated with the UI account"""
         logger.info("Getting list of Unifi hosts")
         params = {}
         if page_size:
             params["pageSize"] = page_size
         if next_token:
-            # TODO: Move params["nextToken"] to .env file
+            params["nextToken"] = next_token
         
         return await self._make_request("GET", "/v1/hosts", params=params)
     
@@ -107,20 +2806,20 @@ class UnifiClient:
         return await self._make_request("GET", f"/v1/hosts/{host_id}")
     
     # Site Management
-    # TODO: Move Optional[int] to .env file
+    async def list_sites(self, page_size: Optional[int] = None, next_token: Optional[str] = None) -> Dict[str, Any]:
         """Get list of all sites from hosts running the UniFi Network application"""
         logger.info("Getting list of Unifi sites")
         params = {}
         if page_size:
             params["pageSize"] = page_size
         if next_token:
-            # TODO: Move params["nextToken"] to .env file
+            params["nextToken"] = next_token
         
         return await self._make_request("GET", "/v1/sites", params=params)
     
     # Device Management
     async def list_devices(self, host_ids: Optional[List[str]] = None, time: Optional[str] = None,
-                          # TODO: Move Optional[int] to .env file
+                          page_size: Optional[int] = None, next_token: Optional[str] = None) -> Dict[str, Any]:
         """Get list of UniFi devices managed by hosts"""
         logger.info("Getting list of Unifi devices")
         params = {}
@@ -131,7 +2830,7 @@ class UnifiClient:
         if page_size:
             params["pageSize"] = page_size
         if next_token:
-            # TODO: Move params["nextToken"] to .env file
+            params["nextToken"] = next_token
         
         return await self._make_request("GET", "/v1/devices", params=params)
     
@@ -155,15 +2854,77 @@ class UnifiClient:
         logger.info("Querying ISP metrics with custom parameters")
         return await self._make_request("POST", "/ea/isp-metrics/query", json_data=query_data)
     
+    async def sync_isp_metrics(self, metric_type: str, begin_timestamp: Optional[str] = None,
+                               end_timestamp: Optional[str] = None, duration: Optional[str] = None) -> Tuple[int, int]:
+        """Fetch the parts of a metrics window missing from the local store and return the window"""
+        begin, end = metric_window(metric_type, begin_timestamp, end_timestamp, duration)
+        step = METRIC_STEPS[metric_type]
+        lock = self._metric_locks.setdefault(metric_type, asyncio.Lock())
+        async with lock:
+            for gap_begin, gap_end in self.metrics_store.missing(metric_type, begin, end):
+                now = time.time()
+                # Nothing older than the API retention can be fetched, and recent periods may still be incomplete
+                fetch_begin = max(gap_begin, int(now) - METRIC_RETENTION[metric_type])
+                settled = int(now) - int(now) % step - step
+                if fetch_begin < gap_end:
+                    response = await self.get_isp_metrics(
+                        metric_type, format_timestamp(fetch_begin), format_timestamp(gap_end)
+                    )
+                    await asyncio.to_thread(self.metrics_store.add, metric_type, response)
+                self.metrics_store.mark_covered(metric_type, gap_begin, min(gap_end, settled))
+        return begin, end
+    
+    async def get_isp_metrics_stored(self, metric_type: str, begin_timestamp: Optional[str] = None,
+                                     end_timestamp: Optional[str] = None, duration: Optional[str] = None,
+                                     site_ids: Optional[List[str]] = None) -> Dict[str, Any]:
+        """Get ISP metrics from the local store, fetching only missing time ranges"""
+        begin, end = await self.sync_isp_metrics(metric_type, begin_timestamp, end_timestamp, duration)
+        return await asyncio.to_thread(self.metrics_store.query, metric_type, begin, end, site_ids)
+    
+    async def summarize_isp_metrics(self, metric_type: str, begin_timestamp: Optional[str] = None,
+                                    end_timestamp: Optional[str] = None, duration: Optional[str] = None,
+                                    site_ids: Optional[List[str]] = None, metrics: Optional[List[str]] = None,
+                                    percentiles: Iterable[float] = (50, 95, 99),
+                                    bucket: Optional[str] = None) -> Dict[str, Any]:
+        """Per-site ISP metric aggregates, and optionally a downsampled series, answered from the local store"""
+        begin, end = await self.sync_isp_metrics(metric_type, begin_timestamp, end_timestamp, duration)
+        result = {
+            "metricType": metric_type,
+            "beginTimestamp": format_timestamp(begin),
+            "endTimestamp": format_timestamp(end),
+            "sites": await asyncio.to_thread(
+                self.metrics_store.summarize, metric_type, begin, end, site_ids, metrics, percentiles
+            ),
+        }
+        if bucket:
+            result["series"] = await asyncio.to_thread(
+                self.metrics_store.downsample, metric_type, begin, end, parse_duration(bucket), site_ids, metrics
+            )
+        return result
+    
+    async def analyze_isp_metrics(self, metric_type: str, begin_timestamp: Optional[str] = None,
+                                  end_timestamp: Optional[str] = None, duration: Optional[str] = None,
+                                  site_ids: Optional[List[str]] = None, metrics: Optional[List[str]] = None,
+                                  percentiles: Iterable[float] = (50, 95, 99), window: str = "1h",
+                                  threshold: float = 3.5, sort_by: str = "anomaly_score",
+                                  top: int = 20) -> Dict[str, Any]:
+        """Per-site ISP metric statistics, rolling windows and anomaly scores computed from the local store"""
+        begin, end = await self.sync_isp_metrics(metric_type, begin_timestamp, end_timestamp, duration)
+        window_periods = max(1, parse_duration(window) // METRIC_STEPS[metric_type])
+        return await asyncio.to_thread(
+            self.metrics_store.analyze, metric_type, begin, end, site_ids, metrics,
+            percentiles, window_periods, threshold, sort_by, top
+        )
+    
     # SD-WAN Management
-    # TODO: Move Optional[int] to .env file
+    async def list_sdwan_configs(self, page_size: Optional[int] = None, next_token: Optional[str] = None) -> Dict[str, Any]:
         """Get list of all SD-WAN configurations"""
         logger.info("Getting list of SD-WAN configurations")
         params = {}
         if page_size:
             params["pageSize"] = page_size
         if next_token:
-            # TODO: Move params["nextToken"] to .env file
+            params["nextToken"] = next_token
         
         return await self._make_request("GET", "/v1/sd-wan/configs", params=params)
     
@@ -177,6 +2938,131 @@ class UnifiClient:
         logger.info(f"Getting SD-WAN config status for ID: {config_id}")
         return await self._make_request("GET", f"/v1/sd-wan/configs/{config_id}/status")
 
+    # Pagination
+    async def _paginate(self, endpoint: str, params: Dict[str, Any], max_items: Optional[int] = None,
+                        max_pages: Optional[int] = None) -> AsyncIterator[Dict[str, Any]]:
+        """Yield items from a paginated list endpoint, following nextToken until exhausted or bounded"""
+        max_pages = max_pages or self.max_pages
+        next_token = None
+        pages = 0
+        count = 0
+        while True:
+            page_params = {**params, "nextToken": next_token} if next_token else params
+            # Streamed pages bypass the response cache: holding them for it would defeat streaming
+            if self.stream_lists:
+                page = StreamedPage(self, endpoint, page_params)
+            else:
+                page = BufferedPage(await self._make_request("GET", endpoint, params=page_params))
+            pages += 1
+            items = aiter(page)
+            try:
+                async for item in items:
+                    yield item
+                    count += 1
+                    if max_items is not None and count >= max_items:
+                        return
+            finally:
+                # Stopping early closes a streamed response right away instead of when it is collected
+                await items.aclose()
+            next_token = page.next_token
+            if not next_token:
+                return
+            if pages >= max_pages:
+                logger.warning(f"Stopped pagination after {pages} pages with more results available")
+                return
+    
+    @staticmethod
+    def _page_params(page_size: Optional[int] = None, **filters) -> Dict[str, Any]:
+        params = {name: value for name, value in filters.items() if value}
+        if page_size:
+            params["pageSize"] = page_size
+        return params
+    
+    def iter_hosts(self, page_size: Optional[int] = None, max_items: Optional[int] = None,
+                   max_pages: Optional[int] = None) -> AsyncIterator[Dict[str, Any]]:
+        """Iterate over all hosts, fetching further pages as needed"""
+        return self._paginate("/v1/hosts", self._page_params(page_size), max_items, max_pages)
+    
+    def iter_sites(self, page_size: Optional[int] = None, max_items: Optional[int] = None,
+                   max_pages: Optional[int] = None) -> AsyncIterator[Dict[str, Any]]:
+        """Iterate over all sites, fetching further pages as needed"""
+        return self._paginate("/v1/sites", self._page_params(page_size), max_items, max_pages)
+    
+    def iter_devices(self, host_ids: Optional[List[str]] = None, time: Optional[str] = None,
+                     page_size: Optional[int] = None, max_items: Optional[int] = None,
+                     max_pages: Optional[int] = None) -> AsyncIterator[Dict[str, Any]]:
+        """Iterate over all device groups (one per host), fetching further pages as needed"""
+        params = self._page_params(page_size, **{"hostIds[]": host_ids, "time": time})
+        return self._paginate("/v1/devices", params, max_items, max_pages)
+    
+    def iter_sdwan_configs(self, page_size: Optional[int] = None, max_items: Optional[int] = None,
+                           max_pages: Optional[int] = None) -> AsyncIterator[Dict[str, Any]]:
+        """Iterate over all SD-WAN configurations, fetching further pages as needed"""
+        return self._paginate("/v1/sd-wan/configs", self._page_params(page_size), max_items, max_pages)
+
+    # Parallel fan-out
+    async def list_devices_fanout(self, host_ids: Optional[List[str]] = None, time: Optional[str] = None,
+                                  page_size: Optional[int] = None, shard_size: Optional[int] = None,
+                                  concurrency: Optional[int] = None,
+                                  max_pages: Optional[int] = None) -> Dict[str, Any]:
+        """Get devices for many hosts by fetching shards of host IDs (and their pages) concurrently"""
+        if host_ids is None:
+            host_ids = [host["id"] async for host in self.iter_hosts(page_size=page_size) if host.get("id")]
+        host_ids = list(dict.fromkeys(host_ids))
+        shard_size = shard_size or self.fanout_shard_size
+        shards = [host_ids[i:i + shard_size] for i in range(0, len(host_ids), shard_size)]
+        semaphore = asyncio.Semaphore(concurrency or self.fanout_concurrency)
+        logger.info(f"Fanning out device listing for {len(host_ids)} hosts over {len(shards)} shards")
+        
+        async def fetch_shard(shard: List[str]) -> List[Dict[str, Any]]:
+            async with semaphore:
+                return [
+                    group async for group in self.iter_devices(
+                        host_ids=shard, time=time, page_size=page_size, max_pages=max_pages
+                    )
+                ]
+        
+        tasks = [asyncio.ensure_future(fetch_shard(shard)) for shard in shards]
+        try:
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        return {"data": merge_device_groups(host_ids, results)}
+    
+    async def get_sdwan_config_status_cached(self, config_id: str, refresh: bool = False) -> Dict[str, Any]:
+        """Get the status of an SD-WAN configuration, reusing responses younger than sdwan_status_ttl"""
+        endpoint = f"/v1/sd-wan/configs/{config_id}/status"
+        key = ResponseCache.make_key("GET", endpoint)
+        ttl = self.sdwan_status_ttl if self.cache_enabled and self.sdwan_status_ttl > 0 else None
+        if ttl is not None and not refresh:
+            cached = self.cache.get(key)
+            # Stale statuses are not served; they are fetched again
+            if cached is not None and cached[1]:
+                return cached[0]
+        return await self._fetch(key, ttl, "GET", endpoint, None)
+    
+    async def sdwan_overview(self, concurrency: Optional[int] = None, live: bool = False) -> Dict[str, Any]:
+        """List SD-WAN configs joined with their statuses, fetching the statuses concurrently"""
+        configs = None if live else self.inventory.list_sdwan_configs()
+        if configs is None:
+            configs = {"data": [config async for config in self.iter_sdwan_configs()]}
+        configs = [config for config in configs["data"] if config.get("id")]
+        semaphore = asyncio.Semaphore(concurrency or self.fanout_concurrency)
+        logger.info(f"Fetching status of {len(configs)} SD-WAN configs")
+        
+        async def fetch_status(config_id: str) -> Any:
+            async with semaphore:
+                try:
+                    return await self.get_sdwan_config_status_cached(config_id, refresh=live)
+                except Exception as e:
+                    return e
+        
+        statuses = await asyncio.gather(*(fetch_status(config["id"]) for config in configs))
+        rows = [sdwan_overview_row(config, status) for config, status in zip(configs, statuses)]
+        return {"data": rows, "count": len(rows), "failed": sum(1 for row in rows if "error" in row)}
+
     # Legacy methods for backward compatibility
     async def get_sites(self) -> List[Dict[str, Any]]:
         """Get list of all Unifi sites (legacy method)"""
@@ -185,9 +3071,21 @@ class UnifiClient:
     
     async def get_devices(self, site_id: str) -> List[Dict[str, Any]]:
         """Get list of all devices for a specific site (legacy method)"""
-        # Note: The new API doesn't filter by site_id directly, so we'll get all devices
-        result = await self.list_devices()
-        return result.get("data", [])
+        # The API doesn't filter devices by site, so look up the host running the site and query only that host
+        host_id = await self.site_index.host_for_site(site_id)
+        if host_id is None:
+            logger.warning(f"Site {site_id} not found")
+            return []
+        devices = []
+        async for group in self.iter_devices(host_ids=[host_id]):
+            if group.get("hostId") not in (None, host_id):
+                continue
+            for device in group.get("devices") or []:
+                # Devices only carry a site ID on some consoles; when present use it to narrow down further
+                if device.get("siteId") not in (None, site_id):
+                    continue
+                devices.append(device)
+        return devices
     
     async def get_clients(self, site_id: str) -> List[Dict[str, Any]]:
         """Get list of all clients for a specific site (legacy method)"""
@@ -197,136 +3095,592 @@ class UnifiClient:
         return []
 
 
-# Initialize Unifi client
+# Unifi client, created by the HTTP app's startup or on the first tool call
 unifi_client = None
+_unifi_client_lock: Optional[asyncio.Lock] = None
+
+
+async def ensure_unifi_client() -> "UnifiClient":
+    """Create and start the shared Unifi client if that hasn't happened yet"""
+    global unifi_client, _unifi_client_lock
+    if _unifi_client_lock is None:
+        _unifi_client_lock = asyncio.Lock()
+    async with _unifi_client_lock:
+        if unifi_client is None:
+            try:
+                client = UnifiClient()
+                await client.start()
+            except Exception as e:
+                logger.error(f"Failed to initialize Unifi client: {e}")
+                raise HTTPException(status_code=500, detail=f"Unifi client not initialized: {e}") from e
+            if client.inventory_enabled:
+                client.inventory.start()
+            unifi_client = client
+            logger.info("Unifi client initialized successfully")
+    return unifi_client
 
 
-@app.on_event("startup")
 async def startup_event():
-    global unifi_client
     try:
-        unifi_client = UnifiClient()
-        logger.info("Unifi client initialized successfully")
-    except Exception as e:
-        logger.error(f"Failed to initialize Unifi client: {e}")
+        await ensure_unifi_client()
+    except HTTPException as e:
         # Stop application startup if the client is not configured
         raise RuntimeError("Unifi client initialization failed") from e
 
 
+async def shutdown_event():
+    if unifi_client:
+        await unifi_client.close()
+    if tenant_clients:
+        await tenant_clients.close()
+
+
+# Tenants
+# One process can serve many UI accounts. An HTTP request picks its account with the X-Unifi-Api-Key
+# header, or with X-Unifi-Tenant naming an account listed in UNIFI_TENANTS_FILE; calls without
+# either (and the stdio transport) use UNIFI_API_KEY. Each account gets its own UnifiClient, with
+# its own connection pool, cache namespace and rate limit budget.
+
+# Tenant selected for the current call, as ("key", api_key) or ("name", tenant_name, bearer_token)
+_current_tenant: "contextvars.ContextVar[Optional[Tuple[Optional[str], ...]]]" = contextvars.ContextVar("unifi_current_tenant", default=None)
+# Client serving the current call when it isn't the default one
+_current_client: "contextvars.ContextVar[Optional[UnifiClient]]" = contextvars.ContextVar("unifi_current_client", default=None)
+
+
+def current_client() -> Optional["UnifiClient"]:
+    """Client of the tenant the current tool call is made for, or the default client"""
+    return _current_client.get() or unifi_client
+
+
+def tenant_id(api_key: str) -> str:
+    """Short identifier of an API key, safe to log and report"""
+    return hashlib.sha256(api_key.encode()).hexdigest()[:12]
+
+
+def load_tenants(path: Optional[str]) -> Dict[str, Tuple[str, Optional[str]]]:
+    """Read UNIFI_TENANTS_FILE, a JSON object mapping tenant names to an API key or to
+    {"api_key": ..., "token": ...}, into name -> (api_key, token)"""
+    if not path:
+        return {}
+    with open(path, "rb") as f:
+        entries = json_loads(f.read())
+    if not isinstance(entries, dict):
+        raise ValueError(f"{path} must contain a JSON object mapping tenant names to API keys")
+    tenants = {}
+    for name, entry in entries.items():
+        if isinstance(entry, str):
+            tenants[name] = (entry, None)
+        elif (isinstance(entry, dict) and isinstance(entry.get("api_key"), str)
+              and isinstance(entry.get("token"), str) and entry["token"]):
+            tenants[name] = (entry["api_key"], entry["token"])
+        else:
+            raise ValueError(f"Tenant {name!r} in {path} needs an API key, or an object with api_key and token")
+    return tenants
+
+
+class _TenantClient:
+    """A tenant's client and the number of calls using it"""
+    
+    def __init__(self, client: "UnifiClient"):
+        self.client = client
+        self.in_use = 0
+        self.used_at = time.monotonic()
+
+
+class ClientRegistry:
+    """UnifiClients per API key, created on first use and closed once idle or least recently used"""
+    
+    def __init__(self, factory: Callable[[str], "UnifiClient"], max_clients: int = 100,
+                 idle_timeout: float = 900.0, inventory: bool = False):
+        self.factory = factory
+        self.max_clients = max_clients
+        self.idle_timeout = idle_timeout
+        # Background inventory syncs for hundreds of accounts would dwarf the tool traffic
+        self.inventory = inventory
+        self._clients: "OrderedDict[str, _TenantClient]" = OrderedDict()
+        self._creating: Dict[str, asyncio.Task] = {}
+        self._reaper: Optional[asyncio.Task] = None
+        self.created = 0
+        self.evicted = 0
+    
+    async def acquire(self, api_key: str) -> "UnifiClient":
+        """Return the tenant's client, creating it if needed; pair with release()"""
+        while True:
+            entry = self._clients.get(api_key)
+            if entry is not None:
+                entry.in_use += 1
+                break
+            # Concurrent first calls of one tenant share a single client
+            task = self._creating.get(api_key)
+            if task is None:
+                task = self._creating[api_key] = asyncio.ensure_future(self._create(api_key))
+                task.add_done_callback(lambda _task: self._creating.pop(api_key, None))
+                try:
+                    # _create reserves the new client for this caller
+                    entry = await asyncio.shield(task)
+                except asyncio.CancelledError:
+                    task.add_done_callback(self._release_reservation(api_key))
+                    raise
+                break
+            # The other callers take their own reference, unless the client was evicted in the meantime
+            await asyncio.shield(task)
+        entry.used_at = time.monotonic()
+        self._clients.move_to_end(api_key)
+        return entry.client
+    
+    def release(self, api_key: str) -> None:
+        entry = self._clients.get(api_key)
+        if entry is not None:
+            entry.in_use -= 1
+            entry.used_at = time.monotonic()
+    
+    def _release_reservation(self, api_key: str) -> Callable[[asyncio.Task], None]:
+        """Done callback handing back the reservation of a creating caller that was cancelled"""
+        def release(task: asyncio.Task) -> None:
+            if not task.cancelled() and task.exception() is None:
+                self.release(api_key)
+        return release
+    
+    async def _create(self, api_key: str) -> _TenantClient:
+        try:
+            client = self.factory(api_key)
+            await client.start()
+        except Exception as e:
+            logger.error(f"Failed to initialize Unifi client for tenant {tenant_id(api_key)}: {e}")
+            raise HTTPException(status_code=500, detail=f"Unifi client not initialized: {e}") from e
+        if self.inventory and client.inventory_enabled:
+            client.inventory.start()
+        # Make room first, so the new client is never the one evicted
+        await self.evict(reserve=1)
+        entry = self._clients[api_key] = _TenantClient(client)
+        # Reserved for the caller that started the creation, so no eviction can close it first
+        entry.in_use = 1
+        self.created += 1
+        logger.info(f"Created Unifi client for tenant {tenant_id(api_key)}")
+        if self._reaper is None:
+            self._reaper = asyncio.ensure_future(self._reap())
+        return entry
+    
+    async def evict(self, reserve: int = 0) -> None:
+        """Close clients idle for longer than idle_timeout, and the least recently used beyond max_clients"""
+        now = time.monotonic()
+        idle = [key for key, entry in self._clients.items() if entry.in_use == 0]
+        excess = len(self._clients) + reserve - self.max_clients
+        victims = idle[:max(0, excess)]
+        victims += [key for key in idle[len(victims):] if now - self._clients[key].used_at >= self.idle_timeout]
+        # Unregister every victim before the first await, so no tenant can acquire a client being closed
+        # and a concurrent eviction never picks the same one again
+        closing = []
+        for key in victims:
+            entry = self._clients.get(key)
+            if entry is None or entry.in_use:
+                continue
+            closing.append((key, self._clients.pop(key)))
+            self.evicted += 1
+        for key, entry in closing:
+            await entry.client.close()
+            logger.info(f"Closed idle Unifi client for tenant {tenant_id(key)}")
+    
+    async def _reap(self) -> None:
+        while True:
+            await asyncio.sleep(max(1.0, self.idle_timeout / 4))
+            await self.evict()
+    
+    async def close(self) -> None:
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+        clients = list(self._clients.values())
+        self._clients.clear()
+        for entry in clients:
+            await entry.client.close()
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "clients": len(self._clients),
+            "in_use": sum(1 for entry in self._clients.values() if entry.in_use),
+            "max_clients": self.max_clients,
+            "idle_timeout": self.idle_timeout,
+            "created": self.created,
+            "evicted": self.evicted,
+        }
+
+
+# Created on the first call for a tenant other than the default account
+tenant_clients: Optional[ClientRegistry] = None
+tenants: Optional[Dict[str, Tuple[str, Optional[str]]]] = None
+
+
+def get_tenant_clients() -> ClientRegistry:
+    global tenant_clients
+    if tenant_clients is None:
+        tenant_clients = ClientRegistry(
+            lambda api_key: UnifiClient(api_key=api_key),
+            max_clients=int(os.environ.get("UNIFI_TENANT_MAX_CLIENTS", "100")),
+            idle_timeout=float(os.environ.get("UNIFI_TENANT_IDLE_TIMEOUT", "900.0")),
+            inventory=os.environ.get("UNIFI_TENANT_INVENTORY_SYNC", "false").lower() in ("1", "true", "yes"),
+        )
+    return tenant_clients
+
+
+def resolve_tenant(selection: Tuple[Optional[str], ...]) -> str:
+    """API key of a tenant selection, raising HTTPException for unknown tenant names and missing or wrong tokens"""
+    global tenants
+    kind, value = selection[:2]
+    if kind == "key":
+        return value
+    if tenants is None:
+        tenants = load_tenants(os.environ.get("UNIFI_TENANTS_FILE"))
+    if value not in tenants:
+        raise HTTPException(status_code=404, detail=f"Unknown tenant: {value}")
+    api_key, expected = tenants[value]
+    bearer = selection[2]
+    if expected is None:
+        # A name alone is only enough where every client that can reach the server is trusted
+        if os.environ.get("UNIFI_TENANTS_TRUST_NAMES", "false").lower() in ("1", "true", "yes"):
+            return api_key
+    elif bearer is not None and hmac.compare_digest(bearer.encode(), expected.encode()):
+        return api_key
+    raise HTTPException(status_code=401, detail=f"Invalid or missing token for tenant: {value}",
+                        headers={"WWW-Authenticate": "Bearer"})
+
+
+async def call_with_tenant_client(func: Callable[..., Awaitable[Any]], *args: Any) -> Any:
+    """Run func with current_client() returning the client of the tenant selected for this call"""
+    selection = _current_tenant.get()
+    api_key = resolve_tenant(selection) if selection is not None else None
+    if _current_client.get() is not None or api_key is None or api_key == os.environ.get("UNIFI_API_KEY"):
+        # Nested calls (batch) keep their client; the default account uses the default client
+        if _current_client.get() is None and unifi_client is None:
+            await ensure_unifi_client()
+        return await func(*args)
+    
+    registry = get_tenant_clients()
+    client = await registry.acquire(api_key)
+    token = _current_client.set(client)
+    try:
+        return await func(*args)
+    finally:
+        _current_client.reset(token)
+        registry.release(api_key)
+
+
+class TenantMiddleware:
+    """ASGI middleware selecting the tenant of a request from the X-Unifi-Api-Key header, or the
+    X-Unifi-Tenant header together with the tenant's bearer token"""
+    
+    def __init__(self, app: Any):
+        self.app = app
+    
+    async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        selection = None
+        if scope["type"] == "http":
+            headers = {name: value for name, value in scope["headers"]
+                       if name in (b"x-unifi-api-key", b"x-unifi-tenant", b"authorization") and value}
+            if b"x-unifi-api-key" in headers:
+                # An explicit key wins over a tenant name, whatever the header order
+                selection = ("key", headers[b"x-unifi-api-key"].decode("latin-1"))
+            elif b"x-unifi-tenant" in headers:
+                scheme, _, credentials = headers.get(b"authorization", b"").decode("latin-1").partition(" ")
+                bearer = credentials.strip() if scheme.lower() == "bearer" and credentials.strip() else None
+                selection = ("name", headers[b"x-unifi-tenant"].decode("latin-1"), bearer)
+        if selection is None:
+            await self.app(scope, receive, send)
+            return
+        token = _current_tenant.set(selection)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _current_tenant.reset(token)
+
+
+async def prometheus_metrics() -> Any:
+    """Expose request, cache and tool metrics in the Prometheus text format"""
+    from starlette.responses import Response
+    
+    if unifi_client:
+        CONCURRENCY_LIMIT.set((), int(unifi_client.concurrency.limit))
+        for host, breaker in unifi_client.breakers.items():
+            CIRCUIT_BREAKER_OPEN.set((host,), 1 if breaker.state == breaker.OPEN else 0)
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 # Define MCP Tool input/output models
 
+
+class ToolModel(BaseModel):
+    """Base of the tool input and output models"""
+    # Validators are built when a model is first used rather than at import, so startup
+    # doesn't pay for the models of tools that are never called
+    model_config = ConfigDict(defer_build=True)
+
+
+# Upper bound on the number of operations accepted by the batch tool
+MAX_BATCH_OPERATIONS = 100
+
+# Shared Models
+class ProjectionInput(ToolModel):
+    fields: Optional[List[str]] = Field(
+        None,
+        description="Dotted field paths to keep in each item (e.g. [\"id\", \"reportedState.hostname\"]); all fields when omitted",
+    )
+    max_items: Optional[int] = Field(None, description="Maximum number of items to return from the data list")
+
+
 # Host Management Models
-class ListHostsInput(BaseModel):
+class ListHostsInput(ProjectionInput):
+    page_size: Optional[int] = Field(None, description="Number of items to return per page")
+    next_token: Optional[str] = Field(None, description="Token for pagination to retrieve the next set of results")
+    live: bool = Field(False, description="Query the API directly instead of the inventory snapshot")
+
+
+class ListHostsOutput(ToolModel):
+    data: SkipValidation[Dict[str, Any]] = Field(..., description="Host data from API response")
+
+
+class GetHostByIdInput(ProjectionInput):
+    host_id: str = Field(..., description="Unique identifier of the host")
+    live: bool = Field(False, description="Query the API directly instead of the inventory snapshot")
+
+
+class GetHostByIdOutput(ToolModel):
+    data: SkipValidation[Dict[str, Any]] = Field(..., description="Host details")
+
+
+# Site Management Models
+class ListSitesInput(ProjectionInput):
+    page_size: Optional[int] = Field(None, description="Number of items to return per page")
+    next_token: Optional[str] = Field(None, description="Token for pagination to retrieve the next set of results")
+    live: bool = Field(False, description="Query the API directly instead of the inventory snapshot")
+
+
+class ListSitesOutput(ToolModel):
+    data: SkipValidation[Dict[str, Any]] = Field(..., description="Sites data from API response")
+
+
+# Device Management Models
+class ListDevicesInput(ProjectionInput):
+    host_ids: Optional[List[str]] = Field(None, description="List of host IDs to filter the results")
+    time: Optional[str] = Field(None, description="Last processed timestamp of devices in RFC3339 format")
+    page_size: Optional[int] = Field(None, description="Number of items to return per page")
+    next_token: Optional[str] = Field(None, description="Token for pagination to retrieve the next set of results")
+    live: bool = Field(False, description="Query the API directly instead of the inventory snapshot")
+
+
+class ListDevicesOutput(ToolModel):
+    data: SkipValidation[Dict[str, Any]] = Field(..., description="Devices data from API response")
+
+
+# ISP Metrics Models
+class GetIspMetricsInput(ProjectionInput):
+    metric_type: str = Field(..., description="Type of metrics (5m or 1h intervals)")
+    begin_timestamp: Optional[str] = Field(None, description="The earliest timestamp to retrieve data from (RFC3339 format)")
+    end_timestamp: Optional[str] = Field(None, description="The latest timestamp to retrieve data up to (RFC3339 format)")
+    duration: Optional[str] = Field(None, description="Specifies the time range of metrics to retrieve")
+    live: bool = Field(False, description="Query the API directly instead of the local metrics store")
+
+
+class GetIspMetricsOutput(ToolModel):
+    data: SkipValidation[Dict[str, Any]] = Field(..., description="ISP metrics data")
+
+
+class SummarizeIspMetricsInput(ToolModel):
+    metric_type: str = Field(..., description="Type of metrics (5m or 1h intervals)")
+    begin_timestamp: Optional[str] = Field(None, description="The earliest timestamp to summarize (RFC3339 format)")
+    end_timestamp: Optional[str] = Field(None, description="The latest timestamp to summarize (RFC3339 format)")
+    duration: Optional[str] = Field(None, description="Time range ending at end_timestamp or now, e.g. '24h' or '7d'")
+    site_ids: Optional[List[str]] = Field(None, description="Only summarize these sites")
+    metrics: Optional[List[str]] = Field(
+        None,
+        description="WAN metrics to summarize (avgLatency, maxLatency, packetLoss, download_kbps, upload_kbps, uptime, downtime); all when omitted",
+    )
+    percentiles: List[float] = Field([50, 95, 99], description="Percentiles to compute for each metric")
+    bucket: Optional[str] = Field(None, description="Also return a series downsampled to this interval, e.g. '1h' or '1d'")
+
+
+class SummarizeIspMetricsOutput(ToolModel):
+    data: SkipValidation[Dict[str, Any]] = Field(..., description="Aggregates per site and metric, and the downsampled series if requested")
+
+
+class AnalyzeIspMetricsInput(ToolModel):
+    metric_type: str = Field(..., description="Type of metrics (5m or 1h intervals)")
+    begin_timestamp: Optional[str] = Field(None, description="The earliest timestamp to analyze (RFC3339 format)")
+    end_timestamp: Optional[str] = Field(None, description="The latest timestamp to analyze (RFC3339 format)")
+    duration: Optional[str] = Field(None, description="Time range ending at end_timestamp or now, e.g. '24h' or '7d'")
+    site_ids: Optional[List[str]] = Field(None, description="Only analyze these sites")
+    metrics: Optional[List[str]] = Field(
+        None,
+        description="WAN metrics to analyze; defaults to avgLatency, packetLoss, uptime, download_kbps and upload_kbps",
+    )
+    percentiles: List[float] = Field([50, 95, 99], description="Percentiles to compute for each metric")
+    window: str = Field("1h", description="Rolling window used to find the worst sustained period, e.g. '1h'")
+    anomaly_threshold: float = Field(3.5, description="Robust z-score above which a period counts as an anomaly")
+    sort_by: str = Field("anomaly_score", description="Rank sites by 'anomaly_score' or by the average of an analyzed metric, worst first")
+    top: int = Field(20, description="Number of sites to return")
+
+
+class AnalyzeIspMetricsOutput(ToolModel):
+    data: SkipValidation[Dict[str, Any]] = Field(..., description="Fleet-wide summary and the top ranked sites")
+
+
+class QueryIspMetricsInput(ProjectionInput):
+    query_data: Dict[str, Any] = Field(..., description="Query parameters for ISP metrics")
+
+
+class QueryIspMetricsOutput(ToolModel):
+    data: SkipValidation[Dict[str, Any]] = Field(..., description="Queried ISP metrics data")
+
+
+# SD-WAN Management Models
+class ListSdwanConfigsInput(ProjectionInput):
     page_size: Optional[int] = Field(None, description="Number of items to return per page")
-    # TODO: Move Optional[str] to .env file
+    next_token: Optional[str] = Field(None, description="Token for pagination to retrieve the next set of results")
+    live: bool = Field(False, description="Query the API directly instead of the inventory snapshot")
+
 
+class ListSdwanConfigsOutput(ToolModel):
+    data: SkipValidation[Dict[str, Any]] = Field(..., description="SD-WAN configurations data")
 
-class ListHostsOutput(BaseModel):
-    data: Dict[str, Any] = Field(..., description="Host data from API response")
+
+class GetSdwanConfigByIdInput(ProjectionInput):
+    config_id: str = Field(..., description="Unique identifier of the SD-WAN configuration")
+    live: bool = Field(False, description="Query the API directly instead of the inventory snapshot")
 
 
-class GetHostByIdInput(BaseModel):
-    host_id: str = Field(..., description="Unique identifier of the host")
+class GetSdwanConfigByIdOutput(ToolModel):
+    data: SkipValidation[Dict[str, Any]] = Field(..., description="SD-WAN configuration details")
 
 
-class GetHostByIdOutput(BaseModel):
-    data: Dict[str, Any] = Field(..., description="Host details")
+class GetSdwanConfigStatusInput(ProjectionInput):
+    config_id: str = Field(..., description="Unique identifier of the SD-WAN configuration")
 
 
-# Site Management Models
-class ListSitesInput(BaseModel):
-    page_size: Optional[int] = Field(None, description="Number of items to return per page")
-    # TODO: Move Optional[str] to .env file
+class GetSdwanConfigStatusOutput(ToolModel):
+    data: SkipValidation[Dict[str, Any]] = Field(..., description="SD-WAN configuration status")
 
 
-class ListSitesOutput(BaseModel):
-    data: Dict[str, Any] = Field(..., description="Sites data from API response")
+# SD-WAN Overview Models
+class SdwanOverviewInput(ProjectionInput):
+    live: bool = Field(False, description="Skip the inventory snapshot and cached statuses")
+    max_concurrency: Optional[int] = Field(None, description="Maximum number of status requests in flight")
 
 
-# Device Management Models
-class ListDevicesInput(BaseModel):
-    host_ids: Optional[List[str]] = Field(None, description="List of host IDs to filter the results")
-    time: Optional[str] = Field(None, description="Last processed timestamp of devices in RFC3339 format")
-    page_size: Optional[int] = Field(None, description="Number of items to return per page")
-    # TODO: Move Optional[str] to .env file
+class SdwanOverviewOutput(ToolModel):
+    data: SkipValidation[Dict[str, Any]] = Field(..., description="One row per SD-WAN config with its generation status, hub/spoke counts and error/warning counts")
 
 
-class ListDevicesOutput(BaseModel):
-    data: Dict[str, Any] = Field(..., description="Devices data from API response")
+# Pagination Models
+class ListAllInput(ProjectionInput):
+    page_size: Optional[int] = Field(None, description="Number of items to request per page")
+    max_items: Optional[int] = Field(1000, description="Maximum number of items to return in total")
+    max_pages: Optional[int] = Field(None, description="Maximum number of pages to fetch")
 
 
-# ISP Metrics Models
-class GetIspMetricsInput(BaseModel):
-    metric_type: str = Field(..., description="Type of metrics (5m or 1h intervals)")
-    begin_timestamp: Optional[str] = Field(None, description="The earliest timestamp to retrieve data from (RFC3339 format)")
-    end_timestamp: Optional[str] = Field(None, description="The latest timestamp to retrieve data up to (RFC3339 format)")
-    duration: Optional[str] = Field(None, description="Specifies the time range of metrics to retrieve")
+class ListDevicesAllInput(ListAllInput):
+    host_ids: Optional[List[str]] = Field(None, description="List of host IDs to filter the results")
+    time: Optional[str] = Field(None, description="Last processed timestamp of devices in RFC3339 format")
+    fan_out: bool = Field(False, description="Fetch shards of host IDs concurrently instead of paging through one combined result")
+    shard_size: Optional[int] = Field(None, description="Number of host IDs per shard in fan-out mode")
 
 
-class GetIspMetricsOutput(BaseModel):
-    data: Dict[str, Any] = Field(..., description="ISP metrics data")
+class ListAllOutput(ToolModel):
+    data: SkipValidation[List[Dict[str, Any]]] = Field(..., description="Items aggregated across all fetched pages")
+    count: int = Field(..., description="Number of items returned")
+    truncated: bool = Field(..., description="Whether more items were available beyond max_items")
 
 
-class QueryIspMetricsInput(BaseModel):
-    query_data: Dict[str, Any] = Field(..., description="Query parameters for ISP metrics")
+# Inventory Query Models
+class QueryInventoryInput(ToolModel):
+    target: str = Field("devices", description="What to query: 'devices' or 'hosts'")
+    filters: Dict[str, Any] = Field(
+        default_factory=dict,
+        description="Field filters, e.g. {\"status\": \"offline\", \"model\": [\"U6-LR\", \"U6-Pro\"]}. "
+                    "Values may be lists or glob patterns; dotted paths reach nested fields",
+    )
+    group_by: Optional[str] = Field(None, description="Field to group matches by, returning a count per value (e.g. 'site', 'firmware')")
+    fields: Optional[List[str]] = Field(None, description="Fields to return for each match")
+    count_only: bool = Field(False, description="Only return the number of matches")
+    limit: int = Field(100, description="Maximum number of matches to return")
 
 
-class QueryIspMetricsOutput(BaseModel):
-    data: Dict[str, Any] = Field(..., description="Queried ISP metrics data")
+class QueryInventoryOutput(ToolModel):
+    total: int = Field(..., description="Number of matching records")
+    groups: Optional[Dict[str, int]] = Field(None, description="Count of matches per group_by value")
+    data: SkipValidation[Optional[List[Dict[str, Any]]]] = Field(None, description="Matching records, projected to the requested fields")
 
 
-# SD-WAN Management Models
-class ListSdwanConfigsInput(BaseModel):
-    page_size: Optional[int] = Field(None, description="Number of items to return per page")
-    # TODO: Move Optional[str] to .env file
+# Client Status Models
+class GetClientStatusInput(ToolModel):
+    pass
 
 
-class ListSdwanConfigsOutput(BaseModel):
-    data: Dict[str, Any] = Field(..., description="SD-WAN configurations data")
+class GetClientStatusOutput(ToolModel):
+    cache: Dict[str, Any] = Field(..., description="Response cache hit/miss counters")
+    single_flight: Dict[str, Any] = Field(..., description="Request coalescing counters")
+    rate_limit: Dict[str, Any] = Field(..., description="Rate limiter budgets and throttling counters")
+    concurrency: Dict[str, Any] = Field(..., description="Adaptive concurrency limit")
+    retries: int = Field(..., description="Number of upstream requests retried")
+    circuit_breakers: Dict[str, Any] = Field(..., description="Circuit breaker state per upstream host")
+    site_index: Dict[str, Any] = Field(..., description="Site to host index used by get_devices")
+    inventory: Dict[str, Any] = Field(..., description="Background inventory snapshot state")
+    metrics_store: Dict[str, Any] = Field(..., description="Local ISP metrics store contents and fetched ranges")
+    tracing: Dict[str, Any] = Field(..., description="Tracing exporter and number of exported spans")
+    tenant: Optional[str] = Field(None, description="Identifier of the tenant served by this client; null for the default account")
+    tenants: Optional[Dict[str, Any]] = Field(None, description="Per-tenant client registry, once a tenant has been served")
 
 
-class GetSdwanConfigByIdInput(BaseModel):
-    config_id: str = Field(..., description="Unique identifier of the SD-WAN configuration")
+# Batch Models
+class BatchOperation(ToolModel):
+    tool: str = Field(..., description="Name of the tool to call, e.g. 'get_sdwan_config_status'")
+    input: Dict[str, Any] = Field(default_factory=dict, description="Input for the tool, exactly as the tool itself accepts it")
 
 
-class GetSdwanConfigByIdOutput(BaseModel):
-    data: Dict[str, Any] = Field(..., description="SD-WAN configuration details")
+class BatchInput(ToolModel):
+    operations: List[BatchOperation] = Field(..., description=f"Tool calls to run concurrently (at most {MAX_BATCH_OPERATIONS})")
+    max_concurrency: int = Field(10, description="Maximum number of operations running at the same time")
 
 
-class GetSdwanConfigStatusInput(BaseModel):
-    config_id: str = Field(..., description="Unique identifier of the SD-WAN configuration")
+class BatchResult(ToolModel):
+    tool: str = Field(..., description="Name of the tool that was called")
+    ok: bool = Field(..., description="Whether the call succeeded")
+    data: SkipValidation[Any] = Field(None, description="Output of the tool when the call succeeded")
+    error: Optional[str] = Field(None, description="Error message when the call failed")
+    status_code: Optional[int] = Field(None, description="HTTP status code of the error")
+    headers: Optional[Dict[str, str]] = Field(None, description="Headers of the error, e.g. Retry-After for a 429")
 
 
-class GetSdwanConfigStatusOutput(BaseModel):
-    data: Dict[str, Any] = Field(..., description="SD-WAN configuration status")
+class BatchOutput(ToolModel):
+    results: List[BatchResult] = Field(..., description="One result per operation, in request order")
+    succeeded: int = Field(..., description="Number of operations that succeeded")
+    failed: int = Field(..., description="Number of operations that failed")
 
 
 # Legacy Models (for backward compatibility)
-class GetSitesInput(BaseModel):
+class GetSitesInput(ProjectionInput):
     pass
 
 
-class GetSitesOutput(BaseModel):
-    sites: List[Dict[str, Any]] = Field(..., description="List of Unifi sites")
+class GetSitesOutput(ToolModel):
+    sites: SkipValidation[List[Dict[str, Any]]] = Field(..., description="List of Unifi sites")
 
 
-class GetDevicesInput(BaseModel):
+class GetDevicesInput(ProjectionInput):
     site_id: str = Field(..., description="ID of the site to get devices for")
 
 
-class GetDevicesOutput(BaseModel):
-    devices: List[Dict[str, Any]] = Field(
+class GetDevicesOutput(ToolModel):
+    devices: SkipValidation[List[Dict[str, Any]]] = Field(
         ...,
         description="List of devices for the specified site"
     )
 
 
-class GetClientsInput(BaseModel):
+class GetClientsInput(ToolModel):
     site_id: str = Field(..., description="ID of the site to get clients for")
 
 
-class GetClientsOutput(BaseModel):
-    clients: List[Dict[str, Any]] = Field(
+class GetClientsOutput(ToolModel):
+    clients: SkipValidation[List[Dict[str, Any]]] = Field(
         ...,
         description="List of clients for the specified site"
     )
@@ -343,15 +3697,21 @@ class GetClientsOutput(BaseModel):
 )
 async def list_hosts(input: ListHostsInput) -> ListHostsOutput:
     """Get a list of all hosts associated with the UI account"""
-    if not unifi_client:
+    client = current_client()
+    if not client:
         raise HTTPException(
             status_code=500,
             detail="Unifi client not initialized"
         )
     
     try:
-        # TODO: Move data to .env file
-        return ListHostsOutput(data=data)
+        data = None if input.live or input.page_size or input.next_token else client.inventory.list_hosts()
+        if data is None:
+            data = await client.list_hosts(input.page_size, input.next_token)
+        return ListHostsOutput(data=shape_response(data, input.fields, input.max_items))
+    except HTTPException:
+        # Keep the status (429, the circuit breaker's 503) and Retry-After of client errors
+        raise
     except Exception as e:
         logger.error(f"Error listing hosts: {e}")
         raise HTTPException(
@@ -368,15 +3728,20 @@ async def list_hosts(input: ListHostsInput) -> ListHostsOutput:
 )
 async def get_host_by_id(input: GetHostByIdInput) -> GetHostByIdOutput:
     """Get detailed information about a specific host by ID"""
-    if not unifi_client:
+    client = current_client()
+    if not client:
         raise HTTPException(
             status_code=500,
             detail="Unifi client not initialized"
         )
     
     try:
-        data = await unifi_client.get_host_by_id(input.host_id)
-        return GetHostByIdOutput(data=data)
+        data = None if input.live else client.inventory.get_host(input.host_id)
+        if data is None:
+            data = await client.get_host_by_id(input.host_id)
+        return GetHostByIdOutput(data=shape_response(data, input.fields, input.max_items))
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error getting host by ID: {e}")
         raise HTTPException(
@@ -394,15 +3759,20 @@ async def get_host_by_id(input: GetHostByIdInput) -> GetHostByIdOutput:
 )
 async def list_sites(input: ListSitesInput) -> ListSitesOutput:
     """Get a list of all sites from hosts running the UniFi Network application"""
-    if not unifi_client:
+    client = current_client()
+    if not client:
         raise HTTPException(
             status_code=500,
             detail="Unifi client not initialized"
         )
     
     try:
-        # TODO: Move data to .env file
-        return ListSitesOutput(data=data)
+        data = None if input.live or input.page_size or input.next_token else client.inventory.list_sites()
+        if data is None:
+            data = await client.list_sites(input.page_size, input.next_token)
+        return ListSitesOutput(data=shape_response(data, input.fields, input.max_items))
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error listing sites: {e}")
         raise HTTPException(
@@ -420,17 +3790,24 @@ async def list_sites(input: ListSitesInput) -> ListSitesOutput:
 )
 async def list_devices(input: ListDevicesInput) -> ListDevicesOutput:
     """Get a list of UniFi devices managed by hosts"""
-    if not unifi_client:
+    client = current_client()
+    if not client:
         raise HTTPException(
             status_code=500,
             detail="Unifi client not initialized"
         )
     
     try:
-        data = await unifi_client.list_devices(
-            input.host_ids, input.time, input.page_size, input.next_token
-        )
-        return ListDevicesOutput(data=data)
+        data = None
+        if not (input.live or input.time or input.page_size or input.next_token):
+            data = client.inventory.list_devices(input.host_ids)
+        if data is None:
+            data = await client.list_devices(
+                input.host_ids, input.time, input.page_size, input.next_token
+            )
+        return ListDevicesOutput(data=shape_response(data, input.fields, input.max_items))
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error listing devices: {e}")
         raise HTTPException(
@@ -448,18 +3825,27 @@ async def list_devices(input: ListDevicesInput) -> ListDevicesOutput:
 )
 async def get_isp_metrics(input: GetIspMetricsInput) -> GetIspMetricsOutput:
     """Get ISP metrics data for all sites linked to the UI account's API key"""
-    if not unifi_client:
+    client = current_client()
+    if not client:
         raise HTTPException(
             status_code=500,
             detail="Unifi client not initialized"
         )
     
     try:
-        data = await unifi_client.get_isp_metrics(
-            input.metric_type, input.begin_timestamp,
-            input.end_timestamp, input.duration
-        )
-        return GetIspMetricsOutput(data=data)
+        if client.metrics_store_enabled and not input.live and input.metric_type in METRIC_STEPS:
+            data = await client.get_isp_metrics_stored(
+                input.metric_type, input.begin_timestamp,
+                input.end_timestamp, input.duration
+            )
+        else:
+            data = await client.get_isp_metrics(
+                input.metric_type, input.begin_timestamp,
+                input.end_timestamp, input.duration
+            )
+        return GetIspMetricsOutput(data=shape_response(data, input.fields, input.max_items))
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error getting ISP metrics: {e}")
         raise HTTPException(
@@ -476,15 +3862,18 @@ async def get_isp_metrics(input: GetIspMetricsInput) -> GetIspMetricsOutput:
 )
 async def query_isp_metrics(input: QueryIspMetricsInput) -> QueryIspMetricsOutput:
     """Query ISP metrics data based on specific query parameters"""
-    if not unifi_client:
+    client = current_client()
+    if not client:
         raise HTTPException(
             status_code=500,
             detail="Unifi client not initialized"
         )
     
     try:
-        data = await unifi_client.query_isp_metrics(input.query_data)
-        return QueryIspMetricsOutput(data=data)
+        data = await client.query_isp_metrics(input.query_data)
+        return QueryIspMetricsOutput(data=shape_response(data, input.fields, input.max_items))
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error querying ISP metrics: {e}")
         raise HTTPException(
@@ -493,6 +3882,79 @@ async def query_isp_metrics(input: QueryIspMetricsInput) -> QueryIspMetricsOutpu
         )
 
 
+@mcp_server.tool(
+    "summarize_isp_metrics",
+    SummarizeIspMetricsInput,
+    SummarizeIspMetricsOutput,
+    "Summarize ISP metrics per site (min/max/avg/percentiles) and optionally downsample them, answered from the local metrics store"
+)
+async def summarize_isp_metrics(input: SummarizeIspMetricsInput) -> SummarizeIspMetricsOutput:
+    """Summarize ISP metrics per site from the local metrics store"""
+    client = current_client()
+    if not client:
+        raise HTTPException(
+            status_code=500,
+            detail="Unifi client not initialized"
+        )
+    if input.metric_type not in METRIC_STEPS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown metric type: {input.metric_type}"
+        )
+    
+    try:
+        data = await client.summarize_isp_metrics(
+            input.metric_type, input.begin_timestamp, input.end_timestamp, input.duration,
+            input.site_ids, input.metrics, input.percentiles, input.bucket
+        )
+        return SummarizeIspMetricsOutput(data=data)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error summarizing ISP metrics: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error summarizing ISP metrics: {str(e)}"
+        )
+
+
+@mcp_server.tool(
+    "analyze_isp_metrics",
+    AnalyzeIspMetricsInput,
+    AnalyzeIspMetricsOutput,
+    "Analyze ISP metrics across sites: aggregates, percentiles, worst rolling windows and anomaly scores, returning only a compact ranked summary"
+)
+async def analyze_isp_metrics(input: AnalyzeIspMetricsInput) -> AnalyzeIspMetricsOutput:
+    """Analyze ISP metrics across sites from the local metrics store"""
+    client = current_client()
+    if not client:
+        raise HTTPException(
+            status_code=500,
+            detail="Unifi client not initialized"
+        )
+    if input.metric_type not in METRIC_STEPS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown metric type: {input.metric_type}"
+        )
+    
+    try:
+        data = await client.analyze_isp_metrics(
+            input.metric_type, input.begin_timestamp, input.end_timestamp, input.duration,
+            input.site_ids, input.metrics, input.percentiles, input.window,
+            input.anomaly_threshold, input.sort_by, input.top
+        )
+        return AnalyzeIspMetricsOutput(data=data)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error analyzing ISP metrics: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error analyzing ISP metrics: {str(e)}"
+        )
+
+
 # SD-WAN Management Tools
 @mcp_server.tool(
     "list_sdwan_configs",
@@ -502,15 +3964,20 @@ async def query_isp_metrics(input: QueryIspMetricsInput) -> QueryIspMetricsOutpu
 )
 async def list_sdwan_configs(input: ListSdwanConfigsInput) -> ListSdwanConfigsOutput:
     """Get a list of all SD-WAN configurations"""
-    if not unifi_client:
+    client = current_client()
+    if not client:
         raise HTTPException(
             status_code=500,
             detail="Unifi client not initialized"
         )
     
     try:
-        # TODO: Move data to .env file
-        return ListSdwanConfigsOutput(data=data)
+        data = None if input.live or input.page_size or input.next_token else client.inventory.list_sdwan_configs()
+        if data is None:
+            data = await client.list_sdwan_configs(input.page_size, input.next_token)
+        return ListSdwanConfigsOutput(data=shape_response(data, input.fields, input.max_items))
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error listing SD-WAN configs: {e}")
         raise HTTPException(
@@ -527,15 +3994,20 @@ async def list_sdwan_configs(input: ListSdwanConfigsInput) -> ListSdwanConfigsOu
 )
 async def get_sdwan_config_by_id(input: GetSdwanConfigByIdInput) -> GetSdwanConfigByIdOutput:
     """Get detailed information about a specific SD-WAN configuration by ID"""
-    if not unifi_client:
+    client = current_client()
+    if not client:
         raise HTTPException(
             status_code=500,
             detail="Unifi client not initialized"
         )
     
     try:
-        data = await unifi_client.get_sdwan_config_by_id(input.config_id)
-        return GetSdwanConfigByIdOutput(data=data)
+        data = None if input.live else client.inventory.get_sdwan_config(input.config_id)
+        if data is None:
+            data = await client.get_sdwan_config_by_id(input.config_id)
+        return GetSdwanConfigByIdOutput(data=shape_response(data, input.fields, input.max_items))
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error getting SD-WAN config by ID: {e}")
         raise HTTPException(
@@ -552,15 +4024,18 @@ async def get_sdwan_config_by_id(input: GetSdwanConfigByIdInput) -> GetSdwanConf
 )
 async def get_sdwan_config_status(input: GetSdwanConfigStatusInput) -> GetSdwanConfigStatusOutput:
     """Get the status of a specific SD-WAN configuration"""
-    if not unifi_client:
+    client = current_client()
+    if not client:
         raise HTTPException(
             status_code=500,
             detail="Unifi client not initialized"
         )
     
     try:
-        data = await unifi_client.get_sdwan_config_status(input.config_id)
-        return GetSdwanConfigStatusOutput(data=data)
+        data = await client.get_sdwan_config_status(input.config_id)
+        return GetSdwanConfigStatusOutput(data=shape_response(data, input.fields, input.max_items))
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error getting SD-WAN config status: {e}")
         raise HTTPException(
@@ -569,6 +4044,247 @@ async def get_sdwan_config_status(input: GetSdwanConfigStatusInput) -> GetSdwanC
         )
 
 
+@mcp_server.tool(
+    "sdwan_overview",
+    SdwanOverviewInput,
+    SdwanOverviewOutput,
+    "Get all SD-WAN configurations together with their status in one compact table"
+)
+async def sdwan_overview(input: SdwanOverviewInput) -> SdwanOverviewOutput:
+    """Get all SD-WAN configurations together with their status"""
+    client = current_client()
+    if not client:
+        raise HTTPException(
+            status_code=500,
+            detail="Unifi client not initialized"
+        )
+    
+    try:
+        data = await client.sdwan_overview(input.max_concurrency, input.live)
+        return SdwanOverviewOutput(data=shape_response(data, input.fields, input.max_items))
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error getting SD-WAN overview: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error getting SD-WAN overview: {str(e)}"
+        )
+
+
+# Pagination Tools
+async def _collect_all(iterator_factory: Callable[..., AsyncIterator[Dict[str, Any]]],
+                       input: ListAllInput, **kwargs) -> ListAllOutput:
+    """Aggregate a pagination iterator into a single tool response"""
+    # Fetch one extra item so we can tell whether the result was truncated
+    limit = input.max_items + 1 if input.max_items is not None else None
+    items = []
+    tree = projection_tree(input.fields) if input.fields else None
+    async for item in iterator_factory(
+        page_size=input.page_size, max_items=limit, max_pages=input.max_pages, **kwargs
+    ):
+        # Project each item as it arrives so full objects are not kept around
+        items.append(project(item, tree))
+    truncated = input.max_items is not None and len(items) > input.max_items
+    if truncated:
+        items = items[:input.max_items]
+    return ListAllOutput(data=items, count=len(items), truncated=truncated)
+
+
+@mcp_server.tool(
+    "list_hosts_all",
+    ListAllInput,
+    ListAllOutput,
+    "Get all hosts associated with the UI account, following pagination automatically"
+)
+async def list_hosts_all(input: ListAllInput) -> ListAllOutput:
+    """Get all hosts associated with the UI account, following pagination automatically"""
+    client = current_client()
+    if not client:
+        raise HTTPException(
+            status_code=500,
+            detail="Unifi client not initialized"
+        )
+    
+    try:
+        return await _collect_all(client.iter_hosts, input)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error listing all hosts: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error listing all hosts: {str(e)}"
+        )
+
+
+@mcp_server.tool(
+    "list_sites_all",
+    ListAllInput,
+    ListAllOutput,
+    "Get all sites from hosts running the UniFi Network application, following pagination automatically"
+)
+async def list_sites_all(input: ListAllInput) -> ListAllOutput:
+    """Get all sites, following pagination automatically"""
+    client = current_client()
+    if not client:
+        raise HTTPException(
+            status_code=500,
+            detail="Unifi client not initialized"
+        )
+    
+    try:
+        return await _collect_all(client.iter_sites, input)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error listing all sites: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error listing all sites: {str(e)}"
+        )
+
+
+@mcp_server.tool(
+    "list_devices_all",
+    ListDevicesAllInput,
+    ListAllOutput,
+    "Get all UniFi devices managed by hosts, following pagination automatically"
+)
+async def list_devices_all(input: ListDevicesAllInput) -> ListAllOutput:
+    """Get all UniFi devices managed by hosts, following pagination automatically"""
+    client = current_client()
+    if not client:
+        raise HTTPException(
+            status_code=500,
+            detail="Unifi client not initialized"
+        )
+    
+    try:
+        if input.fan_out:
+            result = await client.list_devices_fanout(
+                input.host_ids, input.time, input.page_size,
+                shard_size=input.shard_size, max_pages=input.max_pages,
+            )
+            items = result["data"]
+            truncated = input.max_items is not None and len(items) > input.max_items
+            items = shape_response(items, input.fields, input.max_items)
+            return ListAllOutput(data=items, count=len(items), truncated=truncated)
+        return await _collect_all(
+            client.iter_devices, input, host_ids=input.host_ids, time=input.time
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error listing all devices: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error listing all devices: {str(e)}"
+        )
+
+
+@mcp_server.tool(
+    "list_sdwan_configs_all",
+    ListAllInput,
+    ListAllOutput,
+    "Get all SD-WAN configurations, following pagination automatically"
+)
+async def list_sdwan_configs_all(input: ListAllInput) -> ListAllOutput:
+    """Get all SD-WAN configurations, following pagination automatically"""
+    client = current_client()
+    if not client:
+        raise HTTPException(
+            status_code=500,
+            detail="Unifi client not initialized"
+        )
+    
+    try:
+        return await _collect_all(client.iter_sdwan_configs, input)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error listing all SD-WAN configs: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error listing all SD-WAN configs: {str(e)}"
+        )
+
+
+# Inventory Query Tools
+@mcp_server.tool(
+    "query_inventory",
+    QueryInventoryInput,
+    QueryInventoryOutput,
+    "Filter, group and count devices or hosts from the local inventory, e.g. offline devices by site or a firmware version histogram"
+)
+async def query_inventory(input: QueryInventoryInput) -> QueryInventoryOutput:
+    """Filter, group and count devices or hosts from the local inventory"""
+    client = current_client()
+    if not client:
+        raise HTTPException(
+            status_code=500,
+            detail="Unifi client not initialized"
+        )
+    if input.target not in ("devices", "hosts"):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown query target: {input.target}"
+        )
+    
+    try:
+        inventory = await client.inventory.queryable()
+        index = inventory.device_index() if input.target == "devices" else inventory.host_index()
+        matches = index.filter(input.filters)
+        output = QueryInventoryOutput(total=len(matches))
+        if input.group_by:
+            output.groups = RecordIndex.group_counts(matches, input.group_by)
+        elif not input.count_only:
+            fields = input.fields or (DEFAULT_DEVICE_FIELDS if input.target == "devices" else None)
+            matches = matches[:input.limit]
+            output.data = [RecordIndex.project(record, fields) for record in matches] if fields else matches
+        return output
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error querying inventory: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error querying inventory: {str(e)}"
+        )
+
+
+# Client Status Tools
+@mcp_server.tool(
+    "get_client_status",
+    GetClientStatusInput,
+    GetClientStatusOutput,
+    "Get internal status of the Unifi client: cache, rate limiting, retries and circuit breakers"
+)
+async def get_client_status(input: GetClientStatusInput) -> GetClientStatusOutput:
+    """Get internal status of the Unifi client"""
+    client = current_client()
+    if not client:
+        raise HTTPException(
+            status_code=500,
+            detail="Unifi client not initialized"
+        )
+    
+    return GetClientStatusOutput(
+        cache=client.cache_stats(),
+        single_flight=client.single_flight.stats(),
+        rate_limit=client.rate_limiter.stats(),
+        concurrency=client.concurrency.stats(),
+        retries=client.retries,
+        circuit_breakers=client.breaker_stats(),
+        site_index=client.site_index.stats(),
+        inventory=client.inventory.stats(),
+        metrics_store={"enabled": client.metrics_store_enabled, **client.metrics_store.stats()},
+        tracing=tracer.stats(),
+        tenant=tenant_id(client.api_key) if client is not unifi_client else None,
+        tenants=tenant_clients.stats() if tenant_clients else None,
+    )
+
+
 # Legacy Tools (for backward compatibility)
 @mcp_server.tool(
     "get_sites",
@@ -578,15 +4294,18 @@ async def get_sdwan_config_status(input: GetSdwanConfigStatusInput) -> GetSdwanC
 )
 async def get_sites(input: GetSitesInput) -> GetSitesOutput:
     """Get a list of all Unifi sites (legacy method)"""
-    if not unifi_client:
+    client = current_client()
+    if not client:
         raise HTTPException(
             status_code=500,
             detail="Unifi client not initialized"
         )
     
     try:
-        sites = await unifi_client.get_sites()
-        return GetSitesOutput(sites=sites)
+        sites = await client.get_sites()
+        return GetSitesOutput(sites=shape_response(sites, input.fields, input.max_items))
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error getting sites: {e}")
         raise HTTPException(
@@ -603,15 +4322,18 @@ async def get_sites(input: GetSitesInput) -> GetSitesOutput:
 )
 async def get_devices(input: GetDevicesInput) -> GetDevicesOutput:
     """Get a list of devices for a specific site (legacy method)"""
-    if not unifi_client:
+    client = current_client()
+    if not client:
         raise HTTPException(
             status_code=500,
             detail="Unifi client not initialized"
         )
     
     try:
-        devices = await unifi_client.get_devices(input.site_id)
-        return GetDevicesOutput(devices=devices)
+        devices = await client.get_devices(input.site_id)
+        return GetDevicesOutput(devices=shape_response(devices, input.fields, input.max_items))
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error getting devices: {e}")
         raise HTTPException(
@@ -628,15 +4350,18 @@ async def get_devices(input: GetDevicesInput) -> GetDevicesOutput:
 )
 async def get_clients(input: GetClientsInput) -> GetClientsOutput:
     """Get a list of clients for a specific site (legacy method)"""
-    if not unifi_client:
+    client = current_client()
+    if not client:
         raise HTTPException(
             status_code=500,
             detail="Unifi client not initialized"
         )
     
     try:
-        clients = await unifi_client.get_clients(input.site_id)
+        clients = await client.get_clients(input.site_id)
         return GetClientsOutput(clients=clients)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error getting clients: {e}")
         raise HTTPException(
@@ -645,19 +4370,104 @@ async def get_clients(input: GetClientsInput) -> GetClientsOutput:
         )
 
 
+# Batch Tools
+# Tools that can be called through the batch tool, with their input models
+BATCH_TOOLS: Dict[str, Tuple[type, Callable[[Any], Awaitable[BaseModel]]]] = {
+    "list_hosts": (ListHostsInput, list_hosts),
+    "get_host_by_id": (GetHostByIdInput, get_host_by_id),
+    "list_sites": (ListSitesInput, list_sites),
+    "list_devices": (ListDevicesInput, list_devices),
+    "get_isp_metrics": (GetIspMetricsInput, get_isp_metrics),
+    "query_isp_metrics": (QueryIspMetricsInput, query_isp_metrics),
+    "summarize_isp_metrics": (SummarizeIspMetricsInput, summarize_isp_metrics),
+    "analyze_isp_metrics": (AnalyzeIspMetricsInput, analyze_isp_metrics),
+    "list_sdwan_configs": (ListSdwanConfigsInput, list_sdwan_configs),
+    "get_sdwan_config_by_id": (GetSdwanConfigByIdInput, get_sdwan_config_by_id),
+    "get_sdwan_config_status": (GetSdwanConfigStatusInput, get_sdwan_config_status),
+    "sdwan_overview": (SdwanOverviewInput, sdwan_overview),
+    "list_hosts_all": (ListAllInput, list_hosts_all),
+    "list_sites_all": (ListAllInput, list_sites_all),
+    "list_devices_all": (ListDevicesAllInput, list_devices_all),
+    "list_sdwan_configs_all": (ListAllInput, list_sdwan_configs_all),
+    "query_inventory": (QueryInventoryInput, query_inventory),
+    "get_client_status": (GetClientStatusInput, get_client_status),
+    "get_sites": (GetSitesInput, get_sites),
+    "get_devices": (GetDevicesInput, get_devices),
+    "get_clients": (GetClientsInput, get_clients),
+}
+
+
+async def _run_batch_operation(operation: BatchOperation, semaphore: asyncio.Semaphore) -> BatchResult:
+    """Validate and run one batch operation, turning failures into an error result"""
+    entry = BATCH_TOOLS.get(operation.tool)
+    if entry is None:
+        error = f"Unknown tool: {operation.tool}"
+    else:
+        input_model, tool = entry
+        try:
+            tool_input = input_model.model_validate(operation.input)
+            error = None
+        except ValidationError as e:
+            error = str(e)
+    if error is not None:
+        trace_rejected_tool_call(operation.tool, HTTPException(status_code=400, detail=error))
+        return BatchResult(tool=operation.tool, ok=False, error=error, status_code=400)
+    
+    async with semaphore:
+        try:
+            return BatchResult(tool=operation.tool, ok=True, data=await tool(tool_input))
+        except HTTPException as e:
+            return BatchResult(tool=operation.tool, ok=False, error=str(e.detail), status_code=e.status_code,
+                               headers=dict(e.headers) if e.headers else None)
+        except Exception as e:
+            return BatchResult(tool=operation.tool, ok=False, error=str(e), status_code=500)
+
+
+@mcp_server.tool(
+    "batch",
+    BatchInput,
+    BatchOutput,
+    "Run many tool calls (e.g. get_sdwan_config_status for several configs) concurrently and return all results in one response"
+)
+async def batch(input: BatchInput) -> BatchOutput:
+    """Run many tool calls concurrently through the shared client"""
+    client = current_client()
+    if not client:
+        raise HTTPException(
+            status_code=500,
+            detail="Unifi client not initialized"
+        )
+    if len(input.operations) > MAX_BATCH_OPERATIONS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many operations: {len(input.operations)} (at most {MAX_BATCH_OPERATIONS})"
+        )
+    
+    # Upstream requests still go through the client's rate limiter and adaptive concurrency limit
+    semaphore = asyncio.Semaphore(max(1, input.max_concurrency))
+    results = await asyncio.gather(*(_run_batch_operation(operation, semaphore) for operation in input.operations))
+    succeeded = sum(1 for result in results if result.ok)
+    return BatchOutput(results=results, succeeded=succeeded, failed=len(results) - succeeded)
+
+
 # Define MCP Resources
 @mcp_server.resource("unifi://hosts")
 async def resource_hosts():
     """Resource for accessing Unifi hosts"""
-    if not unifi_client:
+    client = current_client()
+    if not client:
         raise HTTPException(
             status_code=500,
             detail="Unifi client not initialized"
         )
     
     try:
-        hosts = await unifi_client.list_hosts()
+        hosts = client.inventory.list_hosts()
+        if hosts is None:
+            hosts = await client.list_hosts()
         return hosts
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error accessing hosts resource: {e}")
         raise HTTPException(
@@ -669,15 +4479,20 @@ async def resource_hosts():
 @mcp_server.resource("unifi://sites")
 async def resource_sites():
     """Resource for accessing Unifi sites"""
-    if not unifi_client:
+    client = current_client()
+    if not client:
         raise HTTPException(
             status_code=500,
             detail="Unifi client not initialized"
         )
     
     try:
-        sites = await unifi_client.list_sites()
+        sites = client.inventory.list_sites()
+        if sites is None:
+            sites = await client.list_sites()
         return sites
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error accessing sites resource: {e}")
         raise HTTPException(
@@ -689,15 +4504,20 @@ async def resource_sites():
 @mcp_server.resource("unifi://devices")
 async def resource_devices():
     """Resource for accessing Unifi devices"""
-    if not unifi_client:
+    client = current_client()
+    if not client:
         raise HTTPException(
             status_code=500,
             detail="Unifi client not initialized"
         )
     
     try:
-        devices = await unifi_client.list_devices()
+        devices = client.inventory.list_devices()
+        if devices is None:
+            devices = await client.list_devices()
         return devices
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error accessing devices resource: {e}")
         raise HTTPException(
@@ -709,15 +4529,20 @@ async def resource_devices():
 @mcp_server.resource("unifi://sdwan-configs")
 async def resource_sdwan_configs():
     """Resource for accessing SD-WAN configurations"""
-    if not unifi_client:
+    client = current_client()
+    if not client:
         raise HTTPException(
             status_code=500,
             detail="Unifi client not initialized"
         )
     
     try:
-        configs = await unifi_client.list_sdwan_configs()
+        configs = client.inventory.list_sdwan_configs()
+        if configs is None:
+            configs = await client.list_sdwan_configs()
         return configs
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error accessing SD-WAN configs resource: {e}")
         raise HTTPException(
@@ -725,7 +4550,391 @@ async def resource_sdwan_configs():
             detail=f"Error accessing SD-WAN configs resource: {str(e)}"
         )
 
+# MCP transport
+# The protocol, sessions and both transports (stdio and streamable HTTP) come from the mcp SDK, which
+# runs every request as its own task, so parallel tool calls from one client don't wait for each
+# other, and cancels a request on notifications/cancelled. The SDK is only imported once a transport
+# is started. MCPDispatcher adds the limits on concurrent and pending work on top
+
+SERVER_VERSION = "1.0.0"
+SERVER_INSTRUCTIONS = "MCP Server for Unifi Site Manager API integration"
+# JSON-RPC error code of requests refused because too many are in progress
+MCP_SERVER_BUSY = -32000
+
+
+class ServerBusyError(HTTPException):
+    """Raised for MCP requests beyond max_pending"""
+    
+    def __init__(self):
+        super().__init__(status_code=503, detail="Server busy: too many requests in flight", headers={"Retry-After": "1"})
+
+
+class MCPDispatcher:
+    """Runs the tools and resources of a ToolRegistry for the MCP SDK server and the REST routes.
+    
+    At most max_in_flight tool calls and resource reads run at once; the others wait for a slot.
+    Beyond max_pending in progress, new ones are refused as busy (over stdio, BackpressureStreams
+    stops reading before that).
+    """
+    
+    def __init__(self, registry: ToolRegistry, max_in_flight: int = 16, max_pending: int = 256):
+        self.registry = registry
+        self.max_in_flight = max_in_flight
+        self.max_pending = max_pending
+        self.pending = 0
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._tool_list: Optional[List[Dict[str, Any]]] = None
+        self.handled = 0
+        self.cancelled = 0
+        self.rejected = 0
+    
+    async def _run(self, func: Callable[..., Awaitable[Any]], *args: Any) -> Any:
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise ServerBusyError()
+        self.pending += 1
+        self.handled += 1
+        try:
+            async with self._slots:
+                return await func(*args)
+        except asyncio.CancelledError:
+            # notifications/cancelled, a closed session or shutdown
+            self.cancelled += 1
+            raise
+        finally:
+            self.pending -= 1
+    
+    def tool_list(self) -> List[Dict[str, Any]]:
+        """Tool names, descriptions and input schemas, built once"""
+        if self._tool_list is None:
+            self._tool_list = [
+                {"name": name, "description": description, "inputSchema": input_model.model_json_schema()}
+                for name, (input_model, _, description, _) in self.registry.tools.items()
+            ]
+        return self._tool_list
+    
+    def validate(self, name: Any, arguments: Dict[str, Any]) -> Tuple[Callable[[Any], Awaitable[Any]], Any]:
+        """Return a tool's handler and validated input, raising HTTPException (404 or 400) if there is none"""
+        entry = self.registry.tools.get(name)
+        if entry is None:
+            error = HTTPException(status_code=404, detail=f"Unknown tool: {name}")
+        else:
+            input_model, _, _, handler = entry
+            try:
+                return handler, input_model.model_validate(arguments)
+            except ValidationError as e:
+                error = HTTPException(status_code=400, detail=f"Invalid arguments for {name}: {e}")
+        trace_rejected_tool_call(name, error)
+        raise error
+    
+    async def call_tool(self, name: Any, arguments: Dict[str, Any]) -> Any:
+        """Validate the arguments and run a tool, raising HTTPException if it fails"""
+        handler, tool_input = self.validate(name, arguments)
+        return await self._run(handler, tool_input)
+    
+    async def read_resource(self, uri: Any) -> Any:
+        func = self.registry.resources.get(uri)
+        if func is None:
+            raise HTTPException(status_code=404, detail=f"Unknown resource: {uri}")
+        return await self._run(call_with_tenant_client, func)
+    
+    def create_server(self) -> Any:
+        """Build the mcp SDK server answering tools and resources requests with this dispatcher"""
+        import mcp_types as types
+        from mcp.server.lowlevel import Server
+        from mcp.shared.exceptions import MCPError
+        
+        def protocol_error(e: HTTPException) -> Exception:
+            if isinstance(e, ServerBusyError):
+                return MCPError(MCP_SERVER_BUSY, e.detail)
+            if e.status_code in (400, 404):
+                return MCPError(types.INVALID_PARAMS, e.detail)
+            return MCPError(types.INTERNAL_ERROR, f"{e.status_code}: {e.detail}")
+        
+        async def list_tools(ctx: Any, params: Any) -> Any:
+            return types.ListToolsResult(tools=[
+                types.Tool(name=tool["name"], description=tool["description"], input_schema=tool["inputSchema"])
+                for tool in self.tool_list()
+            ])
+        
+        async def call_tool(ctx: Any, params: Any) -> Any:
+            try:
+                handler, tool_input = self.validate(params.name, params.arguments or {})
+            except HTTPException as e:
+                raise protocol_error(e) from e
+            try:
+                output = await self._run(handler, tool_input)
+            except ServerBusyError as e:
+                raise protocol_error(e) from e
+            except HTTPException as e:
+                # Tool failures are results the model can see, not protocol errors
+                text = f"{e.status_code}: {e.detail}"
+                retry_after = (e.headers or {}).get("Retry-After")
+                if retry_after is not None:
+                    text += f" (retry after {retry_after}s)"
+                return types.CallToolResult(content=[types.TextContent(type="text", text=text)], is_error=True)
+            return types.CallToolResult(content=[types.TextContent(type="text", text=json_dumps(output).decode())])
+        
+        async def list_resources(ctx: Any, params: Any) -> Any:
+            return types.ListResourcesResult(resources=[
+                types.Resource(uri=uri, name=uri.split("://", 1)[-1], mime_type="application/json")
+                for uri in self.registry.resources
+            ])
+        
+        async def read_resource(ctx: Any, params: Any) -> Any:
+            uri = str(params.uri)
+            try:
+                data = await self.read_resource(uri)
+            except HTTPException as e:
+                raise protocol_error(e) from e
+            return types.ReadResourceResult(contents=[
+                types.TextResourceContents(uri=uri, mime_type="application/json", text=json_dumps(data).decode())
+            ])
+        
+        return Server(
+            "unifi",
+            version=SERVER_VERSION,
+            instructions=SERVER_INSTRUCTIONS,
+            on_list_tools=list_tools,
+            on_call_tool=call_tool,
+            on_list_resources=list_resources,
+            on_read_resource=read_resource,
+        )
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending": self.pending,
+            "max_in_flight": self.max_in_flight,
+            "max_pending": self.max_pending,
+            "handled": self.handled,
+            "cancelled": self.cancelled,
+            "rejected": self.rejected,
+        }
+
+
+def create_dispatcher() -> MCPDispatcher:
+    return MCPDispatcher(
+        mcp_server,
+        max_in_flight=int(os.environ.get("UNIFI_MCP_MAX_IN_FLIGHT", "16")),
+        max_pending=int(os.environ.get("UNIFI_MCP_MAX_PENDING", "256")),
+    )
+
+
+class BackpressureStreams:
+    """Wraps the SDK message streams of a connection to stop reading while max_pending requests are
+    unanswered, so a flooding client blocks on its writes instead of being refused"""
+    
+    def __init__(self, read_stream: Any, write_stream: Any, max_pending: int):
+        self.reader = self._Reader(read_stream, self)
+        self.writer = self._Writer(write_stream, self)
+        self.max_pending = max_pending
+        self.unanswered: set = set()
+        self._room = asyncio.Event()
+        self._room.set()
+    
+    def _received(self, message: Any) -> None:
+        method = getattr(message, "method", None)
+        if method == "notifications/cancelled":
+            # Cancelled requests are never answered
+            self._answered((message.params or {}).get("requestId"))
+        elif method is not None and getattr(message, "id", None) is not None:
+            self.unanswered.add(message.id)
+            if len(self.unanswered) >= self.max_pending:
+                self._room.clear()
+    
+    def _answered(self, request_id: Any) -> None:
+        self.unanswered.discard(request_id)
+        if len(self.unanswered) < self.max_pending:
+            self._room.set()
+    
+    class _Reader:
+        def __init__(self, stream: Any, owner: "BackpressureStreams"):
+            self.stream = stream
+            self.owner = owner
+        
+        @property
+        def last_context(self) -> Optional[contextvars.Context]:
+            # Context the message was sent from, which the SDK runs its handler in
+            return getattr(self.stream, "last_context", None)
+        
+        async def receive(self) -> Any:
+            await self.owner._room.wait()
+            item = await self.stream.receive()
+            self.owner._received(getattr(item, "message", None))
+            return item
+        
+        def __aiter__(self) -> Any:
+            return self
+        
+        async def __anext__(self) -> Any:
+            import anyio
+            
+            try:
+                return await self.receive()
+            except anyio.EndOfStream:
+                raise StopAsyncIteration
+        
+        async def aclose(self) -> None:
+            await self.stream.aclose()
+        
+        async def __aenter__(self) -> Any:
+            return self
+        
+        async def __aexit__(self, *exc_info: Any) -> None:
+            await self.aclose()
+    
+    class _Writer:
+        def __init__(self, stream: Any, owner: "BackpressureStreams"):
+            self.stream = stream
+            self.owner = owner
+        
+        async def send(self, item: Any) -> None:
+            await self.stream.send(item)
+            message = item.message
+            if getattr(message, "method", None) is None and getattr(message, "id", None) is not None:
+                self.owner._answered(message.id)
+        
+        async def aclose(self) -> None:
+            await self.stream.aclose()
+        
+        async def __aenter__(self) -> Any:
+            return self
+        
+        async def __aexit__(self, *exc_info: Any) -> None:
+            await self.aclose()
+
+
+async def serve_stdio(dispatcher: MCPDispatcher, read_stream: Any, write_stream: Any) -> None:
+    """Serve MCP over the SDK message streams of a stdio connection until the client closes it"""
+    server = dispatcher.create_server()
+    streams = BackpressureStreams(read_stream, write_stream, dispatcher.max_pending)
+    await server.run(streams.reader, streams.writer, server.create_initialization_options())
+
+
+async def run_stdio() -> None:
+    """Serve MCP over this process's stdin and stdout, as launched by Claude Desktop"""
+    from mcp.server.stdio import stdio_server
+    
+    # Connect while the client is still initializing; a failure is reported again by the first tool call
+    warm_up = asyncio.ensure_future(ensure_unifi_client())
+    warm_up.add_done_callback(lambda task: task.cancelled() or task.exception())
+    try:
+        async with stdio_server() as (read_stream, write_stream):
+            await serve_stdio(create_dispatcher(), read_stream, write_stream)
+    finally:
+        warm_up.cancel()
+        if unifi_client:
+            await unifi_client.close()
+
+
+# HTTP app
+# FastAPI and uvicorn are only imported once the HTTP app is built, so scripts, tests and the
+# stdio transport start without them (see bench_startup.py)
+
+
+def _fast_json_response_class() -> type:
+    from starlette.responses import JSONResponse
+    
+    class FastJSONResponse(JSONResponse):
+        """JSON response rendered with orjson (or compact stdlib json) without a jsonable_encoder pass"""
+        
+        def render(self, content: Any) -> bytes:
+            return json_dumps(content)
+    
+    return FastJSONResponse
+
+
+def create_app() -> Any:
+    """Build the FastAPI app serving MCP over streamable HTTP at /mcp, plus REST and metrics routes"""
+    from contextlib import asynccontextmanager
+    from fastapi import Body, FastAPI
+    from mcp.server.streamable_http_manager import StreamableHTTPASGIApp, StreamableHTTPSessionManager
+    
+    dispatcher = create_dispatcher()
+    # Without sessions any worker or replica can answer any request, at the cost of cancellation,
+    # which needs the request and its notifications/cancelled to reach the same process
+    session_manager = StreamableHTTPSessionManager(
+        app=dispatcher.create_server(),
+        json_response=True,
+        stateless=os.environ.get("UNIFI_MCP_STATELESS", "false").lower() in ("1", "true", "yes"),
+    )
+    
+    @asynccontextmanager
+    async def lifespan(app: Any) -> AsyncIterator[None]:
+        await startup_event()
+        try:
+            async with session_manager.run():
+                yield
+        finally:
+            await shutdown_event()
+    
+    async def list_tools() -> Dict[str, Any]:
+        return {"tools": dispatcher.tool_list()}
+    
+    async def call_tool(tool_name: str, arguments: Dict[str, Any] = Body(default={})) -> Any:
+        return await dispatcher.call_tool(tool_name, arguments)
+    
+    async def read_resource(resource_uri: str) -> Any:
+        uri = resource_uri if "://" in resource_uri else f"unifi://{resource_uri}"
+        return await dispatcher.read_resource(uri)
+    
+    app = FastAPI(title="Unifi MCP Server", default_response_class=_lazy_attribute("FastJSONResponse"),
+                  lifespan=lifespan)
+    app.add_middleware(TenantMiddleware)
+    app.add_middleware(TraceContextMiddleware)
+    # The SDK's ASGI app answers POST, GET and DELETE on the endpoint itself
+    app.add_route("/mcp", StreamableHTTPASGIApp(session_manager), include_in_schema=False)
+    app.add_api_route("/mcp/tools", list_tools, methods=["GET"])
+    app.add_api_route("/mcp/tools/{tool_name}", call_tool, methods=["POST"])
+    app.add_api_route("/mcp/resources/{resource_uri:path}", read_resource, methods=["GET"])
+    app.add_api_route("/metrics", prometheus_metrics, methods=["GET"], include_in_schema=False)
+    app.state.mcp_dispatcher = dispatcher
+    app.state.mcp_session_manager = session_manager
+    return app
+
+
+# Built on first access, e.g. by `uvicorn main:app` or `from main import app`
+_LAZY_ATTRIBUTES = {"app": create_app, "FastJSONResponse": _fast_json_response_class}
+
+
+def _lazy_attribute(name: str) -> Any:
+    """Module attribute that is created on first use"""
+    if name not in globals():
+        globals()[name] = _LAZY_ATTRIBUTES[name]()
+    return globals()[name]
+
+
+def __getattr__(name: str) -> Any:
+    if name in _LAZY_ATTRIBUTES:
+        return _lazy_attribute(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 # Run the server
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="Unifi MCP Server")
+    parser.add_argument(
+        "--transport", choices=["http", "stdio"], default=os.environ.get("UNIFI_MCP_TRANSPORT", "http"),
+        help="Serve MCP over streamable HTTP on port 8000 (default) or over stdin/stdout",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=int(os.environ.get("UNIFI_WORKERS", "1")),
+        help="Number of HTTP worker processes sharing cache and rate limit state",
+    )
+    args = parser.parse_args()
+    if args.transport == "stdio":
+        asyncio.run(run_stdio())
+    elif args.workers > 1:
+        import uvicorn
+        # Workers are started as new processes that import main:app and inherit this environment
+        if not os.environ.get("UNIFI_SHARED_STATE"):
+            os.environ["UNIFI_SHARED_STATE"] = "sqlite:///logs/shared_state.db"
+        # MCP sessions live in the worker that started them, and requests are spread over all workers
+        os.environ.setdefault("UNIFI_MCP_STATELESS", "true")
+        logger.info(f"Starting {args.workers} workers sharing state in {os.environ['UNIFI_SHARED_STATE']}")
+        uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=args.workers)
+    else:
+        import uvicorn
+        uvicorn.run(_lazy_attribute("app"), host="0.0.0.0", port=8000)
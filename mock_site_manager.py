@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+"""
+Local mock of the Unifi Site Manager API for load tests and benchmarks.
+
+Serves /v1/hosts, /v1/sites, /v1/devices, /v1/sd-wan/configs (with config
+details and status) and /ea/isp-metrics from a deterministic synthetic fleet,
+with nextToken pagination, configurable latency, random errors and 429s, and
+an optional request rate limit.
+
+Run it standalone and point the MCP server at it:
+
+    python mock_site_manager.py --port 8800 --hosts 100 --devices-per-host 100 --latency 0.02
+    UNIFI_API_URL=http://127.0.0.1:8800 UNIFI_API_KEY=mock python main.py
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import zlib
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+MODELS = ["U6-LR", "U6-Pro", "U6-Lite", "USW-24-PoE", "USW-Lite-8-PoE", "UDM-Pro", "UXG-Pro"]
+STATUSES = ["online"] * 18 + ["offline", "updating"]
+FIRMWARE = ["6.6.55", "6.6.65", "7.0.20"]
+METRIC_STEPS = {"5m": 300, "1h": 3600}
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+
+def format_timestamp(epoch: float) -> str:
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def parse_timestamp(value: str) -> int:
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp())
+
+
+def parse_duration(value: str) -> int:
+    units = {"m": 60, "h": 3600, "d": 86400}
+    return int(value[:-1]) * units[value[-1]]
+
+
+class Fleet:
+    """Deterministic synthetic fleet of hosts, sites, devices and SD-WAN configs"""
+
+    def __init__(self, hosts: int = 100, devices_per_host: int = 100, sdwan_configs: int = 20, seed: int = 0):
+        rng = random.Random(seed)
+        updated = format_timestamp(1_713_173_429)
+        self.hosts = [{
+            "id": f"host_{h:05d}",
+            "hardwareId": f"hw-{h:05d}",
+            "type": "console",
+            "ipAddress": f"203.0.{h // 256 % 256}.{h % 256}",
+            "owner": True,
+            "isBlocked": False,
+            "registrationTime": updated,
+            "lastConnectionStateChange": updated,
+            "latestBackupTime": updated,
+            "reportedState": {"name": f"Console {h}", "version": rng.choice(FIRMWARE), "state": "connected"},
+            "userData": {"status": "ACTIVE"},
+        } for h in range(hosts)]
+        self.sites = [{
+            "siteId": f"site_{h:05d}",
+            "hostId": host["id"],
+            "meta": {"name": "default", "desc": f"Site {h}", "timezone": "Europe/Amsterdam"},
+            "statistics": {"counts": {"totalDevice": devices_per_host}},
+            "permission": "admin",
+            "isOwner": True,
+        } for h, host in enumerate(self.hosts)]
+        self.device_groups = [{
+            "hostId": host["id"],
+            "hostName": host["reportedState"]["name"],
+            "updatedAt": updated,
+            "devices": [{
+                "id": f"dev_{h:05d}_{d:04d}",
+                "mac": f"74:ac:b9:{h // 256 % 256:02x}:{h % 256:02x}:{d % 256:02x}",
+                "name": f"Device {h}-{d}",
+                "model": rng.choice(MODELS),
+                "shortname": "U6LR",
+                "ip": f"10.{h % 256}.{d // 256 % 256}.{d % 256}",
+                "productLine": "network",
+                "status": rng.choice(STATUSES),
+                "version": rng.choice(FIRMWARE),
+                "firmwareStatus": "upToDate",
+                "isConsole": d == 0,
+                "isManaged": True,
+                "startupTime": updated,
+                "adoptionTime": updated,
+                "note": None,
+                "uidb": {"guid": f"guid-{h}-{d}", "images": {"default": "0" * 32}},
+            } for d in range(devices_per_host)],
+        } for h, host in enumerate(self.hosts)]
+        self.sdwan_configs = [{
+            "id": f"sdwan_{c:04d}",
+            "name": f"SD-WAN {c}",
+            "type": "sdwan-hbsp",
+            "variant": "extension",
+        } for c in range(sdwan_configs)]
+        self.sdwan_statuses = {}
+        for c, config in enumerate(self.sdwan_configs):
+            members = [self.sites[(c * 5 + i) % len(self.sites)] for i in range(min(5, len(self.sites)))]
+            self.sdwan_statuses[config["id"]] = {
+                "id": config["id"],
+                "fingerprint": f"{c:08x}",
+                "updatedAt": 1_713_173_429,
+                "generateStatus": "OK" if c % 7 else "GENERATING",
+                "errors": [],
+                "warnings": [],
+                "hubs": [{"id": site["siteId"], "hostId": site["hostId"], "name": site["meta"]["desc"],
+                          "errors": [], "warnings": []} for site in members[:1]],
+                "spokes": [{"id": site["siteId"], "hostId": site["hostId"], "name": site["meta"]["desc"],
+                            "errors": [], "warnings": ["unstable uplink"] if c % 3 == 0 else []}
+                           for site in members[1:]],
+            }
+        self.hosts_by_id = {host["id"]: host for host in self.hosts}
+        self.configs_by_id = {config["id"]: config for config in self.sdwan_configs}
+
+    @property
+    def device_count(self) -> int:
+        return sum(len(group["devices"]) for group in self.device_groups)
+
+    def isp_series(self, metric_type: str, site: Dict[str, Any], begin: int, end: int) -> Dict[str, Any]:
+        """ISP metric periods of one site, the same for every request covering the same timestamps"""
+        step = METRIC_STEPS[metric_type]
+        base = zlib.crc32(site["siteId"].encode())
+        periods = []
+        for ts in range(begin - begin % step + step, end + 1, step):
+            noise = zlib.crc32(ts.to_bytes(8, "big"), base) / 0xFFFFFFFF
+            outage = noise > 0.995
+            latency = 8 + 30 * noise
+            periods.append({
+                "metricTime": format_timestamp(ts),
+                "version": "1",
+                "data": {"wan": {
+                    "avgLatency": round(latency, 1),
+                    "maxLatency": round(latency * 2.5, 1),
+                    "packetLoss": round(50 * noise, 2) if outage else 0,
+                    "download_kbps": int(400_000 + 200_000 * noise),
+                    "upload_kbps": int(40_000 + 20_000 * noise),
+                    "uptime": 0 if outage else 100,
+                    "downtime": step if outage else 0,
+                    "ispName": "Mock ISP",
+                    "ispAsn": "64496",
+                }},
+            })
+        return {"metricType": metric_type, "hostId": site["hostId"], "siteId": site["siteId"], "periods": periods}
+
+
+class MockSiteManager:
+    """Threaded HTTP server answering Site Manager API requests from a Fleet"""
+
+    def __init__(self, fleet: Fleet, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0,
+                 jitter: float = 0.0, error_rate: float = 0.0, throttle_rate: float = 0.0,
+                 rate_limit: Optional[float] = None, retry_after: float = 1.0, seed: int = 0):
+        self.fleet = fleet
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.requests: Counter = Counter()
+        self.responses: Counter = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._tokens = rate_limit or 0.0
+        self._refilled = time.monotonic()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._server.request_queue_size = 256
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def serve_forever(self) -> None:
+        self._server.serve_forever()
+
+    def start(self) -> "MockSiteManager":
+        """Serve from a background thread"""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self.requests.clear()
+            self.responses.clear()
+
+    def __enter__(self) -> "MockSiteManager":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def _throttled(self) -> bool:
+        """Injected 429s: at random, and whenever the token bucket is empty"""
+        with self._lock:
+            if self.throttle_rate and self._random.random() < self.throttle_rate:
+                return True
+            if not self.rate_limit:
+                return False
+            now = time.monotonic()
+            self._tokens = min(self.rate_limit, self._tokens + (now - self._refilled) * self.rate_limit)
+            self._refilled = now
+            if self._tokens < 1:
+                return True
+            self._tokens -= 1
+            return False
+
+    def _failed(self) -> bool:
+        with self._lock:
+            return bool(self.error_rate) and self._random.random() < self.error_rate
+
+    def handle(self, method: str, path: str, query: Dict[str, List[str]],
+               body: Optional[Dict[str, Any]]) -> Tuple[int, Dict[str, Any]]:
+        """Route one request to (status code, JSON body)"""
+        fleet = self.fleet
+        parts = path.strip("/").split("/")
+        if method == "GET" and path == "/v1/hosts":
+            return self._page(fleet.hosts, query)
+        if method == "GET" and len(parts) == 3 and parts[:2] == ["v1", "hosts"]:
+            host = fleet.hosts_by_id.get(parts[2])
+            return (200, {"data": host}) if host else self._not_found(path)
+        if method == "GET" and path == "/v1/sites":
+            return self._page(fleet.sites, query)
+        if method == "GET" and path == "/v1/devices":
+            host_ids = set(query.get("hostIds[]", []) + query.get("hostIds", []))
+            groups = [group for group in fleet.device_groups if group["hostId"] in host_ids] if host_ids else fleet.device_groups
+            return self._page(groups, query)
+        if method == "GET" and path == "/v1/sd-wan/configs":
+            return self._page(fleet.sdwan_configs, query)
+        if method == "GET" and len(parts) in (4, 5) and parts[:3] == ["v1", "sd-wan", "configs"]:
+            config = fleet.configs_by_id.get(parts[3])
+            if config is None or (len(parts) == 5 and parts[4] != "status"):
+                return self._not_found(path)
+            return 200, {"data": fleet.sdwan_statuses[config["id"]] if len(parts) == 5 else config}
+        if method == "GET" and len(parts) == 3 and parts[:2] == ["ea", "isp-metrics"] and parts[2] in METRIC_STEPS:
+            begin, end = self._metric_window(parts[2], query)
+            return 200, {"data": [fleet.isp_series(parts[2], site, begin, end) for site in fleet.sites]}
+        if method == "POST" and path == "/ea/isp-metrics/query":
+            return self._query_metrics(body or {})
+        return self._not_found(path)
+
+    def _page(self, items: List[Dict[str, Any]], query: Dict[str, List[str]]) -> Tuple[int, Dict[str, Any]]:
+        """nextToken pagination over a list, as the v1 endpoints page their results"""
+        try:
+            page_size = min(int(query.get("pageSize", [DEFAULT_PAGE_SIZE])[0]), MAX_PAGE_SIZE)
+            offset = int(query["nextToken"][0], 16) if "nextToken" in query else 0
+        except ValueError:
+            return 400, {"code": "invalid_parameter", "message": "invalid pageSize or nextToken"}
+        end = offset + max(1, page_size)
+        next_token = format(end, "x") if end < len(items) else None
+        return 200, {"data": items[offset:end], "httpStatusCode": 200, "traceId": "mock", "nextToken": next_token}
+
+    @staticmethod
+    def _metric_window(metric_type: str, query: Dict[str, List[str]]) -> Tuple[int, int]:
+        end = parse_timestamp(query["endTimestamp"][0]) if "endTimestamp" in query else int(time.time())
+        if "beginTimestamp" in query:
+            begin = parse_timestamp(query["beginTimestamp"][0])
+        else:
+            begin = end - parse_duration(query.get("duration", ["24h" if metric_type == "5m" else "7d"])[0])
+        return begin, end
+
+    def _query_metrics(self, body: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+        metric_type = body.get("metricType", "5m")
+        if metric_type not in METRIC_STEPS:
+            return 400, {"code": "invalid_parameter", "message": f"unknown metric type {metric_type}"}
+        by_id = {site["siteId"]: site for site in self.fleet.sites}
+        metrics = []
+        for query in body.get("sites") or []:
+            site = by_id.get(query.get("siteId"))
+            if site is None:
+                continue
+            end = parse_timestamp(query["endTimestamp"]) if query.get("endTimestamp") else int(time.time())
+            begin = parse_timestamp(query["beginTimestamp"]) if query.get("beginTimestamp") else end - 86400
+            metrics.append(self.fleet.isp_series(metric_type, site, begin, end))
+        return 200, {"data": {"metrics": metrics}, "httpStatusCode": 200, "traceId": "mock"}
+
+    @staticmethod
+    def _not_found(path: str) -> Tuple[int, Dict[str, Any]]:
+        return 404, {"code": "not_found", "message": f"{path} not found"}
+
+    def _handler_class(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                self._respond("GET")
+
+            def do_POST(self):
+                self._respond("POST")
+
+            def _respond(self, method):
+                url = urlsplit(self.path)
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length) if length else b""
+                delay = mock.latency + (mock._random.random() * mock.jitter if mock.jitter else 0.0)
+                if delay:
+                    time.sleep(delay)
+
+                headers = {}
+                if not self.headers.get("X-API-KEY"):
+                    status, payload = 401, {"code": "unauthorized", "message": "missing X-API-KEY"}
+                elif mock._throttled():
+                    status, payload = 429, {"code": "rate_limit", "message": "too many requests"}
+                    headers["Retry-After"] = f"{mock.retry_after:g}"
+                elif mock._failed():
+                    status, payload = 503, {"code": "unavailable", "message": "injected failure"}
+                else:
+                    try:
+                        body = json.loads(raw) if raw else None
+                        status, payload = mock.handle(method, url.path, parse_qs(url.query), body)
+                    except (ValueError, KeyError) as e:
+                        status, payload = 400, {"code": "bad_request", "message": str(e)}
+
+                with mock._lock:
+                    mock.requests[url.path] += 1
+                    mock.responses[status] += 1
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument("--hosts", type=int, default=100, help="Number of hosts (one site each)")
+    parser.add_argument("--devices-per-host", type=int, default=100)
+    parser.add_argument("--sdwan-configs", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random extra seconds, up to this value")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 503")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of requests answered with 429")
+    parser.add_argument("--rate-limit", type=float, default=None, help="Requests per second before answering 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds sent with 429s")
+    args = parser.parse_args()
+
+    fleet = Fleet(args.hosts, args.devices_per_host, args.sdwan_configs)
+    server = MockSiteManager(
+        fleet, args.host, args.port, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate, rate_limit=args.rate_limit, retry_after=args.retry_after,
+    )
+    print(f"Mock Site Manager with {len(fleet.hosts)} hosts and {fleet.device_count} devices on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
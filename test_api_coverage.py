@@ -3,6 +3,7 @@
 Test script to verify all UI.com Site Manager API functions are implemented
 """
 import asyncio
+import json
 import os
 import sys
 from unittest.mock import AsyncMock, patch
@@ -39,11 +40,14 @@ async def test_api_coverage():
     with patch('httpx.AsyncClient') as mock_client:
         # Setup the mock client
         mock_instance = AsyncMock()
-        mock_client.return_value.__aenter__.return_value = mock_instance
+        mock_client.return_value = mock_instance
 
         class DummyResponse:
+            status_code = 200
+            
             def __init__(self, data):
                 self._data = data
+                self.content = json.dumps(data).encode()
 
             def raise_for_status(self):
                 return None
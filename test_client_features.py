@@ -0,0 +1,1669 @@
+#!/usr/bin/env python3
+"""
+Tests for UnifiClient performance features (pagination, caching, coalescing, ...)
+against an in-process mock transport
+"""
+import asyncio
+import json
+import os
+import sys
+import time
+import logging
+
+import httpx
+
+# Ensure we can import the project modules
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+os.environ["UNIFI_API_KEY"] = "test_api_key"
+os.environ["UNIFI_API_URL"] = "https://api.ui.com"
+
+import main
+from main import UnifiClient
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def make_client(handler) -> UnifiClient:
+    """Create a UnifiClient whose shared HTTP client is backed by a mock transport"""
+    client = UnifiClient()
+    client._http_client = httpx.AsyncClient(
+        transport=httpx.MockTransport(handler),
+        headers=client.headers,
+    )
+    return client
+
+
+def paged_handler(items, page_size, calls=None):
+    """Build a handler that serves items in pages linked by nextToken"""
+    def handler(request: httpx.Request) -> httpx.Response:
+        if calls is not None:
+            calls.append(request)
+        start = int(request.url.params.get("nextToken") or 0)
+        end = start + page_size
+        body = {"data": items[start:end], "nextToken": str(end) if end < len(items) else None}
+        return httpx.Response(200, json=body)
+    return handler
+
+
+def test_iter_hosts_follows_next_token():
+    async def run():
+        calls = []
+        items = [{"id": f"host_{i}"} for i in range(25)]
+        client = make_client(paged_handler(items, 10, calls))
+        result = [item async for item in client.iter_hosts()]
+        assert [item["id"] for item in result] == [item["id"] for item in items]
+        assert len(calls) == 3
+    asyncio.run(run())
+
+
+def test_iter_devices_respects_bounds():
+    async def run():
+        calls = []
+        items = [{"hostId": f"host_{i}", "devices": []} for i in range(50)]
+        client = make_client(paged_handler(items, 10, calls))
+        result = [item async for item in client.iter_devices(max_items=15)]
+        assert len(result) == 15
+        assert len(calls) == 2
+
+        calls.clear()
+        client = make_client(paged_handler(items, 10, calls))
+        result = [item async for item in client.iter_devices(max_pages=3)]
+        assert len(result) == 30
+        assert len(calls) == 3
+    asyncio.run(run())
+
+
+def test_list_sites_all_reports_truncation():
+    async def run():
+        items = [{"siteId": f"site_{i}"} for i in range(12)]
+        main.unifi_client = make_client(paged_handler(items, 5))
+        try:
+            output = await main.list_sites_all(main.ListAllInput(max_items=10))
+            assert output.count == 10 and output.truncated
+            output = await main.list_sites_all(main.ListAllInput(max_items=12))
+            assert output.count == 12 and not output.truncated
+        finally:
+            main.unifi_client = None
+    asyncio.run(run())
+
+
+def test_cache_serves_repeated_reads():
+    async def run():
+        calls = []
+        client = make_client(paged_handler([{"id": "host_1"}], 10, calls))
+        first = await client.list_hosts(page_size=10)
+        second = await client.list_hosts(page_size=10)
+        assert first == second
+        assert len(calls) == 1
+        await client.list_hosts(page_size=20)
+        assert len(calls) == 2
+        stats = client.cache_stats()
+        assert stats["hits"] == 1 and stats["misses"] == 2
+    asyncio.run(run())
+
+
+def test_cache_skips_status_endpoints():
+    async def run():
+        calls = []
+        client = make_client(paged_handler([], 10, calls))
+        await client.get_sdwan_config_status("config_1")
+        await client.get_sdwan_config_status("config_1")
+        assert len(calls) == 2
+    asyncio.run(run())
+
+
+def test_cache_stale_while_revalidate():
+    async def run():
+        calls = []
+        client = make_client(paged_handler([{"siteId": "site_1"}], 10, calls))
+        client.cache_ttls["/v1/sites"] = 0.0
+        await client.list_sites()
+        stale = await client.list_sites()
+        assert stale["data"] == [{"siteId": "site_1"}]
+        assert client.cache_stats()["stale_hits"] == 1
+        await asyncio.gather(*client._background_tasks)
+        assert len(calls) == 2
+    asyncio.run(run())
+
+
+def test_single_flight_coalesces_concurrent_requests():
+    async def run():
+        calls = []
+
+        async def handler(request):
+            calls.append(request)
+            await asyncio.sleep(0.05)
+            return httpx.Response(200, json={"data": {"id": "config_1", "status": "ok"}})
+
+        client = make_client(handler)
+        results = await asyncio.gather(*[client.get_sdwan_config_status("config_1") for _ in range(5)])
+        assert len(calls) == 1
+        assert all(result == results[0] for result in results)
+        assert client.single_flight.stats()["coalesced"] == 4
+    asyncio.run(run())
+
+
+def test_single_flight_shares_errors():
+    async def run():
+        calls = []
+
+        async def handler(request):
+            calls.append(request)
+            await asyncio.sleep(0.05)
+            return httpx.Response(404, json={"message": "not found"})
+
+        client = make_client(handler)
+        results = await asyncio.gather(
+            *[client.get_host_by_id("missing") for _ in range(3)], return_exceptions=True
+        )
+        assert len(calls) == 1
+        assert all(isinstance(result, main.HTTPException) for result in results)
+    asyncio.run(run())
+
+
+def test_single_flight_cancels_when_all_waiters_leave():
+    async def run():
+        cancelled = asyncio.Event()
+
+        async def factory():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        flights = main.SingleFlight()
+        waiters = [asyncio.create_task(flights.do("key", factory)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        waiters[0].cancel()
+        await asyncio.sleep(0.01)
+        assert not cancelled.is_set()
+        waiters[1].cancel()
+        await asyncio.wait_for(cancelled.wait(), 1)
+        assert flights.stats()["in_flight"] == 0
+    asyncio.run(run())
+
+
+def test_rate_limiter_spaces_requests():
+    async def run():
+        bucket = main.TokenBucket(rate=20.0, capacity=2.0)
+        start = asyncio.get_running_loop().time()
+        for _ in range(4):
+            await bucket.acquire()
+        elapsed = asyncio.get_running_loop().time() - start
+        # Two tokens are available up front, the other two take 1/20s each
+        assert 0.08 <= elapsed < 0.5
+    asyncio.run(run())
+
+
+def test_throttling_backs_off_and_surfaces_429():
+    async def run():
+        def handler(request):
+            return httpx.Response(429, headers={"Retry-After": "2"}, json={"message": "slow down"})
+
+        client = make_client(handler)
+        client.max_retries = 0
+        limit = client.concurrency.limit
+        try:
+            await client.get_isp_metrics("5m")
+            assert False, "expected HTTPException"
+        except main.HTTPException as e:
+            assert e.status_code == 429
+            assert e.headers == {"Retry-After": "2"}
+        assert client.concurrency.limit == limit / 2
+        stats = client.rate_limiter.stats()
+        assert stats["throttled"] == 1
+        assert stats["families"]["ea"]["paused_for"] > 1.5
+        assert stats["families"]["v1"]["paused_for"] == 0
+        
+        # Tools and batch results pass the 429 and its Retry-After on instead of turning them into a 500
+        client.rate_limiter = main.RateLimiter({})
+        main.unifi_client = client
+        try:
+            try:
+                await main.get_isp_metrics(main.GetIspMetricsInput(metric_type="5m", live=True))
+                assert False, "expected HTTPException"
+            except main.HTTPException as e:
+                assert e.status_code == 429 and e.headers == {"Retry-After": "2"}
+            output = await main.batch(main.BatchInput(operations=[
+                {"tool": "get_isp_metrics", "input": {"metric_type": "5m", "live": True}},
+            ]))
+            assert output.results[0].status_code == 429 and output.results[0].headers == {"Retry-After": "2"}
+        finally:
+            main.unifi_client = None
+            await client.close()
+    asyncio.run(run())
+
+
+def test_retry_after_on_any_status_pauses_and_shrinks_the_limit():
+    async def run():
+        client = make_client(lambda request: httpx.Response(503, headers={"Retry-After": "2"}))
+        client.max_retries = 0
+        limit = client.concurrency.limit
+        try:
+            await client.get_isp_metrics("5m")
+            assert False, "expected HTTPException"
+        except main.HTTPException as e:
+            assert e.status_code == 500
+        assert client.concurrency.limit == limit / 2
+        stats = client.rate_limiter.stats()
+        assert stats["throttled"] == 1 and stats["families"]["ea"]["paused_for"] > 1.5
+        
+        # A 503 without Retry-After is a plain server error
+        client = make_client(lambda request: httpx.Response(503))
+        client.max_retries = 0
+        try:
+            await client.get_isp_metrics("5m")
+        except main.HTTPException:
+            pass
+        assert client.concurrency.limit == limit and client.rate_limiter.stats()["throttled"] == 0
+    asyncio.run(run())
+
+
+def test_concurrency_limit_grows_when_healthy():
+    async def run():
+        client = make_client(paged_handler([], 10))
+        client.cache_enabled = False
+        client.concurrency.limit = 2.0
+        for _ in range(10):
+            await client.list_sites()
+        assert client.concurrency.limit > 3.0
+    asyncio.run(run())
+
+
+def test_retries_transient_failures():
+    async def run():
+        calls = []
+
+        def handler(request):
+            calls.append(request)
+            if len(calls) == 1:
+                raise httpx.ConnectError("connection reset", request=request)
+            if len(calls) == 2:
+                return httpx.Response(503, json={"message": "unavailable"})
+            return httpx.Response(200, json={"data": {"id": "host_1"}})
+
+        client = make_client(handler)
+        client.retry_base_delay = 0.001
+        client.retry_max_delay = 0.01
+        data = await client.get_host_by_id("host_1")
+        assert data == {"data": {"id": "host_1"}}
+        assert len(calls) == 3 and client.retries == 2
+    asyncio.run(run())
+
+
+def test_post_requests_are_not_retried():
+    async def run():
+        calls = []
+
+        def handler(request):
+            calls.append(request)
+            return httpx.Response(502, json={"message": "bad gateway"})
+
+        client = make_client(handler)
+        client.retry_base_delay = 0.001
+        try:
+            await client.query_isp_metrics({"sites": []})
+            assert False, "expected HTTPException"
+        except main.HTTPException as e:
+            assert e.status_code == 500
+        assert len(calls) == 1
+    asyncio.run(run())
+
+
+def test_circuit_breaker_fails_fast():
+    async def run():
+        calls = []
+
+        def handler(request):
+            calls.append(request)
+            return httpx.Response(504, json={"message": "timeout"})
+
+        client = make_client(handler)
+        client.max_retries = 0
+        client.breaker_failure_threshold = 2
+        client.breaker_recovery_timeout = 0.05
+        for _ in range(4):
+            try:
+                await client.get_sdwan_config_status("config_1")
+            except main.HTTPException:
+                pass
+        assert len(calls) == 2
+        assert client.breaker_stats()["api.ui.com"]["state"] == "open"
+
+        await asyncio.sleep(0.06)
+        try:
+            await client.get_sdwan_config_status("config_1")
+        except main.HTTPException:
+            pass
+        # The half-open probe failed, so the breaker opens again
+        assert len(calls) == 3
+        assert client.breaker_stats()["api.ui.com"]["state"] == "open"
+    asyncio.run(run())
+
+
+def test_list_devices_fanout_shards_and_merges():
+    async def run():
+        calls = []
+        in_flight = {"now": 0, "max": 0}
+
+        async def handler(request):
+            calls.append(request)
+            in_flight["now"] += 1
+            in_flight["max"] = max(in_flight["max"], in_flight["now"])
+            await asyncio.sleep(0.02)
+            in_flight["now"] -= 1
+            host_ids = request.url.params.get_list("hostIds[]")
+            groups = [
+                {"hostId": host_id, "devices": [{"id": f"{host_id}_dev"}, {"id": "shared_dev"}]}
+                for host_id in reversed(host_ids)
+            ]
+            return httpx.Response(200, json={"data": groups, "nextToken": None})
+
+        client = make_client(handler)
+        host_ids = [f"host_{i}" for i in range(10)] + ["host_0"]
+        result = await client.list_devices_fanout(host_ids, shard_size=2, concurrency=3)
+        assert len(calls) == 5
+        assert in_flight["max"] == 3
+        assert [group["hostId"] for group in result["data"]] == host_ids[:10]
+        assert [device["id"] for device in result["data"][0]["devices"]] == ["host_0_dev", "shared_dev"]
+    asyncio.run(run())
+
+
+def test_merge_device_groups_deduplicates_devices():
+    merged = main.merge_device_groups(
+        ["b", "a"],
+        [
+            [{"hostId": "a", "devices": [{"id": "1"}]}],
+            [{"hostId": "b", "devices": [{"id": "2"}]}, {"hostId": "a", "devices": [{"id": "1"}, {"id": "3"}]}],
+        ],
+    )
+    assert [group["hostId"] for group in merged] == ["b", "a"]
+    assert [device["id"] for device in merged[1]["devices"]] == ["1", "3"]
+
+
+def test_get_devices_uses_site_index():
+    async def run():
+        calls = []
+        sites = [{"siteId": "site_a", "hostId": "host_a"}, {"siteId": "site_b", "hostId": "host_b"}]
+
+        def handler(request):
+            calls.append(request)
+            if request.url.path == "/v1/sites":
+                return httpx.Response(200, json={"data": sites, "nextToken": None})
+            host_ids = request.url.params.get_list("hostIds[]")
+            groups = [{"hostId": host_id, "devices": [{"id": f"{host_id}_dev"}]} for host_id in host_ids]
+            return httpx.Response(200, json={"data": groups, "nextToken": None})
+
+        client = make_client(handler)
+        client.cache_enabled = False
+        devices = await client.get_devices("site_b")
+        assert devices == [{"id": "host_b_dev"}]
+        assert calls[-1].url.params.get_list("hostIds[]") == ["host_b"]
+
+        # A new site triggers one incremental refresh; unknown sites return nothing
+        sites.append({"siteId": "site_c", "hostId": "host_c"})
+        client.site_index.min_refresh_interval = 0
+        assert await client.get_devices("site_c") == [{"id": "host_c_dev"}]
+        assert await client.get_devices("missing") == []
+        assert client.site_index.stats()["sites"] == 3
+    asyncio.run(run())
+
+
+def inventory_handler(calls, device_updates=None):
+    """Serve a small fleet, returning device_updates for incremental (time=...) device pulls"""
+    def handler(request):
+        calls.append(request)
+        path = request.url.path
+        if path == "/v1/hosts":
+            data = [{"id": "host_a"}, {"id": "host_b"}]
+        elif path == "/v1/sites":
+            data = [{"siteId": "site_a", "hostId": "host_a"}]
+        elif path == "/v1/devices" and "time" in request.url.params:
+            data = device_updates or []
+        elif path == "/v1/devices":
+            data = [
+                {"hostId": "host_a", "devices": [{"id": "dev_1", "status": "online"}]},
+                {"hostId": "host_b", "devices": [{"id": "dev_2", "status": "online"}]},
+            ]
+        else:
+            data = [{"id": "config_1"}]
+        return httpx.Response(200, json={"data": data, "nextToken": None})
+    return handler
+
+
+def test_inventory_full_load_and_incremental_sync():
+    async def run():
+        calls = []
+        updates = [{"hostId": "host_a", "devices": [{"id": "dev_1", "status": "offline"}, {"id": "dev_3"}]}]
+        client = make_client(inventory_handler(calls, updates))
+        client.cache_enabled = False
+        assert client.inventory.list_hosts() is None
+
+        await client.inventory.full_load()
+        assert len(client.inventory.list_hosts()["data"]) == 2
+        assert client.inventory.get_sdwan_config("config_1") == {"data": {"id": "config_1"}}
+        assert client.site_index.site_hosts == {"site_a": "host_a"}
+
+        await client.inventory.sync_devices()
+        assert "time" in calls[-1].url.params
+        group = client.inventory.list_devices(["host_a"])["data"][0]
+        assert group["devices"] == [{"id": "dev_1", "status": "offline"}, {"id": "dev_3"}]
+        assert client.inventory.stats()["devices"] == 3
+    asyncio.run(run())
+
+
+def test_inventory_is_not_served_while_syncs_keep_failing():
+    async def run():
+        calls, failing = [], []
+        serve = inventory_handler(calls)
+
+        def handler(request):
+            if failing:
+                return httpx.Response(503, json={"message": "unavailable"})
+            return serve(request)
+
+        client = make_client(handler)
+        client.cache_enabled = False
+        client.max_retries = 0
+        client.breaker_failure_threshold = 100
+        inventory = client.inventory
+        inventory.interval = 0.02
+        await inventory.full_load()
+        failing.append(True)
+        inventory.start()
+        try:
+            await asyncio.sleep(0.03)
+            assert inventory.is_fresh() and inventory.errors >= 1
+            # The sync task keeps running, but the snapshot ages out after a few failed intervals
+            await asyncio.sleep(0.06)
+            assert not inventory.is_fresh() and inventory.list_hosts() is None
+            failing.clear()
+            await asyncio.sleep(0.05)
+            assert inventory.is_fresh()
+        finally:
+            await inventory.stop()
+    asyncio.run(run())
+
+
+def test_tools_read_from_inventory_snapshot():
+    async def run():
+        calls = []
+        main.unifi_client = make_client(inventory_handler(calls))
+        main.unifi_client.cache_enabled = False
+        try:
+            await main.unifi_client.inventory.full_load()
+            loaded = len(calls)
+            output = await main.list_hosts(main.ListHostsInput())
+            assert [host["id"] for host in output.data["data"]] == ["host_a", "host_b"]
+            assert len(calls) == loaded
+            await main.list_hosts(main.ListHostsInput(live=True))
+            assert len(calls) == loaded + 1
+            
+            # The snapshot isn't paged and may not know new hosts yet; those requests go to the API
+            await main.list_hosts(main.ListHostsInput(page_size=1))
+            assert calls[-1].url.params["pageSize"] == "1"
+            await main.list_devices(main.ListDevicesInput(host_ids=["host_a"]))
+            assert len(calls) == loaded + 2
+            await main.list_devices(main.ListDevicesInput(host_ids=["host_a", "host_new"]))
+            assert len(calls) == loaded + 3 and calls[-1].url.params.get_list("hostIds[]") == ["host_a", "host_new"]
+        finally:
+            main.unifi_client = None
+    asyncio.run(run())
+
+
+
+def test_query_inventory_loads_a_separate_snapshot():
+    async def run():
+        calls = []
+        hosts = [{"id": "host_a"}]
+        client = make_client(lambda request: (calls.append(request), paged_handler(hosts, 10)(request))[1])
+        client.cache_enabled = False
+        client.inventory_enabled = False
+        client.inventory.interval = 0.2
+        main.unifi_client = client
+        try:
+            # Concurrent first queries share one load, which the list tools never serve
+            outputs = await asyncio.gather(*(
+                main.query_inventory(main.QueryInventoryInput(target="hosts", count_only=True)) for _ in range(3)
+            ))
+            assert [output.total for output in outputs] == [1, 1, 1]
+            loaded = len(calls)
+            assert loaded == 4 and not client.inventory.ready
+            hosts.append({"id": "host_b"})
+            assert len((await main.list_hosts(main.ListHostsInput())).data["data"]) == 2
+            
+            # The snapshot is reused for one interval, then loaded again
+            assert (await main.query_inventory(main.QueryInventoryInput(target="hosts"))).total == 1
+            await asyncio.sleep(0.25)
+            assert (await main.query_inventory(main.QueryInventoryInput(target="hosts"))).total == 2
+            
+            # A loaded inventory that stops syncing is no longer served either
+            await client.inventory.full_load()
+            assert client.inventory.list_hosts() is not None
+            await asyncio.sleep(0.25)
+            assert client.inventory.list_hosts() is None
+        finally:
+            main.unifi_client = None
+            await client.close()
+    asyncio.run(run())
+
+
+def test_query_inventory_filters_groups_and_counts():
+    async def run():
+        client = make_client(paged_handler([], 10))
+        inventory = client.inventory
+        inventory.sites = {"site_a": {"siteId": "site_a", "hostId": "host_a"}}
+        inventory.device_groups = {"host_a": {"hostId": "host_a"}, "host_b": {"hostId": "host_b"}}
+        inventory.devices = {
+            "host_a": {
+                "ap_1": {"id": "ap_1", "model": "U6-LR", "status": "offline", "version": "6.6.55"},
+                "ap_2": {"id": "ap_2", "model": "U6-Pro", "status": "online", "version": "6.6.55"},
+            },
+            "host_b": {
+                "sw_1": {"id": "sw_1", "model": "USW-24", "status": "offline", "version": "7.0.50",
+                         "uidb": {"guid": "abc"}},
+            },
+        }
+        inventory.ready = True
+        inventory.updated_at = time.monotonic()
+        main.unifi_client = client
+        try:
+            output = await main.query_inventory(main.QueryInventoryInput(
+                filters={"status": "offline", "model": "U6*"}, group_by="site"
+            ))
+            assert output.total == 1 and output.groups == {"site_a": 1}
+
+            output = await main.query_inventory(main.QueryInventoryInput(group_by="firmware"))
+            assert output.groups == {"6.6.55": 2, "7.0.50": 1}
+
+            output = await main.query_inventory(main.QueryInventoryInput(
+                filters={"uidb.guid": "abc"}, fields=["id", "host"]
+            ))
+            assert output.data == [{"id": "sw_1", "host": "host_b"}]
+
+            output = await main.query_inventory(main.QueryInventoryInput(
+                filters={"status": ["offline", "online"]}, count_only=True
+            ))
+            assert output.total == 3 and output.data is None
+        finally:
+            main.unifi_client = None
+    asyncio.run(run())
+
+
+def test_shape_response_projects_and_caps():
+    response = {
+        "data": [
+            {"hostId": "h1", "reportedState": {"hostname": "a", "big": "x" * 100},
+             "devices": [{"id": "d1", "name": "ap", "uidb": {}}]},
+            {"hostId": "h2", "reportedState": {"hostname": "b"}, "devices": []},
+        ],
+        "nextToken": "next",
+    }
+    shaped = main.shape_response(response, ["hostId", "reportedState.hostname", "devices.name"], max_items=1)
+    assert shaped == {
+        "data": [{"hostId": "h1", "reportedState": {"hostname": "a"}, "devices": [{"name": "ap"}]}],
+        "nextToken": "next",
+    }
+    # The original response is left untouched for the cache and inventory
+    assert len(response["data"]) == 2 and "big" in response["data"][0]["reportedState"]
+    assert main.shape_response(response) is response
+    assert main.projection_tree(["a.b", "a"]) == {"a": None}
+
+
+def test_tools_apply_projection():
+    async def run():
+        host = {"id": "host_1", "reportedState": {"hostname": "udm", "firmware": "x" * 1000}}
+        main.unifi_client = make_client(lambda request: httpx.Response(200, json={"data": host}))
+        try:
+            output = await main.get_host_by_id(main.GetHostByIdInput(
+                host_id="host_1", fields=["id", "reportedState.hostname"], live=True
+            ))
+            assert output.data == {"data": {"id": "host_1", "reportedState": {"hostname": "udm"}}}
+        finally:
+            main.unifi_client = None
+    asyncio.run(run())
+
+
+def test_streaming_parser_handles_any_chunking():
+    body = json.dumps({
+        "httpStatusCode": 200,
+        "data": [{"id": i, "name": "dev \\\"" + str(i) + "\\\" ]}", "tags": [1, 2.5, None]} for i in range(5)],
+        "nextToken": "abc",
+        "traceId": 12345,
+    })
+    for chunk_size in (1, 3, 7, 64, len(body)):
+        parser = main.StreamingPageParser()
+        items = []
+        for start in range(0, len(body), chunk_size):
+            items.extend(parser.feed(body[start:start + chunk_size]))
+        items.extend(parser.feed("", final=True))
+        assert items == json.loads(body)["data"], chunk_size
+        assert parser.extras == {"httpStatusCode": 200, "nextToken": "abc", "traceId": 12345}
+
+    parser = main.StreamingPageParser()
+    parser.feed('{"data": [{"id": 1}, {"id"')
+    try:
+        parser.feed("", final=True)
+        assert False, "expected ValueError"
+    except ValueError:
+        pass
+
+
+def test_iter_devices_streams_pages():
+    async def run():
+        calls = []
+        failures = [503]
+        items = [{"hostId": f"host_{i}", "devices": [{"id": f"dev_{i}"}]} for i in range(7)]
+
+        def handler(request):
+            calls.append(request)
+            start = int(request.url.params.get("nextToken") or 0)
+            if start and failures:
+                return httpx.Response(failures.pop(), json={"message": "unavailable"})
+            end = start + 3
+            body = json.dumps({"data": items[start:end], "nextToken": str(end) if end < len(items) else None})
+
+            async def chunks():
+                for position in range(0, len(body), 5):
+                    await asyncio.sleep(0)
+                    yield body[position:position + 5].encode()
+
+            return httpx.Response(200, content=chunks())
+
+        async def listing():
+            return [group async for group in client.iter_devices()]
+
+        client = make_client(handler)
+        client.stream_lists = True
+        client.retry_base_delay = 0.001
+        # The 503 on the second page arrives before its body, so it is retried like a buffered request
+        assert await listing() == items
+        assert len(calls) == 4
+        assert client.retries == 1
+
+        # Streamed pages bypass the response cache
+        assert client.cache.stats()["entries"] == 0
+        assert await listing() == items
+        assert len(calls) == 7
+
+        # The concurrency slot is released before items reach the consumer
+        iterator = client.iter_devices()
+        assert await iterator.__anext__() == items[0]
+        assert client.concurrency.in_flight == 0
+        await iterator.aclose()
+    asyncio.run(run())
+
+
+def test_parse_retry_after():
+    assert main.parse_retry_after("5") == 5.0
+    assert main.parse_retry_after(None) is None
+    assert main.parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+
+
+def test_json_dumps_and_fast_response():
+    output = main.ListDevicesOutput(data={"data": [{"id": "dev_1", "seen": main.datetime(2024, 1, 1),
+                                                    "day": main.date(2024, 1, 2)}]})
+    orjson_available = main.ORJSON_AVAILABLE
+    # Both the orjson path (when installed) and the stdlib fallback
+    for use_orjson in sorted({False, orjson_available}):
+        main.ORJSON_AVAILABLE = use_orjson
+        try:
+            assert json.loads(main.json_dumps(output)) == {
+                "data": {"data": [{"id": "dev_1", "seen": "2024-01-01T00:00:00", "day": "2024-01-02"}]}
+            }
+            assert main.json_dumps({"b": 1, "a": 2}, sort_keys=True) == b'{"a":2,"b":1}'
+            assert main.json_loads(b'{"a": [1, 2]}') == {"a": [1, 2]}
+            response = main.FastJSONResponse(content=output)
+            assert json.loads(response.body)["data"]["data"][0]["id"] == "dev_1"
+        finally:
+            main.ORJSON_AVAILABLE = orjson_available
+
+
+def test_streamed_page_fails_without_retry_once_read():
+    async def run():
+        calls = []
+        body = json.dumps({"data": [{"hostId": f"host_{i}"} for i in range(50)]}).encode()
+
+        def handler(request):
+            calls.append(request)
+
+            async def chunks():
+                yield body[:100]
+                raise httpx.ReadError("connection reset")
+
+            return httpx.Response(200, content=chunks())
+
+        client = make_client(handler)
+        client.stream_lists = True
+        client.retry_base_delay = 0.001
+        received = []
+        try:
+            async for group in client.iter_devices():
+                received.append(group)
+            assert False, "truncated page accepted"
+        except main.HTTPException as e:
+            assert "connection reset" in e.detail
+        # Items already handed on can't be taken back, so the page isn't fetched again
+        assert received and len(calls) == 1 and client.retries == 0
+    asyncio.run(run())
+
+
+def test_streamed_listing_memory_stays_below_page_size():
+    import tracemalloc
+
+    async def run():
+        groups = [{"hostId": f"host_{h}", "devices": [{"id": f"dev_{h}_{d}", "name": f"Device {h}-{d}",
+                                                       "uidb": {"images": {"default": "x" * 64}}}
+                                                      for d in range(50)]} for h in range(200)]
+        body = json.dumps({"data": groups}).encode()
+        del groups
+
+        def handler(request):
+            async def chunks():
+                for position in range(0, len(body), 8192):
+                    yield body[position:position + 8192]
+
+            return httpx.Response(200, content=chunks())
+
+        client = make_client(handler)
+        client.stream_lists = True
+        tree = main.projection_tree(["hostId"])
+        tracemalloc.start()
+        try:
+            hosts = [main.project(group, tree) async for group in client.iter_devices()]
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        assert len(hosts) == 200
+        # Buffering holds the body and every parsed group, about seven times the body's size
+        assert peak < len(body) / 2, (peak, len(body))
+    asyncio.run(run())
+
+def metrics_handler(calls, sites=("site_a", "site_b")):
+    """Serve 5m ISP metric periods for every site within the requested window"""
+    def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(request)
+        begin = main.parse_timestamp(request.url.params["beginTimestamp"])
+        end = main.parse_timestamp(request.url.params["endTimestamp"])
+        data = [{
+            "metricType": "5m",
+            "siteId": site_id,
+            "hostId": f"host_{site_id}",
+            "periods": [{
+                "metricTime": main.format_timestamp(ts),
+                "data": {"wan": {"avgLatency": ts // 300 % 10, "packetLoss": 0, "uptime": 100}},
+            } for ts in range(begin, end, 300)],
+        } for site_id in sites]
+        return httpx.Response(200, json={"data": data})
+    return handler
+
+
+def test_missing_ranges():
+    covered = main.merge_ranges([(0, 10), (20, 30), (10, 15)])
+    assert covered == [(0, 15), (20, 30)]
+    assert main.missing_ranges(covered, 5, 40) == [(15, 20), (30, 40)]
+    assert main.missing_ranges(covered, 0, 15) == []
+
+
+def test_metrics_store_fetches_only_missing_ranges():
+    async def run():
+        calls = []
+        client = make_client(metrics_handler(calls))
+        now = time.time()
+        end = now - now % 300 - 7200
+        first = (main.format_timestamp(end - 7200), main.format_timestamp(end))
+        data = await client.get_isp_metrics_stored("5m", *first)
+        assert [series["siteId"] for series in data["data"]] == ["site_a", "site_b"]
+        assert len(data["data"][0]["periods"]) == 25
+
+        await client.get_isp_metrics_stored("5m", *first)
+        assert len(calls) == 1
+
+        data = await client.get_isp_metrics_stored(
+            "5m", main.format_timestamp(end - 3600), main.format_timestamp(end + 3600), site_ids=["site_b"]
+        )
+        assert len(calls) == 2
+        assert calls[1].url.params["beginTimestamp"] == main.format_timestamp(end + 300)
+        assert [series["siteId"] for series in data["data"]] == ["site_b"]
+        assert len(data["data"][0]["periods"]) == 25
+    asyncio.run(run())
+
+
+def test_metrics_store_overwrites_refetched_periods():
+    async def run():
+        calls, latency = [], {"value": 1}
+        serve = metrics_handler(calls, sites=("site_a",))
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            response = serve(request)
+            body = response.json()
+            for period in body["data"][0]["periods"]:
+                period["data"]["wan"]["avgLatency"] = latency["value"]
+            return httpx.Response(200, json=body)
+
+        client = make_client(handler)
+        now = time.time()
+        window = (main.format_timestamp(now - 3600), main.format_timestamp(now))
+        data = await client.get_isp_metrics_stored("5m", *window)
+        assert data["data"][0]["periods"][-1]["data"]["wan"]["avgLatency"] == 1
+        added = client.metrics_store.periods_added
+
+        # The unsettled tail is refetched and the changed period replaces the stored one
+        latency["value"] = 99
+        data = await client.get_isp_metrics_stored("5m", *window)
+        assert len(calls) == 2
+        assert data["data"][0]["periods"][-1]["data"]["wan"]["avgLatency"] == 99
+        assert data["data"][0]["periods"][0]["data"]["wan"]["avgLatency"] == 1
+        assert client.metrics_store.periods_added > added
+    asyncio.run(run())
+
+
+def test_summarize_isp_metrics_aggregates_and_downsamples():
+    async def run():
+        client = make_client(metrics_handler([]))
+        now = time.time()
+        begin = now - now % 3600 - 3 * 3600
+        result = await client.summarize_isp_metrics(
+            "5m", main.format_timestamp(begin), main.format_timestamp(begin + 3600 - 1),
+            metrics=["avgLatency", "uptime"], percentiles=[50, 90], bucket="30m"
+        )
+        latency = result["sites"]["site_a"]["avgLatency"]
+        values = sorted(int(ts) // 300 % 10 for ts in range(int(begin), int(begin) + 3600, 300))
+        assert latency["count"] == 12
+        assert latency["min"] == values[0] and latency["max"] == values[-1]
+        assert latency["avg"] == sum(values) / 12
+        assert latency["p50"] == main.percentile(values, 50)
+        assert result["sites"]["site_a"]["uptime"]["p90"] == 100
+        series = result["series"]["site_b"]
+        assert [point["count"] for point in series] == [6, 6]
+        assert series[0]["metricTime"] == main.format_timestamp(begin)
+    asyncio.run(run())
+
+
+def test_metrics_store_analyze_ranks_anomalies():
+    store = main.MetricsStore()
+    begin = 1_700_000_000 - 1_700_000_000 % 300
+    series = []
+    for site in range(3):
+        periods = []
+        for step in range(48):
+            latency = 10 + step % 3
+            if site == 1 and step in (30, 31, 32):
+                latency = 250
+            wan = {"avgLatency": latency, "packetLoss": 0, "uptime": 100}
+            if site == 2 and step == 5:
+                wan = {}
+            periods.append({"metricTime": main.format_timestamp(begin + step * 300), "data": {"wan": wan}})
+        series.append({"siteId": f"site_{site}", "hostId": f"host_{site}", "periods": periods})
+    store.add("5m", {"data": series})
+
+    result = store.analyze("5m", begin, begin + 48 * 300, metrics=["avgLatency", "uptime"],
+                           percentiles=[50, 95], window=3, top=2)
+    assert result["sites_analyzed"] == 3 and result["periods"] == 48
+    worst = result["sites"][0]
+    assert worst["siteId"] == "site_1" and len(result["sites"]) == 2
+    latency = worst["metrics"]["avgLatency"]
+    assert latency["anomalies"] == 3 and latency["max"] == 250
+    assert latency["worst_window_avg"] == 250
+    assert latency["worst_window_start"] == main.format_timestamp(begin + 30 * 300)
+    summary = store.summarize("5m", begin, begin + 48 * 300, ["site_1"], ["avgLatency"], [50, 95])
+    assert latency["p95"] == round(summary["site_1"]["avgLatency"]["p95"], 3)
+    assert latency["avg"] == round(summary["site_1"]["avgLatency"]["avg"], 3)
+    assert result["fleet"]["avgLatency"]["sites_with_anomalies"] == 1
+
+    gaps = store.analyze("5m", begin, begin + 48 * 300, site_ids=["site_2"], sort_by="avgLatency")
+    assert gaps["sites"][0]["metrics"]["avgLatency"]["count"] == 47
+
+
+def test_batch_runs_operations_concurrently():
+    async def run():
+        active = {"now": 0, "peak": 0}
+
+        async def handler(request: httpx.Request) -> httpx.Response:
+            active["now"] += 1
+            active["peak"] = max(active["peak"], active["now"])
+            await asyncio.sleep(0.05)
+            active["now"] -= 1
+            config_id = request.url.path.split("/")[-2]
+            if config_id == "missing":
+                return httpx.Response(404, json={"message": "not found"})
+            return httpx.Response(200, json={"data": {"id": config_id, "generateStatus": "OK"}})
+
+        main.unifi_client = make_client(handler)
+        main.unifi_client.max_retries = 0
+        try:
+            operations = [{"tool": "get_sdwan_config_status", "input": {"config_id": f"config_{i}"}} for i in range(6)]
+            operations += [
+                {"tool": "get_sdwan_config_status", "input": {"config_id": "missing"}},
+                {"tool": "get_sdwan_config_status", "input": {}},
+                {"tool": "delete_everything", "input": {}},
+            ]
+            started = time.perf_counter()
+            output = await main.batch(main.BatchInput(operations=operations, max_concurrency=3))
+            assert time.perf_counter() - started < 0.3
+            assert active["peak"] == 3
+            assert (output.succeeded, output.failed) == (6, 3)
+            assert output.results[0].data.data["data"]["id"] == "config_0"
+            assert [result.status_code for result in output.results[6:]] == [500, 400, 400]
+            assert "config_id" in output.results[7].error
+            assert json.loads(main.json_dumps(output))["results"][1]["data"]["data"]["data"]["id"] == "config_1"
+        finally:
+            main.unifi_client = None
+    asyncio.run(run())
+
+
+def test_sdwan_overview_joins_statuses():
+    async def run():
+        calls = []
+
+        async def handler(request: httpx.Request) -> httpx.Response:
+            calls.append(request.url.path)
+            if request.url.path == "/v1/sd-wan/configs":
+                configs = [{"id": f"config_{i}", "name": f"Mesh {i}", "type": "sitemagic"} for i in range(8)]
+                return httpx.Response(200, json={"data": configs, "nextToken": None})
+            await asyncio.sleep(0.05)
+            config_id = request.url.path.split("/")[-2]
+            if config_id == "config_7":
+                return httpx.Response(404, json={"message": "not found"})
+            status = {
+                "generateStatus": "OK",
+                "hubs": [{"id": "hub", "errors": [], "warnings": ["wan2 down"]}],
+                "spokes": [{"id": "a", "errors": ["unreachable"]}, {"id": "b"}],
+            }
+            return httpx.Response(200, json={"data": status})
+
+        client = make_client(handler)
+        client.max_retries = 0
+        started = time.perf_counter()
+        overview = await client.sdwan_overview()
+        assert time.perf_counter() - started < 0.2
+        assert (overview["count"], overview["failed"]) == (8, 1)
+        assert overview["data"][0] == {
+            "id": "config_0", "name": "Mesh 0", "type": "sitemagic", "status": "OK", "updatedAt": None,
+            "hubs": 1, "spokes": 2, "errors": 1, "warnings": 1,
+        }
+        assert "error" in overview["data"][7]
+
+        status_calls = len(calls)
+        await client.sdwan_overview()
+        # Successful statuses are cached; only the failed one is requested again
+        assert len(calls) == status_calls + 1
+        await client.sdwan_overview(live=True)
+        assert len(calls) == status_calls + 1 + 8
+    asyncio.run(run())
+
+
+def test_metrics_endpoint_reports_tools_and_upstream():
+    async def run():
+        main.unifi_client = make_client(paged_handler([{"id": "host_a"}], 10))
+        main.unifi_client.inventory_enabled = False
+        try:
+            await main.list_hosts(main.ListHostsInput(live=True))
+            await main.list_hosts(main.ListHostsInput(live=True))
+            await main.get_host_by_id(main.GetHostByIdInput(host_id="host_a", live=True))
+            response = await main.prometheus_metrics()
+        finally:
+            main.unifi_client = None
+        text = response.body.decode()
+        assert response.media_type.startswith("text/plain")
+        assert 'unifi_mcp_tool_calls_total{tool="list_hosts",outcome="ok"}' in text
+        assert 'unifi_mcp_tool_duration_seconds_bucket{tool="list_hosts",le="+Inf"}' in text
+        assert 'unifi_mcp_upstream_requests_total{method="GET",endpoint="/v1/hosts/{id}",status="200"}' in text
+        assert 'unifi_mcp_cache_lookups_total{endpoint="/v1/hosts",result="hit"}' in text
+        assert "unifi_mcp_upstream_response_bytes_total" in text and "unifi_mcp_concurrency_limit 8" in text
+
+
+def test_histogram_renders_cumulative_buckets():
+    registry = main.MetricsRegistry()
+    histogram = registry.histogram("latency_seconds", "Latency", ("tool",))
+    for value in (0.002, 0.002, 0.3, 60):
+        histogram.observe(value, ('say "hi"',))
+    text = registry.render()
+    assert 'latency_seconds_bucket{tool="say \\"hi\\"",le="0.005"} 2' in text
+    assert 'latency_seconds_bucket{tool="say \\"hi\\"",le="0.5"} 3' in text
+    assert 'latency_seconds_bucket{tool="say \\"hi\\"",le="+Inf"} 4' in text
+    assert 'latency_seconds_count{tool="say \\"hi\\"",le' not in text
+    assert main.endpoint_label("/v1/sd-wan/configs/abc123/status") == "/v1/sd-wan/configs/{id}/status"
+
+
+def test_tracing_spans_propagate_trace_context():
+    async def run():
+        upstream_headers = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            upstream_headers.append(request.headers.get("traceparent"))
+            return httpx.Response(200, json={"data": {"id": "host_a"}})
+
+        exporter = main.InMemorySpanExporter()
+        main.tracer.exporter = exporter
+        main.unifi_client = make_client(handler)
+        try:
+            incoming = "00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01"
+
+            async def app(scope, receive, send):
+                await main.get_host_by_id(main.GetHostByIdInput(host_id="host_a", live=True))
+                await send({"type": "http.response.start", "status": 200, "headers": []})
+
+            async def send(message):
+                pass
+
+            scope = {"type": "http", "method": "POST", "path": "/mcp", "headers": [(b"traceparent", incoming.encode())]}
+            await main.TraceContextMiddleware(app)(scope, None, send)
+        finally:
+            main.tracer.exporter = None
+            main.unifi_client = None
+        spans = {span["name"]: span for span in exporter.spans}
+        assert set(spans) == {"POST /mcp", "tool get_host_by_id", "unifi GET /v1/hosts/{id}", "upstream GET /v1/hosts/{id}"}
+        assert {span["traceId"] for span in spans.values()} == {"4bf92f3577b34da6a3ce929d0e0e4736"}
+        assert spans["POST /mcp"]["parentSpanId"] == "00f067aa0ba902b7"
+        assert spans["POST /mcp"]["attributes"]["http.response.status_code"] == 200
+        assert spans["tool get_host_by_id"]["parentSpanId"] == spans["POST /mcp"]["spanId"]
+        upstream = spans["upstream GET /v1/hosts/{id}"]
+        assert upstream["parentSpanId"] == spans["unifi GET /v1/hosts/{id}"]["spanId"]
+        assert upstream["attributes"]["http.response.status_code"] == "200"
+        assert "rate_limit.wait_s" in upstream["attributes"] and "concurrency.wait_s" in upstream["attributes"]
+        assert upstream_headers == [f"00-4bf92f3577b34da6a3ce929d0e0e4736-{upstream['spanId']}-01"]
+        assert main.tracer.span("disabled") is main.NOOP_SPAN
+        assert main.parse_traceparent("00-" + "0" * 32 + "-00f067aa0ba902b7-01") is None
+    asyncio.run(run())
+
+
+def test_tracing_records_rejected_tool_calls():
+    async def run():
+        exporter = main.InMemorySpanExporter()
+        main.tracer.exporter = exporter
+        main.unifi_client = make_client(lambda request: httpx.Response(200, json={"data": {}}))
+        dispatcher = main.MCPDispatcher(main.mcp_server)
+        try:
+            for name, arguments, status_code in (("get_host_by_id", {}, 400), ("missing", {}, 404)):
+                try:
+                    await dispatcher.call_tool(name, arguments)
+                    assert False, f"{name} accepted"
+                except main.HTTPException as e:
+                    assert e.status_code == status_code
+            output = await main.batch(main.BatchInput(operations=[{"tool": "get_host_by_id", "input": {}}]))
+            assert output.results[0].status_code == 400
+        finally:
+            main.tracer.exporter = None
+            main.unifi_client = None
+        rejected = [span for span in exporter.spans if span["name"] != "tool batch"]
+        assert [span["name"] for span in rejected] == ["tool get_host_by_id", "tool missing", "tool get_host_by_id"]
+        assert all(span["status"] == "ERROR" and span["events"][0]["name"] == "exception" for span in rejected)
+        assert rejected[2]["parentSpanId"] == next(span for span in exporter.spans if span["name"] == "tool batch")["spanId"]
+    asyncio.run(run())
+
+
+def test_mock_site_manager_pages_and_throttles():
+    from mock_site_manager import Fleet, MockSiteManager
+
+    async def run():
+        fleet = Fleet(hosts=30, devices_per_host=4, sdwan_configs=3)
+        with MockSiteManager(fleet, throttle_rate=0.2, retry_after=0, seed=1) as server:
+            client = UnifiClient()
+            client.base_url = server.url
+            client.cache_enabled = False
+            client.retry_base_delay = 0.001
+            client.max_retries = 10
+            await client.start()
+            try:
+                groups = [group async for group in client.iter_devices(page_size=7)]
+                status = await client.get_sdwan_config_status(fleet.sdwan_configs[0]["id"])
+                metrics = await client.get_isp_metrics("1h", duration="1d")
+            finally:
+                await client.close()
+        assert [group["hostId"] for group in groups] == [host["id"] for host in fleet.hosts]
+        assert sum(len(group["devices"]) for group in groups) == fleet.device_count == 120
+        assert server.responses[429] > 0 and server.requests["/v1/devices"] >= 5
+        assert status["data"]["hubs"][0]["id"] == fleet.sites[0]["siteId"]
+        assert len(metrics["data"]) == 30 and len(metrics["data"][0]["periods"]) == 24
+    asyncio.run(run())
+
+
+def test_disk_cache_survives_restart():
+    import tempfile
+
+    async def run():
+        calls = []
+        path = os.path.join(tempfile.mkdtemp(), "cache.db")
+        os.environ.update({"UNIFI_DISK_CACHE": "true", "UNIFI_DISK_CACHE_PATH": path})
+        try:
+            first = make_client(paged_handler([{"id": "host_1"}], 10, calls))
+            await first.list_hosts()
+            await first.close()
+            
+            # A restarted client answers from disk, and revalidates entries past their TTL in the background
+            second = make_client(paged_handler([{"id": "host_2"}], 10, calls))
+            assert (await second.list_hosts())["data"] == [{"id": "host_1"}]
+            assert len(calls) == 1 and second.cache_stats()["disk"]["hits"] == 1
+            second.cache_ttls["/v1/hosts"] = 0.0
+            second.cache.clear()
+            assert (await second.list_hosts())["data"] == [{"id": "host_1"}]
+            await asyncio.gather(*second._background_tasks)
+            assert len(calls) == 2
+            await second.close()
+            
+            # Another API key never sees the entries
+            os.environ["UNIFI_API_KEY"] = "other_api_key"
+            third = make_client(paged_handler([{"id": "host_3"}], 10, calls))
+            assert (await third.list_hosts())["data"] == [{"id": "host_3"}]
+            await third.close()
+        finally:
+            os.environ["UNIFI_API_KEY"] = "test_api_key"
+            for name in ("UNIFI_DISK_CACHE", "UNIFI_DISK_CACHE_PATH"):
+                os.environ.pop(name)
+        
+        cache = main.DiskCache(":memory:", max_bytes=250)
+        for i in range(5):
+            cache.set(f"key_{i}", {"data": "x" * 80})
+        assert cache.get("key_0") is None and cache.get("key_4")[0] == {"data": "x" * 80}
+        assert cache.size <= 250 and cache.evictions == 3
+    asyncio.run(run())
+
+
+def test_cold_start_defers_http_stack_and_client():
+    import subprocess
+    code = "import sys, main; print(sorted(m for m in ('fastapi', 'mcp', 'numpy', 'uvicorn') if m in sys.modules))"
+    result = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == "[]"
+    
+    async def run():
+        created = []
+        
+        def factory():
+            client = make_client(lambda request: httpx.Response(200, json={"data": {"id": "host_1"}}))
+            client.inventory_enabled = False
+            created.append(client)
+            return client
+        
+        original = main.UnifiClient
+        main.UnifiClient = factory
+        try:
+            result = await main.get_host_by_id(main.GetHostByIdInput(host_id="host_1"))
+            await main.get_host_by_id(main.GetHostByIdInput(host_id="host_1"))
+        finally:
+            main.UnifiClient = original
+            await main.unifi_client.close()
+            main.unifi_client = None
+        assert result.data == {"data": {"id": "host_1"}} and len(created) == 1
+    asyncio.run(run())
+    
+    paths = {route.path for route in main.app.routes}
+    assert "/metrics" in paths and vars(main)["app"] is main.app
+
+
+def test_shared_state_coalesces_fetches_and_budgets_across_workers():
+    import tempfile
+
+    async def run():
+        calls = []
+        
+        async def slow_handler(request):
+            calls.append(request)
+            await asyncio.sleep(0.2)
+            return httpx.Response(200, json={"data": [{"id": "host_1"}], "nextToken": None})
+        
+        path = os.path.join(tempfile.mkdtemp(), "shared.db")
+        os.environ["UNIFI_SHARED_STATE"] = f"sqlite:///{path}"
+        try:
+            # Two clients on one shared state stand in for two worker processes
+            workers = [make_client(slow_handler) for _ in range(2)]
+            results = await asyncio.gather(*(worker.list_hosts() for worker in workers))
+            assert [result["data"] for result in results] == [[{"id": "host_1"}]] * 2
+            assert len(calls) == 1
+            assert sum(worker.cache_stats()["shared"]["waits"] for worker in workers) == 1
+            assert workers[0].rate_limiter.stats()["shared"]
+            for worker in workers:
+                await worker.close()
+        finally:
+            os.environ.pop("UNIFI_SHARED_STATE")
+        
+        state = main.SQLiteSharedState(path, namespace="budget ")
+        other = main.SQLiteSharedState(path, namespace="budget ")
+        assert state.take_token("v1", 1.0, 2.0)[0] == 0.0
+        assert other.take_token("v1", 1.0, 2.0)[0] == 0.0
+        wait, tokens = state.take_token("v1", 1.0, 2.0)
+        assert 0.9 < wait <= 1.0 and tokens < 1
+        other.pause_bucket("v1", 30.0)
+        assert state.take_token("v1", 1.0, 2.0)[0] > 29
+        
+        assert state.acquire_lease("key", "a", 30.0) and not other.acquire_lease("key", "b", 30.0)
+        state.release_lease("key", "a")
+        assert other.acquire_lease("key", "b", 30.0)
+        state.close()
+        other.close()
+    asyncio.run(run())
+
+
+SHARED_WORKER = """
+import asyncio, sys, main
+async def run():
+    client = main.UnifiClient()
+    client.inventory_enabled = False
+    result = await client.list_hosts()
+    await client.close()
+    print(len(result["data"]))
+asyncio.run(run())
+"""
+
+
+def test_worker_processes_share_upstream_calls():
+    import subprocess
+    import tempfile
+    from mock_site_manager import Fleet, MockSiteManager
+    
+    with MockSiteManager(Fleet(hosts=5, devices_per_host=1), latency=0.3) as server:
+        env = {**os.environ, "UNIFI_API_URL": server.url, "UNIFI_INVENTORY_SYNC": "false",
+               "UNIFI_SHARED_STATE": os.path.join(tempfile.mkdtemp(), "shared.db")}
+        workers = [
+            subprocess.Popen([sys.executable, "-c", SHARED_WORKER], cwd=os.path.dirname(os.path.abspath(__file__)),
+                             env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+            for _ in range(3)
+        ]
+        assert [worker.communicate(timeout=60)[0].strip() for worker in workers] == ["5"] * 3
+        assert server.requests["/v1/hosts"] == 1
+
+
+def sleeping_registry(started, delay=0.2):
+    registry = main.ToolRegistry()
+    
+    @registry.tool("sleep", main.GetHostByIdInput, main.GetHostByIdOutput, "Sleep, then echo the host ID")
+    async def sleep_tool(input):
+        started.append(input.host_id)
+        await asyncio.sleep(delay)
+        return main.GetHostByIdOutput(data={"id": input.host_id, "tenant": main._current_tenant.get()})
+    
+    @registry.tool("fail", main.GetHostByIdInput, main.GetHostByIdOutput, "Always fails")
+    async def fail_tool(input):
+        raise main.HTTPException(status_code=500, detail=f"Host {input.host_id} unavailable")
+    
+    return registry
+
+
+def call_message(request_id, tool, **arguments):
+    return {"jsonrpc": "2.0", "id": request_id, "method": "tools/call", "params": {"name": tool, "arguments": arguments}}
+
+
+INITIALIZE = {"jsonrpc": "2.0", "id": 0, "method": "initialize", "params": {
+    "protocolVersion": "2025-03-26", "capabilities": {}, "clientInfo": {"name": "test", "version": "1.0"},
+}}
+
+
+class StdioConnection:
+    """Serve a dispatcher over in-memory SDK message streams, as the stdio transport does"""
+    
+    def __init__(self, dispatcher):
+        import anyio
+        self.dispatcher = dispatcher
+        self.client_send, self.server_read = anyio.create_memory_object_stream(100)
+        self.server_write, self.client_read = anyio.create_memory_object_stream(100)
+    
+    async def __aenter__(self):
+        self.task = asyncio.ensure_future(main.serve_stdio(self.dispatcher, self.server_read, self.server_write))
+        await self.send(INITIALIZE)
+        assert (await self.receive())["result"]["serverInfo"]["name"] == "unifi"
+        await self.send({"jsonrpc": "2.0", "method": "notifications/initialized"})
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        await self.client_send.aclose()
+        await self.task
+    
+    async def send(self, message):
+        import mcp_types
+        from mcp.shared.message import SessionMessage
+        await self.client_send.send(SessionMessage(mcp_types.jsonrpc_message_adapter.validate_python(message)))
+    
+    async def receive(self):
+        return (await self.client_read.receive()).message.model_dump(by_alias=True, exclude_unset=True)
+
+
+def test_mcp_transport_runs_tool_calls_concurrently():
+    async def run():
+        started = []
+        main.unifi_client = make_client(lambda request: httpx.Response(200, json={}))
+        try:
+            async with StdioConnection(main.MCPDispatcher(sleeping_registry(started), max_in_flight=8)) as connection:
+                await connection.send({"jsonrpc": "2.0", "id": 1, "method": "tools/list"})
+                tools = (await connection.receive())["result"]["tools"]
+                assert [tool["name"] for tool in tools] == ["sleep", "fail"]
+                assert "host_id" in tools[0]["inputSchema"]["properties"]
+                
+                start = time.perf_counter()
+                for i in range(2, 7):
+                    await connection.send(call_message(i, "sleep", host_id=f"host_{i}"))
+                responses = sorted([await connection.receive() for _ in range(5)], key=lambda response: response["id"])
+                assert time.perf_counter() - start < 0.5
+                assert [json.loads(r["result"]["content"][0]["text"])["data"]["id"] for r in responses] == [
+                    f"host_{i}" for i in range(2, 7)
+                ]
+                
+                await connection.send(call_message(7, "fail", host_id="host_x"))
+                failed = await connection.receive()
+                assert failed["result"]["isError"] and "host_x unavailable" in failed["result"]["content"][0]["text"]
+                await connection.send(call_message(8, "sleep"))
+                assert (await connection.receive())["error"]["code"] == -32602
+                await connection.send(call_message(9, "missing"))
+                assert (await connection.receive())["error"]["code"] == -32602
+                await connection.send({"jsonrpc": "2.0", "id": 10, "method": "prompts/list"})
+                assert (await connection.receive())["error"]["code"] == -32601
+        finally:
+            await main.unifi_client.close()
+            main.unifi_client = None
+    asyncio.run(run())
+
+
+def test_mcp_dispatcher_limits_and_sheds_load():
+    async def run():
+        started = []
+        dispatcher = main.MCPDispatcher(sleeping_registry(started, delay=5), max_in_flight=1, max_pending=2)
+        main.unifi_client = make_client(lambda request: httpx.Response(200, json={}))
+        try:
+            first = asyncio.ensure_future(dispatcher.call_tool("sleep", {"host_id": "a"}))
+            second = asyncio.ensure_future(dispatcher.call_tool("sleep", {"host_id": "b"}))
+            await asyncio.sleep(0.05)
+            # One call runs, the other waits for the in-flight slot, and a third is refused
+            assert started == ["a"] and dispatcher.pending == 2
+            try:
+                await dispatcher.call_tool("sleep", {"host_id": "c"})
+                assert False, "expected ServerBusyError"
+            except main.ServerBusyError as e:
+                assert e.status_code == 503 and e.headers == {"Retry-After": "1"}
+            
+            first.cancel()
+            await asyncio.sleep(0.05)
+            assert started == ["a", "b"]
+            second.cancel()
+            await asyncio.gather(first, second, return_exceptions=True)
+            assert dispatcher.pending == 0
+            assert dispatcher.stats()["cancelled"] == 2 and dispatcher.stats()["rejected"] == 1
+        finally:
+            await main.unifi_client.close()
+            main.unifi_client = None
+    asyncio.run(run())
+
+
+def test_stdio_transport_cancels_and_applies_backpressure():
+    async def run():
+        started = []
+        main.unifi_client = make_client(lambda request: httpx.Response(200, json={}))
+        try:
+            dispatcher = main.MCPDispatcher(sleeping_registry(started, delay=0.2))
+            async with StdioConnection(dispatcher) as connection:
+                # The slow call is answered after the ping that came in behind it
+                await connection.send(call_message(1, "sleep", host_id="slow"))
+                await connection.send({"jsonrpc": "2.0", "id": 2, "method": "ping"})
+                assert [(await connection.receive())["id"] for _ in range(2)] == [2, 1]
+                
+                # A cancelled call is never answered
+                await connection.send(call_message(3, "sleep", host_id="cancelled"))
+                await asyncio.sleep(0.05)
+                await connection.send({"jsonrpc": "2.0", "method": "notifications/cancelled", "params": {"requestId": 3}})
+                await connection.send({"jsonrpc": "2.0", "id": 4, "method": "ping"})
+                assert (await connection.receive())["id"] == 4
+                await asyncio.sleep(0.3)
+                assert dispatcher.cancelled == 1 and dispatcher.pending == 0
+            
+            # While the dispatcher is full, stdio stops reading instead of refusing requests
+            dispatcher = main.MCPDispatcher(sleeping_registry(started, delay=0.2), max_pending=1)
+            async with StdioConnection(dispatcher) as connection:
+                await connection.send(call_message(5, "sleep", host_id="first"))
+                await connection.send(call_message(6, "sleep", host_id="second"))
+                await connection.send({"jsonrpc": "2.0", "id": 7, "method": "ping"})
+                assert [(await connection.receive())["id"] for _ in range(3)] == [5, 6, 7]
+                assert dispatcher.rejected == 0
+        finally:
+            await main.unifi_client.close()
+            main.unifi_client = None
+    asyncio.run(run())
+
+
+def test_streamable_http_sessions():
+    async def run():
+        original = main.mcp_server
+        main.mcp_server = sleeping_registry([], delay=0)
+        main.unifi_client = make_client(lambda request: httpx.Response(200, json={}))
+        try:
+            for stateless in (False, True):
+                os.environ["UNIFI_MCP_STATELESS"] = str(stateless).lower()
+                app = main.create_app()
+                async with app.router.lifespan_context(app):
+                    transport = httpx.ASGITransport(app=app)
+                    async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+                        accept = {"Accept": "application/json, text/event-stream"}
+                        response = await http.post("/mcp", json=INITIALIZE, headers=accept)
+                        assert response.json()["result"]["serverInfo"]["name"] == "unifi"
+                        session = response.headers.get("mcp-session-id")
+                        assert (session is None) == stateless
+                        headers = {**accept, "MCP-Protocol-Version": "2025-03-26", "X-Unifi-Api-Key": "test_api_key"}
+                        if session:
+                            headers["Mcp-Session-Id"] = session
+                        response = await http.post("/mcp", json={"jsonrpc": "2.0", "method": "notifications/initialized"},
+                                                   headers=headers)
+                        assert response.status_code == 202
+                        
+                        # Tool calls see the tenant chosen by the request's headers
+                        responses = await asyncio.gather(*(
+                            http.post("/mcp", json=call_message(i, "sleep", host_id=f"host_{i}"), headers=headers)
+                            for i in (3, 4)
+                        ))
+                        results = [json.loads(r.json()["result"]["content"][0]["text"]) for r in responses]
+                        assert results == [{"data": {"id": f"host_{i}", "tenant": ["key", "test_api_key"]}} for i in (3, 4)]
+                        
+                        response = await http.post("/mcp", json={"jsonrpc": "2.0", "id": 5, "method": "ping"}, headers=accept)
+                        assert response.status_code == (200 if stateless else 400)
+                        if session:
+                            assert (await http.delete("/mcp", headers=headers)).status_code == 200
+                            response = await http.post("/mcp", json={"jsonrpc": "2.0", "id": 6, "method": "ping"},
+                                                       headers=headers)
+                            assert response.status_code == 404
+                        
+                        response = await http.post("/mcp/tools/sleep", json={"host_id": "c"})
+                        assert response.json() == {"data": {"id": "c", "tenant": None}}
+                        assert (await http.post("/mcp/tools/missing", json={})).status_code == 404
+                        assert (await http.post("/mcp/tools/sleep", json={})).status_code == 400
+                main.unifi_client = make_client(lambda request: httpx.Response(200, json={}))
+        finally:
+            os.environ.pop("UNIFI_MCP_STATELESS", None)
+            main.mcp_server = original
+            await main.unifi_client.close()
+            main.unifi_client = None
+    asyncio.run(run())
+
+
+def test_tenant_clients_are_isolated_and_evicted():
+    async def run():
+        created = []
+        
+        def factory(api_key):
+            # Each tenant's API answers with the key it was called with
+            def handler(request):
+                return httpx.Response(200, json={"data": {"id": request.url.path.rsplit("/", 1)[-1],
+                                                          "key": request.headers["x-api-key"]}})
+            client = UnifiClient(api_key=api_key)
+            client._http_client = httpx.AsyncClient(transport=httpx.MockTransport(handler), headers=client.headers)
+            created.append(client)
+            return client
+        
+        main.tenant_clients = main.ClientRegistry(factory, max_clients=2, idle_timeout=60.0)
+        main.tenants = {"acme": ("key_acme", "acme-token"), "initech": ("key_initech", None)}
+        main.unifi_client = make_client(lambda request: httpx.Response(200, json={"data": {"key": "default"}}))
+        
+        async def host_for(selection):
+            token = main._current_tenant.set(selection)
+            try:
+                return (await main.get_host_by_id(main.GetHostByIdInput(host_id="host_1", live=True))).data["data"]
+            finally:
+                main._current_tenant.reset(token)
+        
+        try:
+            assert (await host_for(None))["key"] == "default"
+            assert (await host_for(("key", "test_api_key")))["key"] == "default"
+            results = await asyncio.gather(host_for(("key", "key_a")), host_for(("key", "key_a")), host_for(("name", "acme", "acme-token")))
+            assert [result["key"] for result in results] == ["key_a", "key_a", "key_acme"] and len(created) == 2
+            assert created[0].cache.stats()["entries"] == 1 and main.unifi_client.cache.stats()["entries"] == 1
+            assert created[0].disk_cache is None and created[0].rate_limiter is not created[1].rate_limiter
+            
+            status_token = main._current_tenant.set(("key", "key_a"))
+            try:
+                status = await main.get_client_status(main.GetClientStatusInput())
+            finally:
+                main._current_tenant.reset(status_token)
+            assert status.tenant == main.tenant_id("key_a") and status.tenants["clients"] == 2
+            
+            # A third tenant evicts the least recently used idle client
+            assert (await host_for(("key", "key_b")))["key"] == "key_b"
+            assert list(main.tenant_clients._clients) == ["key_a", "key_b"]
+            assert main.tenant_clients.evicted == 1 and created[1]._http_client is None
+            
+            main.tenant_clients.idle_timeout = 0.0
+            await main.tenant_clients.evict()
+            assert main.tenant_clients.stats()["clients"] == 0
+            
+            # Names need the tenant's token, or an explicit opt-in for tenants without one
+            for selection, status_code in ((("name", "unknown", None), 404), (("name", "acme", None), 401),
+                                           (("name", "acme", "wrong"), 401), (("name", "initech", None), 401)):
+                try:
+                    await host_for(selection)
+                    assert False, f"{selection} accepted"
+                except main.HTTPException as e:
+                    assert e.status_code == status_code, selection
+            os.environ["UNIFI_TENANTS_TRUST_NAMES"] = "true"
+            try:
+                assert (await host_for(("name", "initech", None)))["key"] == "key_initech"
+            finally:
+                del os.environ["UNIFI_TENANTS_TRUST_NAMES"]
+            
+            # Over HTTP the tenant is chosen with a header
+            main.tenant_clients.idle_timeout = 60.0
+            transport = httpx.ASGITransport(app=main.create_app())
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+                response = await http.post("/mcp/tools/get_host_by_id", json={"host_id": "host_2", "live": True},
+                                           headers={"X-Unifi-Api-Key": "key_c"})
+                assert response.json()["data"]["data"] == {"id": "host_2", "key": "key_c"}
+                response = await http.post("/mcp/tools/get_host_by_id", json={"host_id": "host_2", "live": True})
+                assert response.json()["data"]["data"] == {"key": "default"}
+                # An explicit key wins over a tenant name in either order
+                for headers in ([("X-Unifi-Tenant", "acme"), ("X-Unifi-Api-Key", "key_c")],
+                                [("X-Unifi-Api-Key", "key_c"), ("X-Unifi-Tenant", "acme")]):
+                    response = await http.post("/mcp/tools/get_host_by_id", json={"host_id": "host_2", "live": True},
+                                               headers=headers)
+                    assert response.json()["data"]["data"]["key"] == "key_c"
+                response = await http.post("/mcp/tools/get_host_by_id", json={"host_id": "host_2", "live": True},
+                                           headers={"X-Unifi-Tenant": "acme"})
+                assert response.status_code == 401
+                response = await http.post("/mcp/tools/get_host_by_id", json={"host_id": "host_2", "live": True},
+                                           headers={"X-Unifi-Tenant": "acme", "Authorization": "Bearer acme-token"})
+                assert response.json()["data"]["data"]["key"] == "key_acme"
+        finally:
+            await main.tenant_clients.close()
+            main.tenant_clients = None
+            main.tenants = None
+            await main.unifi_client.close()
+            main.unifi_client = None
+    asyncio.run(run())
+    
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), "tenants.json")
+    with open(path, "w") as f:
+        json.dump({"acme": {"api_key": "key_acme", "token": "acme-token"}, "initech": "key_initech"}, f)
+    assert main.load_tenants(path) == {"acme": ("key_acme", "acme-token"), "initech": ("key_initech", None)}
+    with open(path, "w") as f:
+        json.dump({"acme": {"api_key": "key_acme"}}, f)
+    try:
+        main.load_tenants(path)
+        assert False, "tenant without a token accepted"
+    except ValueError:
+        pass
+
+
+def test_tenant_client_creation_is_never_evicted_before_use():
+    async def run():
+        started = {"a": asyncio.Event(), "b": asyncio.Event(), "c": asyncio.Event()}
+        
+        def factory(api_key):
+            client = make_client(lambda request: httpx.Response(200, json={}))
+            
+            async def start():
+                await started[api_key].wait()
+            client.start = start
+            return client
+        
+        registry = main.ClientRegistry(factory, max_clients=1, idle_timeout=60.0)
+        try:
+            # b's creation evicts idle clients as soon as a's client exists, before a's callers resume
+            acquires = [asyncio.ensure_future(registry.acquire(key)) for key in ("a", "a", "b")]
+            await asyncio.sleep(0)
+            started["a"].set()
+            started["b"].set()
+            first, second, other = await asyncio.gather(*acquires)
+            assert first is second and first._http_client is not None
+            assert registry._clients["a"].in_use == 2 and registry._clients["b"].in_use == 1
+            
+            # A cancelled creator hands its reservation back
+            creating = asyncio.ensure_future(registry.acquire("c"))
+            await asyncio.sleep(0)
+            creating.cancel()
+            started["c"].set()
+            await asyncio.sleep(0.01)
+            assert registry._clients["c"].in_use == 0
+        finally:
+            await registry.close()
+    asyncio.run(run())
+
+
+
+def test_tenant_client_eviction_is_atomic():
+    async def run():
+        release_close, closed = asyncio.Event(), []
+        
+        def factory(api_key):
+            client = make_client(lambda request: httpx.Response(200, json={}))
+            
+            async def close():
+                await release_close.wait()
+                closed.append(client)
+            client.close = close
+            return client
+        
+        registry = main.ClientRegistry(factory, max_clients=10, idle_timeout=60.0)
+        try:
+            for key in ("a", "b"):
+                await registry.acquire(key)
+                registry.release(key)
+            old_b = registry._clients["b"].client
+            
+            # Concurrent evictions while the first close is pending never pick the same victim twice
+            registry.idle_timeout = 0.0
+            evictions = [asyncio.ensure_future(registry.evict()) for _ in range(2)]
+            await asyncio.sleep(0)
+            assert not registry._clients and registry.evicted == 2
+            
+            # A tenant acquiring mid-eviction gets a fresh client, which the eviction leaves open
+            registry.idle_timeout = 60.0
+            client = await registry.acquire("b")
+            assert client is not old_b
+            release_close.set()
+            await asyncio.gather(*evictions)
+            assert old_b in closed and client not in closed
+            assert registry._clients["b"].in_use == 1 and registry.evicted == 2
+        finally:
+            release_close.set()
+            await registry.close()
+    asyncio.run(run())
+
+if __name__ == "__main__":
+    failures = 0
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_") and callable(test):
+            try:
+                test()
+                logger.info(f"✅ {name}: PASSED")
+            except Exception as e:
+                failures += 1
+                logger.error(f"❌ {name}: FAILED - {e!r}")
+    sys.exit(1 if failures else 0)